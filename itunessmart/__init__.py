@@ -30,11 +30,28 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-__all__ = ["Parser", "SmartPlaylist", "BytesParser", "createXSPFile", "createXSP", "PlaylistException", "EmptyPlaylistException", "readiTunesLibrary", "generatePersistentIDMapping", "createPlaylistTree", "LibraryException"]
+__all__ = ["Parser", "SmartPlaylist", "BytesParser", "createXSPFile", "createXSP", "writeXSP", "SubPlaylistRegistry", "exportXSPFiles", "ExportResult", "ExportReport", "FileWriterPool", "atomicOpen", "atomicWrite", "PlaylistException", "EmptyPlaylistException", "readiTunesLibrary", "generatePersistentIDMapping", "createPlaylistTree", "LibraryException", "createTrackRecord", "createTrackRecords", "searchKey", "compileSmartPlaylist", "evaluateSmartPlaylist", "predicateSource", "EvaluationException", "TrackTable", "evaluateSmartPlaylists", "TrackDatabase", "selectTracks", "LibraryEvaluator", "PlaylistCycleException", "playlistDependencies", "ruleFields", "FieldDependencyIndex", "limitFields", "StringIndex", "RangeIndex", "TrackIndex", "optimizeRules", "FieldStatistics", "LibraryStatistics", "explainSmartPlaylist", "iterTrackRecords", "StreamEvaluator", "evaluateStream", "RuleGraph", "PatternMatcher", "SharedTrackTable", "evaluateParallel", "DateSchedule", "nextChange", "CountEstimate", "estimateCount", "iterCountEstimates"]
 
 from itunessmart.parse import SmartPlaylistParser, SmartPlaylist
-from itunessmart.xsp import createXSPFile, createXSP, PlaylistException, EmptyPlaylistException
-from itunessmart.library import readiTunesLibrary, generatePersistentIDMapping, createPlaylistTree, LibraryException
+from itunessmart.xsp import createXSPFile, createXSP, writeXSP, SubPlaylistRegistry, PlaylistException, EmptyPlaylistException
+from itunessmart.export import exportXSPFiles, ExportResult, ExportReport
+from itunessmart.output import FileWriterPool, atomicOpen, atomicWrite
+from itunessmart.library import readiTunesLibrary, generatePersistentIDMapping, createPlaylistTree, LibraryException, createTrackRecord, createTrackRecords, iterTrackRecords, searchKey
+from itunessmart.evaluate import compileSmartPlaylist, evaluateSmartPlaylist, predicateSource, EvaluationException
+from itunessmart.columnar import TrackTable, evaluateSmartPlaylists
+from itunessmart.sql import TrackDatabase
+from itunessmart.parallel import SharedTrackTable, evaluateParallel
+from itunessmart.selection import selectTracks, limitFields
+from itunessmart.optimize import optimizeRules
+from itunessmart.statistics import FieldStatistics, LibraryStatistics
+from itunessmart.index import StringIndex, RangeIndex, TrackIndex
+from itunessmart.explain import explainSmartPlaylist
+from itunessmart.schedule import DateSchedule, nextChange
+from itunessmart.sampling import CountEstimate, estimateCount, iterCountEstimates
+from itunessmart.dependency import LibraryEvaluator, PlaylistCycleException, playlistDependencies, ruleFields, FieldDependencyIndex
+from itunessmart.stream import StreamEvaluator, evaluateStream
+from itunessmart.patterns import PatternMatcher
+from itunessmart.sharing import RuleGraph
 
 
 class Parser:
@@ -31,7 +31,22 @@ def printWithoutException(s):
             print(str(s).encode('ascii', errors='replace').decode('ascii'))
 
 
-def main(iTunesLibraryFile=None, outputDirectory=None):
+def printExportResult(result):
+    if result.error == "decode":
+        print("! Failed to decode playlist:")
+        print(result.traceback)
+        printWithoutException(result.name)
+    elif result.error == "empty":
+        printWithoutException("! `%s` is empty." % result.name)
+    elif result.error == "skipped":
+        printWithoutException("! Skipped `%s`: %s" % (result.name, result.message))
+    elif result.error == "failed":
+        print("! Failed to convert playlist:")
+        print(result.traceback)
+        printWithoutException(result.name)
+
+
+def main(iTunesLibraryFile=None, outputDirectory=None, processes=None):
 
     if iTunesLibraryFile == "--help" or iTunesLibraryFile == "-h" or iTunesLibraryFile == "/?":
         print("""Export smart playlists from 'iTunes Music Library.xml' to .xsp files for Kodi.
@@ -39,10 +54,11 @@ This interactive script uses the default iTunes library, but you may also specif
 
 Optional arguments:
 
-python3 -m itunessmart {iTunesLibraryFile} {outputDirectory}
+python3 -m itunessmart {iTunesLibraryFile} {outputDirectory} {processes}
 
 {iTunesLibraryFile}\t - Default is ~\\Music\\iTunes\\iTunes Music Library.xml
-{outputDirectory}\t - Default is ./out/""")
+{outputDirectory}\t - Default is ./out/
+{processes}\t\t - Number of worker processes to convert all playlists, default is the number of CPUs""")
         return
 
     export_sub_playlists = True
@@ -81,6 +97,16 @@ python3 -m itunessmart {iTunesLibraryFile} {outputDirectory}
     if userinput.lower() in ("n", "no", "0"):
         export_sub_playlists = False
 
+    incremental = False
+    remove_stale = False
+    if export_all:
+        userinput = input("# Do you want to keep a manifest in the output directory and only convert the playlists that changed? (yes/no) ")
+        if userinput.lower() in ("y", "yes", "1"):
+            incremental = True
+            userinput = input("# Do you want to remove the files of the last export that no playlist creates anymore? (yes/no) ")
+            if userinput.lower() in ("y", "yes", "1"):
+                remove_stale = True
+
     # Decode and export all smart playlists
 
     parser = itunessmart.Parser()
@@ -93,38 +119,30 @@ python3 -m itunessmart {iTunesLibraryFile} {outputDirectory}
 
     if export_all:
         print("# Converting playlists to %s" % outputDirectory)
-
-    res = []
-    for playlist in library['Playlists']:
-        if 'Name' in playlist and 'Smart Criteria' in playlist and 'Smart Info' in playlist and playlist['Smart Criteria']:
-            try:
-                parser.update_data_bytes(playlist['Smart Info'], playlist['Smart Criteria'])
-            except Exception as e:
-                print("! Failed to decode playlist:")
+        report = itunessmart.exportXSPFiles(library['Playlists'], outputDirectory, createSubplaylists=export_sub_playlists, persistentIDMapping=persistentIDMapping, processes=int(processes) if processes else None, incremental=incremental, removeStale=remove_stale)
+        for result in report.results:
+            printExportResult(result)
+        for filename in report.removed:
+            printWithoutException("# Removed %s" % filename)
+        print("# %s" % report)
+    else:
+        res = []
+        for playlist in library['Playlists']:
+            if 'Name' in playlist and 'Smart Criteria' in playlist and 'Smart Info' in playlist and playlist['Smart Criteria']:
                 try:
-                    print(traceback.format_exc())
-                    printWithoutException(playlist['Name'])
-                except KeyError:
-                    printWithoutException(playlist)
-
-            if not parser.result:
-                continue
+                    parser.update_data_bytes(playlist['Smart Info'], playlist['Smart Criteria'])
+                except Exception as e:
+                    print("! Failed to decode playlist:")
+                    try:
+                        print(traceback.format_exc())
+                        printWithoutException(playlist['Name'])
+                    except KeyError:
+                        printWithoutException(playlist)
+
+                if not parser.result:
+                    continue
 
-            try:
                 res.append((playlist['Name'], parser.result))
-                if export_all:
-                    itunessmart.createXSPFile(directory=outputDirectory, name=playlist['Name'], smartPlaylist=parser.result, createSubplaylists=export_sub_playlists, persistentIDMapping=persistentIDMapping)
-            except itunessmart.EmptyPlaylistException as e:
-                printWithoutException("! `%s` is empty." % playlist['Name'])
-            except itunessmart.PlaylistException as e:
-                printWithoutException("! Skipped `%s`: %s" % (playlist['Name'], str(e)))
-            except Exception as e:
-                print("! Failed to convert playlist:")
-                try:
-                    print(traceback.format_exc())
-                    printWithoutException(playlist['Name'])
-                except KeyError:
-                    printWithoutException(playlist)
 
     if not export_all:
         i = 1
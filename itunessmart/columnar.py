@@ -0,0 +1,199 @@
+"""
+Module to evaluate smart playlists with NumPy over a columnar track table
+"""
+
+import time
+from typing import Dict, Hashable, List, Mapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from itunessmart.data_structure import StringFields, IntFields, DateFields, BooleanFields
+from itunessmart.parse import SmartPlaylist
+from itunessmart.library import searchKey
+from itunessmart.evaluate import EvaluationException, evaluateSmartPlaylist
+from itunessmart.optimize import optimizeRules
+
+__all__ = ["TrackTable", "evaluateSmartPlaylists"]
+
+_stringTests = {
+    "like": lambda s, value: value in s,
+    "not like": lambda s, value: value not in s,
+    "is": lambda s, value: s == value,
+    "is not": lambda s, value: s != value,
+    "starts with": lambda s, value: s.startswith(value),
+    "ends with": lambda s, value: s.endswith(value)
+}
+
+_listTests = {
+    "is": lambda s, value: s == value,
+    "is not": lambda s, value: s != value
+}
+
+_intTests = {
+    "is": lambda column, value: column == value,
+    "is not": lambda column, value: column != value,
+    "greater than": lambda column, value: column > value,
+    "less than": lambda column, value: column < value,
+    "between": lambda column, value: (column >= value[0]) & (column <= value[1])
+}
+
+# Missing dates are NaN, every comparison with NaN is False
+_dateTests = {
+    "is after": lambda column, value, now: column > value,
+    "is before": lambda column, value, now: column < value,
+    "is in the range": lambda column, value, now: (column >= value[0]) & (column <= value[1]),
+    "is not in the range": lambda column, value, now: ~((column >= value[0]) & (column <= value[1])),
+    "is in the last": lambda column, value, now: (now - column) < value,
+    "is not in the last": lambda column, value, now: numpy.isnan(column) | ((now - column) > value)
+}
+
+_categoryFields = {"MediaKind", "iCloudStatus", "Love", "Location"}
+
+
+class TrackTable:
+    """Columnar table of track records. The columns are created on first use:
+    numbers and dates are typed arrays, strings are dictionary encoded so every distinct string is matched only once."""
+
+    def __init__(self, tracks: List[dict]):
+        """Create table from track records, see createTrackRecords()"""
+        if numpy is None:
+            raise EvaluationException("NumPy is not available")
+        self.tracks = tracks
+        self.trackIDs = numpy.fromiter((t["TrackID"] for t in tracks), dtype=numpy.int64, count=len(tracks))
+        self._columns = {}
+
+    @classmethod
+    def fromColumns(cls, trackIDs, columns: Mapping) -> "TrackTable":
+        """ Create a table from existing columns, e.g. arrays in shared memory. The table has no track records, so it can only evaluate rules on the given columns
+        :param trackIDs: array of the TrackIDs
+        :param columns: mapping from field to the column, see column()
+        :return: the table
+        :rtype: TrackTable
+        """
+        if numpy is None:
+            raise EvaluationException("NumPy is not available")
+        table = cls.__new__(cls)
+        table.tracks = None
+        table.trackIDs = trackIDs
+        table._columns = dict(columns)
+        return table
+
+    def __len__(self):
+        return len(self.trackIDs)
+
+    def column(self, field: str):
+        """Return the array of a field or a tuple (categories, codes) for a string field"""
+        if field not in self._columns:
+            self._columns[field] = self._createColumn(field)
+        return self._columns[field]
+
+    def _createColumn(self, field):
+        if self.tracks is None:
+            raise EvaluationException("Column not available", field)
+        n = len(self.tracks)
+        if field in StringFields.__members__ or field == "Uri":
+            return _encode([t["SearchKeys"][field] for t in self.tracks])
+        if field in _categoryFields:
+            return _encode([t[field] for t in self.tracks])
+        if field in IntFields.__members__:
+            return numpy.fromiter((t[field] for t in self.tracks), dtype=numpy.int64, count=n)
+        if field in DateFields.__members__:
+            return numpy.fromiter((numpy.nan if t[field] is None else t[field] for t in self.tracks), dtype=numpy.float64, count=n)
+        if field in BooleanFields.__members__:
+            return numpy.fromiter((t[field] for t in self.tracks), dtype=bool, count=n)
+        raise EvaluationException("Unknown field", field)
+
+    def mask(self, fulltree: dict, now: float = None, playlists: Mapping = None):
+        """ Evaluate the rules of a fulltree
+        :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+        :return: boolean array, True for all tracks that match the rules
+        :rtype: numpy.ndarray
+        """
+        if now is None:
+            now = time.time()
+        if playlists is None:
+            playlists = {}
+        if not fulltree:
+            return numpy.ones(len(self), dtype=bool)
+        return self._mask(fulltree, now, playlists)
+
+    def evaluate(self, smartPlaylist: SmartPlaylist, now: float = None, playlists: Mapping = None) -> List[int]:
+        """ Return the TrackIDs of all tracks that match the rules of the playlist, see evaluateSmartPlaylist()"""
+        return self.trackIDs[self.mask(optimizeRules(smartPlaylist.queryTree["fulltree"]), now, playlists)].tolist()
+
+    def _mask(self, obj, now, playlists):
+        if "and" in obj or "or" in obj:
+            operator = "and" if "and" in obj else "or"
+            result = numpy.full(len(self), operator == "and", dtype=bool)
+            for x in obj[operator]:
+                if operator == "and":
+                    result &= self._mask(x, now, playlists)
+                else:
+                    result |= self._mask(x, now, playlists)
+            return result
+
+        ruletype = obj.get("type")
+        operator = obj.get("operator")
+        try:
+            if ruletype == "string":
+                if obj["field"] == "Kind":
+                    return self._kindMask(obj)
+                return self._categoryMask(obj["field"], _stringTests[operator], searchKey(obj["value"]))
+            if ruletype in ("mediakind", "cloud", "love", "location"):
+                return self._categoryMask(obj["field"], _listTests[operator], obj["value"])
+            if ruletype == "int":
+                return _intTests[operator](self.column(obj["field"]), obj["value"])
+            if ruletype == "date":
+                return _dateTests[operator](self.column(obj["field"]), obj["value"], now)
+            if ruletype == "boolean" and operator == "is":
+                return self.column(obj["field"]) == obj["value"]
+            if ruletype == "playlist" and operator in ("is", "is not"):
+                members = numpy.fromiter(playlists.get(obj["value"], ()), dtype=numpy.int64)
+                return numpy.isin(self.trackIDs, members, invert=operator == "is not")
+        except KeyError:
+            pass
+        raise EvaluationException("Unsupported rule", obj)
+
+    def _categoryMask(self, field, test, value):
+        categories, codes = self.column(field)
+        matches = numpy.fromiter((test(s, value) for s in categories), dtype=bool, count=len(categories))
+        return matches[codes]
+
+    def _kindMask(self, obj):
+        """The parser converts Kind rules to rules on the file extension"""
+        negative = obj.get("operator") in ("not like", "is not")
+        if "kind_value" not in obj:
+            return numpy.full(len(self), negative, dtype=bool)
+        mask = self._categoryMask("Uri", _stringTests["ends with"], obj["kind_value"])
+        if obj["kind_operator"] == "not like":
+            return ~mask
+        return mask
+
+
+def _encode(values):
+    """Dictionary encoding: return the list of distinct values and the index of each value in that list"""
+    index = {}
+    codes = numpy.fromiter((index.setdefault(v, len(index)) for v in values), dtype=numpy.int32, count=len(values))
+    return list(index), codes
+
+
+def evaluateSmartPlaylists(smartPlaylists: Mapping[Hashable, SmartPlaylist], tracks: List[dict], now: float = None, playlists: Mapping = None) -> Dict[Hashable, List[int]]:
+    """ Evaluate many playlists on the same tracks. Uses a TrackTable if NumPy is available, otherwise the compiled predicates.
+    :param smartPlaylists: mapping from a key, e.g. the playlist name, to the result of the parser
+    :param tracks: the track records, see createTrackRecords()
+    :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+    :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+    :return: mapping from key to list of TrackIDs
+    :rtype: dict
+    """
+    if now is None:
+        now = time.time()
+    if numpy is None:
+        return {key: evaluateSmartPlaylist(smartPlaylist, tracks, now, playlists) for key, smartPlaylist in smartPlaylists.items()}
+    table = TrackTable(tracks)
+    return {key: table.evaluate(smartPlaylist, now, playlists) for key, smartPlaylist in smartPlaylists.items()}
@@ -231,3 +231,57 @@ class Offset(IntEnum):
     TIMEVALUE = 65     # begin the inverse int with the value of time - Relative offset from FIELD
     SUBLOGICTYPE = 68  # determine whether all or any criteria must match - Relative offset from FIELD
     SUBINT = 61        # begin the first int - Relative offset from FIELD
+
+
+# Keys of the track dicts in `iTunes Music Library.xml` for the fields used in the matching criteria
+# Fields that are not listed here are derived from several keys, see library.createTrackRecord()
+TrackKeys = {
+    # StringFields
+    "Album": "Album",
+    "AlbumArtist": "Album Artist",
+    "Artist": "Artist",
+    "Category": "Category",
+    "Comments": "Comments",
+    "Composer": "Composer",
+    "Description": "Description",
+    "Genre": "Genre",
+    "Grouping": "Grouping",
+    "Kind": "Kind",
+    "Name": "Name",
+    "Show": "Series",
+    "SortAlbum": "Sort Album",
+    "SortAlbumartist": "Sort Album Artist",
+    "SortComposer": "Sort Composer",
+    "SortName": "Sort Name",
+    "SortShow": "Sort Series",
+    "VideoRating": "Content Rating",
+    # Only used for sorting limited playlists
+    "SortArtist": "Sort Artist",
+    # IntFields
+    "BPM": "BPM",
+    "BitRate": "Bit Rate",
+    "DiskNumber": "Disc Number",
+    "Plays": "Play Count",
+    "SampleRate": "Sample Rate",
+    "Season": "Season",
+    "Size": "Size",
+    "Skips": "Skip Count",
+    "Duration": "Total Time",
+    "TrackNumber": "Track Number",
+    "Year": "Year",
+    # DateFields
+    "DateAdded": "Date Added",
+    "DateModified": "Date Modified",
+    "LastPlayed": "Play Date UTC",
+    "LastSkipped": "Skip Date",
+}
+
+# Sort keys fall back to the unsorted field
+TrackSortFallback = {
+    "SortAlbum": "Album",
+    "SortAlbumartist": "AlbumArtist",
+    "SortArtist": "Artist",
+    "SortComposer": "Composer",
+    "SortName": "Name",
+    "SortShow": "Show",
+}
@@ -0,0 +1,373 @@
+"""
+Module to evaluate all playlists of a library in the order of their dependencies
+"""
+
+import math
+import time
+import logging
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Mapping, Set, Tuple
+
+from itunessmart.parse import SmartPlaylistParser, SmartPlaylist
+from itunessmart.library import Library, createPlaylistTree, createTrackRecords
+from itunessmart.evaluate import EvaluationException, compileSmartPlaylist
+from itunessmart.selection import selectTracks, limitFields
+from itunessmart.optimize import optimizeRules
+from itunessmart.statistics import LibraryStatistics
+from itunessmart.schedule import DateSchedule
+
+__all__ = ["LibraryEvaluator", "PlaylistCycleException", "playlistDependencies", "ruleFields", "FieldDependencyIndex"]
+
+
+class PlaylistCycleException(EvaluationException):
+    pass
+
+
+def playlistDependencies(fulltree: dict) -> Set[str]:
+    """ Return the persistent IDs of all playlists that are referenced by the rules
+    :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+    :return: set of playlist persistent IDs
+    :rtype: set
+    """
+    result = set()
+    stack = [fulltree] if fulltree else []
+    while stack:
+        obj = stack.pop()
+        if "and" in obj or "or" in obj:
+            stack.extend(obj["and"] if "and" in obj else obj["or"])
+        elif obj.get("type") == "playlist":
+            result.add(obj["value"])
+    return result
+
+
+def ruleFields(fulltree: dict) -> Set[str]:
+    """ Return the fields of the track records that are read by the rules. Rules on other playlists only read the TrackID.
+    :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+    :return: set of field names
+    :rtype: set
+    """
+    result = set()
+    stack = [fulltree] if fulltree else []
+    while stack:
+        obj = stack.pop()
+        if "and" in obj or "or" in obj:
+            stack.extend(obj["and"] if "and" in obj else obj["or"])
+        elif obj.get("type") == "string" and obj["field"] == "Kind":
+            # The parser converts Kind rules to rules on the file extension
+            result.add("Uri")
+        elif obj.get("type") != "playlist":
+            result.add(obj["field"])
+    return result
+
+
+class FieldDependencyIndex:
+    """Map each playlist to the track fields that its rules and its limit read, and each field to the playlists that read it"""
+
+    def __init__(self, smartPlaylists: Mapping[str, SmartPlaylist]):
+        """ Create the index
+        :param smartPlaylists: mapping from playlist persistent ID to the result of the parser
+        """
+        self.fields = {}  # Map PlaylistPersistentId to the set of fields
+        self.playlists = defaultdict(set)  # Map field to the set of PlaylistPersistentIds
+        for persistentID, smartPlaylist in smartPlaylists.items():
+            self.fields[persistentID] = ruleFields(smartPlaylist.queryTree["fulltree"]) | limitFields(smartPlaylist)
+            for field in self.fields[persistentID]:
+                self.playlists[field].add(persistentID)
+
+    def affected(self, fields: Iterable[str]) -> Set[str]:
+        """Return the persistent IDs of the playlists that read any of the fields"""
+        result = set()
+        for field in fields:
+            if field in self.playlists:
+                result |= self.playlists[field]
+        return result
+
+
+def _topologicalOrder(graph, starts):
+    """Depth first search, dependencies come before the playlists that depend on them"""
+    order = []
+    state = {}  # 1: on the stack, 2: done
+    for start in starts:
+        if start in state:
+            continue
+        state[start] = 1
+        stack = [(start, iter(graph[start]))]
+        while stack:
+            node, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency not in graph:
+                    continue
+                if dependency not in state:
+                    state[dependency] = 1
+                    stack.append((dependency, iter(graph[dependency])))
+                    break
+                if state[dependency] == 1:
+                    cycle = [n for n, _ in stack]
+                    cycle = cycle[cycle.index(dependency):] + [dependency]
+                    raise PlaylistCycleException("Cycle in playlist dependencies", cycle)
+            else:
+                stack.pop()
+                state[node] = 2
+                order.append(node)
+    return order
+
+
+class LibraryEvaluator:
+    """Evaluate the playlists of a library. Smart playlists may depend on other playlists and folders,
+    so the playlists are evaluated in topological order and each membership is computed once."""
+
+    def __init__(self, library: Library, tracks: List[dict] = None, now: float = None):
+        """ Parse all smart playlists and build the dependency graph
+        :param Library library: the result of readiTunesLibrary()
+        :param tracks: Optional, the track records, default is createTrackRecords(library)
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        """
+        self.tracks = createTrackRecords(library) if tracks is None else list(tracks)
+        self.now = time.time() if now is None else now
+        self.root, self.playlistByPersistentId = createPlaylistTree(library)
+        self.smartPlaylists = {}  # Map PlaylistPersistentId to SmartPlaylist
+        self.children = {}  # Map PlaylistPersistentId of folders to the PlaylistPersistentIds of the children
+        self.dependencies = {}  # Map PlaylistPersistentId to the PlaylistPersistentIds it depends on
+
+        stack = list(self.root.children)
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children)
+            if node.children and 'Playlist Persistent ID' in node.data:
+                self.children[node.data['Playlist Persistent ID']] = [child.data['Playlist Persistent ID'] for child in node.children]
+
+        parser = SmartPlaylistParser()
+        for persistentID, playlist in self.playlistByPersistentId.items():
+            if persistentID in self.children:
+                self.dependencies[persistentID] = self.children[persistentID]
+                continue
+            if 'Smart Info' in playlist and 'Smart Criteria' in playlist and playlist['Smart Criteria']:
+                try:
+                    parser.data(playlist['Smart Info'], playlist['Smart Criteria'])
+                    parser.parse()
+                    self.smartPlaylists[persistentID] = parser.result()
+                except Exception as e:
+                    logging.warning("# Failed to decode playlist %s: %s" % (persistentID, str(e)))
+            if persistentID in self.smartPlaylists:
+                self.dependencies[persistentID] = sorted(playlistDependencies(self.smartPlaylists[persistentID].queryTree["fulltree"]))
+            else:
+                self.dependencies[persistentID] = []
+
+        self.fieldIndex = FieldDependencyIndex(self.smartPlaylists)
+        self.dependents = defaultdict(set)  # Map PlaylistPersistentId to the PlaylistPersistentIds that depend on it
+        for persistentID, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                self.dependents[dependency].add(persistentID)
+
+        self._positions = {t["TrackID"]: i for i, t in enumerate(self.tracks)}
+        self._members = {}  # Map PlaylistPersistentId to frozenset of TrackIDs
+        self._items = {}  # Map PlaylistPersistentId to list of TrackIDs
+        self.statistics = LibraryStatistics(self.tracks, self.now, self._members)
+        self.schedule = DateSchedule(self.tracks)
+        self._validUntil = {}  # Map PlaylistPersistentId to the first instant at which the items can change
+
+    def order(self, persistentIDs: Iterable[str] = None) -> List[str]:
+        """ Return the playlists in evaluation order. Raises PlaylistCycleException if the playlists depend on each other.
+        :param persistentIDs: Optional, only these playlists and their dependencies, default is all playlists
+        :return: list of playlist persistent IDs
+        :rtype: list
+        """
+        return _topologicalOrder(self.dependencies, self.dependencies if persistentIDs is None else persistentIDs)
+
+    def ruleOrder(self, persistentID: str) -> dict:
+        """ Return the rules of a smart playlist in the order in which they are evaluated
+        :param str persistentID: the playlist persistent ID
+        :return: the optimized and reordered fulltree
+        :rtype: dict
+        """
+        if persistentID not in self.smartPlaylists:
+            raise EvaluationException("Not a smart playlist", persistentID)
+        return self.statistics.reorder(optimizeRules(self.smartPlaylists[persistentID].queryTree["fulltree"]))
+
+    def members(self, persistentID: str) -> FrozenSet[int]:
+        """Return the TrackIDs of a playlist as a set"""
+        self._evaluate([persistentID])
+        return self._members[persistentID]
+
+    def evaluate(self, persistentID: str) -> List[int]:
+        """Return the TrackIDs of a playlist in playlist order"""
+        self._evaluate([persistentID])
+        return self._items[persistentID]
+
+    def validUntil(self, persistentID: str) -> float:
+        """ Return the first instant at which the items of a playlist can change because time passes, i.e. a rule like
+        `is in the last 7 days` of the playlist or of a playlist it depends on changes for a track. The items are valid until then.
+        :param str persistentID: the playlist persistent ID
+        :return: unix timestamp, math.inf if the items do not change with time
+        :rtype: float
+        """
+        self._evaluate([persistentID])
+        return self._validUntil[persistentID]
+
+    def refresh(self, now: float = None) -> Dict[str, Tuple[Set[int], Set[int]]]:
+        """ Move the evaluation to a new time. Only the playlists that expired (see validUntil()) and the playlists that depend on them are evaluated again.
+        :param float now: Optional, unix timestamp, default is the current time
+        :return: mapping from playlist persistent ID to (added TrackIDs, removed TrackIDs) for all playlists that changed
+        :rtype: dict
+        """
+        self._evaluate(self.dependencies)
+        self.now = time.time() if now is None else now
+        expired = {persistentID for persistentID, validUntil in self._validUntil.items() if validUntil <= self.now}
+        candidates = set(expired)
+        stack = list(expired)
+        while stack:
+            for dependent in self.dependents[stack.pop()]:
+                if dependent not in candidates:
+                    candidates.add(dependent)
+                    stack.append(dependent)
+
+        changes = {}
+        for persistentID in self.order(candidates):
+            old = self._members[persistentID]
+            self._items[persistentID] = self._playlistItems(persistentID)
+            self._members[persistentID] = members = frozenset(self._items[persistentID])
+            self._validUntil[persistentID] = self._nextChange(persistentID)
+            if members != old:
+                changes[persistentID] = (members - old, old - members)
+        return changes
+
+    def evaluateAll(self) -> Dict[str, List[int]]:
+        """Return a mapping from playlist persistent ID to TrackIDs for all playlists"""
+        self._evaluate(self.dependencies)
+        return dict(self._items)
+
+    def _evaluate(self, persistentIDs):
+        missing = [p for p in persistentIDs if p not in self._items]
+        if not missing:
+            return
+        unknown = [p for p in missing if p not in self.dependencies]
+        if unknown:
+            raise EvaluationException("Unknown playlist", unknown)
+        for persistentID in self.order(missing):
+            if persistentID not in self._items:
+                self._items[persistentID] = self._playlistItems(persistentID)
+                self._members[persistentID] = frozenset(self._items[persistentID])
+                self._validUntil[persistentID] = self._nextChange(persistentID)
+
+    def _nextChange(self, persistentID):
+        """All dependencies have been evaluated at this point"""
+        result = math.inf
+        if persistentID in self.smartPlaylists:
+            result = self.schedule.nextChange(optimizeRules(self.smartPlaylists[persistentID].queryTree["fulltree"]), self.now)
+        for dependency in self.dependencies[persistentID]:
+            result = min(result, self._validUntil.get(dependency, math.inf))
+        return result
+
+    def _playlistItems(self, persistentID):
+        """All dependencies have been evaluated at this point"""
+        if persistentID in self.children:
+            # Folder: union of the children
+            items = {}
+            for child in self.children[persistentID]:
+                items.update(dict.fromkeys(self._items[child]))
+            return list(items)
+
+        if persistentID in self.smartPlaylists:
+            smartPlaylist = self.smartPlaylists[persistentID]
+            predicate = compileSmartPlaylist(smartPlaylist, self.statistics)
+            now = self.now
+            playlists = self._members
+            matches = (t for t in self.tracks if predicate(t, now, playlists))
+            return [t["TrackID"] for t in selectTracks(smartPlaylist, matches)]
+
+        playlist = self.playlistByPersistentId[persistentID]
+        if playlist.get('Master'):
+            # The library playlist contains all tracks, including the tracks added by update()
+            return [t["TrackID"] for t in self.tracks]
+        if 'Playlist Items' in playlist:
+            return list(playlist['Playlist Items'])
+        return []
+
+    def update(self, tracks: Iterable[dict]) -> Dict[str, Tuple[Set[int], Set[int]]]:
+        """ Replace or add track records and patch the memberships of the affected playlists.
+        Only the playlists that read a changed field or depend on a changed playlist are re-evaluated and,
+        unless the playlist is limited, only for the changed tracks.
+        Removing tracks is not supported, create a new LibraryEvaluator instead.
+        :param tracks: new track records, see createTrackRecord()
+        :return: mapping from playlist persistent ID to (added TrackIDs, removed TrackIDs) for all playlists that changed
+        :rtype: dict
+        """
+        self._evaluate(self.dependencies)
+
+        changedFields = {}  # Map TrackID to the set of changed fields
+        newTrackIDs = set()
+        for record in tracks:
+            trackID = record["TrackID"]
+            if trackID in self._positions:
+                old = self.tracks[self._positions[trackID]]
+                fields = {key for key in record if record[key] != old.get(key)}
+                if not fields:
+                    continue
+                self.tracks[self._positions[trackID]] = record
+            else:
+                fields = set(record)
+                self._positions[trackID] = len(self.tracks)
+                self.tracks.append(record)
+                newTrackIDs.add(trackID)
+            changedFields[trackID] = fields
+
+        self.schedule.invalidate(set().union(*changedFields.values()))
+        affected = self.fieldIndex.affected(set().union(*changedFields.values()))
+        # New tracks are added to the library playlist
+        masters = {p for p in self.dependencies if p in self.playlistByPersistentId and self.playlistByPersistentId[p].get('Master')} if newTrackIDs else set()
+        affected |= masters
+        # Playlists that depend on an affected playlist may change too
+        candidates = set(affected)
+        stack = list(affected)
+        while stack:
+            for dependent in self.dependents[stack.pop()]:
+                if dependent not in candidates:
+                    candidates.add(dependent)
+                    stack.append(dependent)
+
+        changes = {}
+        changedMembers = {}  # Map PlaylistPersistentId to the TrackIDs with changed membership
+        for persistentID in self.order(candidates):
+            trackIDs = set()
+            if persistentID in masters:
+                trackIDs = set(newTrackIDs)
+            elif persistentID in affected:
+                fields = self.fieldIndex.fields[persistentID]
+                trackIDs = {trackID for trackID, changed in changedFields.items() if changed & fields}
+            for dependency in self.dependencies[persistentID]:
+                trackIDs |= changedMembers.get(dependency, set())
+            if not trackIDs:
+                continue
+
+            old = self._members[persistentID]
+            if persistentID in self.smartPlaylists and "number" not in self.smartPlaylists[persistentID].queryTree:
+                members = self._patchMembers(persistentID, trackIDs)
+                self._items[persistentID] = sorted(members, key=self._positions.__getitem__)
+            else:
+                self._items[persistentID] = self._playlistItems(persistentID)
+                members = frozenset(self._items[persistentID])
+            self._members[persistentID] = members
+
+            added = members - old
+            removed = old - members
+            if added or removed:
+                changes[persistentID] = (added, removed)
+                changedMembers[persistentID] = added | removed
+        # Changed dates move the next change of the playlists with relative date rules
+        for persistentID in self.order(candidates):
+            self._validUntil[persistentID] = self._nextChange(persistentID)
+        return changes
+
+    def _patchMembers(self, persistentID, trackIDs):
+        """Re-evaluate the rules of an unlimited smart playlist for some tracks"""
+        smartPlaylist = self.smartPlaylists[persistentID]
+        predicate = compileSmartPlaylist(smartPlaylist, self.statistics)
+        onlychecked = smartPlaylist.queryTree.get("onlychecked")
+        members = set(self._members[persistentID])
+        for trackID in trackIDs:
+            t = self.tracks[self._positions[trackID]]
+            if predicate(t, self.now, self._members) and (not onlychecked or t["Checked"]):
+                members.add(trackID)
+            else:
+                members.discard(trackID)
+        return frozenset(members)
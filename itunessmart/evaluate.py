@@ -0,0 +1,167 @@
+"""
+Module to evaluate the rules of a parser result against the tracks of a library
+"""
+
+import time
+import weakref
+import functools
+from typing import Callable, Iterable, List, Mapping
+
+from itunessmart.parse import SmartPlaylist
+from itunessmart.library import searchKey
+from itunessmart.optimize import optimizeRules
+from itunessmart.statistics import LibraryStatistics
+
+__all__ = ["compileSmartPlaylist", "evaluateSmartPlaylist", "predicateSource", "EvaluationException"]
+
+
+class EvaluationException(Exception):
+    pass
+
+
+# Python expressions for the rules. {column} is the field of the track record t, {value} the value of the rule.
+# String rules compare the precomputed search keys of the track with the normalized value of the rule
+_templates = {
+    "string": {
+        "like": "({value!r} in {column})",
+        "not like": "({value!r} not in {column})",
+        "is": "({column} == {value!r})",
+        "is not": "({column} != {value!r})",
+        "starts with": "{column}.startswith({value!r})",
+        "ends with": "{column}.endswith({value!r})"
+    },
+    "int": {
+        "is": "({column} == {value!r})",
+        "is not": "({column} != {value!r})",
+        "greater than": "({column} > {value!r})",
+        "less than": "({column} < {value!r})",
+        "between": "({value[0]!r} <= {column} <= {value[1]!r})"
+    },
+    "date": {
+        "is after": "({column} is not None and {column} > {value!r})",
+        "is before": "({column} is not None and {column} < {value!r})",
+        "is in the range": "({column} is not None and {value[0]!r} <= {column} <= {value[1]!r})",
+        "is not in the range": "({column} is None or not {value[0]!r} <= {column} <= {value[1]!r})",
+        "is in the last": "({column} is not None and now - {column} < {value!r})",
+        "is not in the last": "({column} is None or now - {column} > {value!r})"
+    },
+    "boolean": {
+        "is": "({column} == {value!r})"
+    },
+    "playlist": {
+        "is": "({column} in playlists.get({value!r}, ()))",
+        "is not": "({column} not in playlists.get({value!r}, ()))"
+    }
+}
+for _listtype in ("mediakind", "cloud", "love", "location"):
+    _templates[_listtype] = {
+        "is": "({column} == {value!r})",
+        "is not": "({column} != {value!r})"
+    }
+
+_columns = {
+    "string": "t['SearchKeys'][{field!r}]",
+    "playlist": "t['TrackID']"
+}
+
+_predicateByPlaylist = weakref.WeakKeyDictionary()
+
+
+def predicateSource(smartPlaylist: SmartPlaylist, statistics: LibraryStatistics = None) -> str:
+    """ Create the Python source code of the predicate function for the optimized rules of a playlist
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param LibraryStatistics statistics: Optional, reorder the rules by the estimated selectivity and cost
+    :return: source code of the function `predicate(t, now, playlists)`
+    :rtype: str
+    """
+    fulltree = optimizeRules(smartPlaylist.queryTree["fulltree"])
+    if statistics is not None:
+        fulltree = statistics.reorder(fulltree)
+    return _treeSource(fulltree)
+
+
+def compileSmartPlaylist(smartPlaylist: SmartPlaylist, statistics: LibraryStatistics = None) -> Callable[[dict, float, Mapping], bool]:
+    """ Compile the rules of a playlist to a predicate function. The function is memoized per playlist (and statistics).
+    The predicate is called with a track record (see createTrackRecord()), the current unix timestamp and
+    a mapping from playlist persistent ID to a set of TrackIDs: predicate(track, now, playlists)
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param LibraryStatistics statistics: Optional, reorder the rules by the estimated selectivity and cost
+    :return: predicate function
+    :rtype: function
+    """
+    predicates = _predicateByPlaylist if statistics is None else statistics._predicates
+    try:
+        return predicates[smartPlaylist]
+    except KeyError:
+        pass
+    predicate = _compileSource(predicateSource(smartPlaylist, statistics))
+    predicates[smartPlaylist] = predicate
+    return predicate
+
+
+def evaluateSmartPlaylist(smartPlaylist: SmartPlaylist, tracks: Iterable[dict], now: float = None, playlists: Mapping = None, statistics: LibraryStatistics = None) -> List[int]:
+    """ Return the TrackIDs of all tracks that match the rules of the playlist. The limit of the playlist is not applied.
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param tracks: the track records, see createTrackRecords()
+    :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+    :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+    :param LibraryStatistics statistics: Optional, reorder the rules by the estimated selectivity and cost
+    :return: list of TrackIDs
+    :rtype: list
+    """
+    predicate = compileSmartPlaylist(smartPlaylist, statistics)
+    if now is None:
+        now = time.time()
+    if playlists is None:
+        playlists = {}
+    return [track["TrackID"] for track in tracks if predicate(track, now, playlists)]
+
+
+@functools.lru_cache(maxsize=1024)
+def _compileSource(source):
+    namespace = {}
+    exec(compile(source, "<smartplaylist>", "exec"), namespace)
+    return namespace["predicate"]
+
+
+def _treeSource(fulltree):
+    expression = _ruleSource(fulltree) if fulltree else "True"
+    return "def predicate(t, now, playlists):\n    return %s\n" % expression
+
+
+def _ruleSource(obj):
+    """Create a Python expression for a rule or a group of rules"""
+    if "and" in obj or "or" in obj:
+        operator = "and" if "and" in obj else "or"
+        expressions = [_ruleSource(x) for x in obj[operator]]
+        if not expressions:
+            return "True" if operator == "and" else "False"
+        return "(%s)" % (" %s " % operator).join(expressions)
+
+    ruletype = obj.get("type")
+    if ruletype == "string" and obj["field"] == "Kind":
+        return _kindSource(obj)
+
+    try:
+        template = _templates[ruletype][obj["operator"]]
+    except KeyError:
+        raise EvaluationException("Unsupported rule", obj)
+
+    column = _columns.get(ruletype, "t[{field!r}]").format(field=obj["field"])
+    value = obj["value"]
+    if ruletype == "string":
+        value = searchKey(value)
+    elif isinstance(value, list):
+        value = tuple(value)
+    return template.format(column=column, value=value)
+
+
+def _kindSource(obj):
+    """The parser converts Kind rules to rules on the file extension"""
+    negative = obj.get("operator") in ("not like", "is not")
+    if "kind_value" not in obj:
+        return "True" if negative else "False"
+    expression = "t['SearchKeys']['Uri'].endswith(%r)" % obj["kind_value"]
+    if obj["kind_operator"] == "not like":
+        return "(not %s)" % expression
+    return expression
@@ -0,0 +1,215 @@
+"""
+Module to explain how the rules of a smart playlist are evaluated
+"""
+
+import time
+from typing import Iterable, Mapping
+
+from itunessmart.parse import SmartPlaylist, SmartPlaylistParser
+from itunessmart.evaluate import _compileSource, _treeSource
+from itunessmart.optimize import optimizeRules
+from itunessmart.statistics import LibraryStatistics
+from itunessmart.index import TrackIndex
+from itunessmart.selection import selectTracks
+
+__all__ = ["explainSmartPlaylist"]
+
+_stringOutput = {
+    "like": "contains",
+    "not like": "does not contain",
+    "is": "is",
+    "is not": "is not",
+    "starts with": "starts with",
+    "ends with": "ends with"
+}
+
+_intOutput = {
+    "is": "is",
+    "is not": "is not",
+    "greater than": "is greater than",
+    "less than": "is less than"
+}
+
+
+def _dateString(value):
+    return SmartPlaylistParser._dateString(value)
+
+
+def _ruleOutput(obj):
+    """Describe a rule like the output of the parser"""
+    field = obj.get("field")
+    ruletype = obj.get("type")
+    operator = obj.get("operator")
+    value = obj.get("value")
+    if ruletype == "string" and field == "Kind":
+        if "kind_value" not in obj:
+            return "Kind %s (no file kind)" % _stringOutput.get(operator, operator)
+        return "Kind: file extension %s \"%s\"" % ("is" if obj["kind_operator"] == "like" else "is not", obj["kind_value"])
+    if ruletype == "string":
+        return "%s %s \"%s\"" % (field, _stringOutput.get(operator, operator), value)
+    if ruletype == "int":
+        if operator == "between":
+            return "%s is in the range of %d to %d" % (field, value[0], value[1])
+        if operator == "not between":
+            return "%s is not in the range of %d to %d" % (field, value[0], value[1])
+        return "%s %s %d" % (field, _intOutput.get(operator, operator), value)
+    if ruletype == "date":
+        if operator in ("is in the range", "is not in the range"):
+            return "%s %s of %s to %s" % (field, operator, _dateString(value[0]), _dateString(value[1]))
+        if operator in ("is in the last", "is not in the last"):
+            return "%s %s %s" % (field, operator, obj.get("value_date", "%d seconds" % value))
+        return "%s %s %s" % (field, operator, _dateString(value))
+    if ruletype == "boolean":
+        return "%s %s %s" % (field, operator, "True" if value else "False")
+    return "%s %s %s" % (field, operator, value)
+
+
+class _PlanNode:
+    """A rule or a group of the plan with the estimates and the measurements"""
+
+    def __init__(self, obj, depth, estimatedInput, estimated):
+        self.obj = obj
+        self.depth = depth
+        self.estimatedInput = estimatedInput
+        self.estimated = estimated
+        self.children = []
+        self.path = ""
+        self.inputRows = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+
+class _Execution:
+    def __init__(self, tracks, now, playlists, statistics, index):
+        self.tracks = tracks
+        self.now = now
+        self.playlists = playlists
+        self.statistics = statistics
+        self.index = index
+
+    def run(self, obj, positions, depth, estimatedInput):
+        """Evaluate obj for the track positions, return the plan node and the matching positions in track order"""
+        selectivity, cost = self.statistics.estimate(obj)
+        node = _PlanNode(obj, depth, estimatedInput, estimatedInput * selectivity)
+        node.inputRows = len(positions)
+
+        if "and" in obj or "or" in obj:
+            operator = "and" if "and" in obj else "or"
+            node.path = "all" if operator == "and" else "any"
+            start = time.perf_counter()
+            remaining = positions
+            estimated = estimatedInput
+            matched = set()
+            for x in obj[operator]:
+                child, result = self.run(x, remaining, depth + 1, estimated)
+                node.children.append(child)
+                childSelectivity = child.estimated / estimated if estimated else 0.0
+                if operator == "and":
+                    remaining = result
+                    estimated *= childSelectivity
+                else:
+                    matched.update(result)
+                    remaining = [p for p in remaining if p not in matched]
+                    estimated *= 1.0 - childSelectivity
+            if operator == "and":
+                result = remaining if obj["and"] else positions
+            else:
+                result = [p for p in positions if p in matched]
+            node.seconds = time.perf_counter() - start
+            node.rows = len(result)
+            return node, result
+
+        predicate = _compileSource(_treeSource(obj))
+        now = self.now
+        playlists = self.playlists
+        tracks = self.tracks
+        # An index lookup returns the matches of all tracks, a scan tests the remaining tracks
+        useIndex = self.index is not None and self.index.supports(obj) and selectivity * len(tracks) < len(positions) * cost
+        start = time.perf_counter()
+        if useIndex:
+            node.path = "index"
+            candidates = self.index.candidates(obj, now)
+            if len(positions) != len(tracks):
+                candidates = candidates.intersection(positions)
+            # Verify the candidates, relative dates are looked up with inclusive bounds
+            result = [p for p in sorted(candidates) if predicate(tracks[p], now, playlists)]
+        else:
+            node.path = "scan"
+            result = [p for p in positions if predicate(tracks[p], now, playlists)]
+        node.seconds = time.perf_counter() - start
+        node.rows = len(result)
+        return node, result
+
+
+def _annotation(node):
+    return "%s: estimated %d rows, actual %d of %d rows, %.2f ms" % (node.path, round(node.estimated), node.rows, node.inputRows, node.seconds * 1000)
+
+
+def _render(node, conjunction, lines):
+    """Add (text, annotation) lines with the indentation of the output of the parser"""
+    indent = "\t" * node.depth
+    if node.children:
+        operator = "and" if "and" in node.obj else "or"
+        lines.append((indent + "[", _annotation(node)))
+        for i, child in enumerate(node.children):
+            _render(child, " " + operator if i < len(node.children) - 1 else "", lines)
+        lines.append((indent + "]" + conjunction, ""))
+    elif "and" in node.obj or "or" in node.obj:
+        lines.append((indent + ("[all tracks]" if "and" in node.obj else "[no tracks]") + conjunction, _annotation(node)))
+    else:
+        lines.append((indent + _ruleOutput(node.obj) + conjunction, _annotation(node)))
+
+
+def explainSmartPlaylist(smartPlaylist: SmartPlaylist, tracks: Iterable[dict], now: float = None, playlists: Mapping = None, statistics: LibraryStatistics = None, index: TrackIndex = None) -> str:
+    """ Evaluate the playlist and describe the plan: the optimized rules in the order of evaluation, the access path of each rule,
+    the estimated and the actual number of tracks and the time of each rule and group, indented like the output of the parser
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param tracks: the track records, see createTrackRecords()
+    :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+    :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+    :param LibraryStatistics statistics: Optional, statistics of the tracks, default is new statistics
+    :param TrackIndex index: Optional, indexes of the same tracks. Without indexes every rule is a scan
+    :return: the plan
+    :rtype: str
+    """
+    tracks = index.tracks if index is not None else list(tracks)
+    if now is None:
+        now = time.time()
+    if playlists is None:
+        playlists = {}
+    if statistics is None:
+        statistics = LibraryStatistics(tracks, now, playlists)
+
+    fulltree = optimizeRules(smartPlaylist.queryTree["fulltree"])
+    execution = _Execution(tracks, now, playlists, statistics, index)
+    start = time.perf_counter()
+    lines = []
+    if fulltree:
+        fulltree = statistics.reorder(fulltree)
+        # The rules of the top level group are not indented
+        root, positions = execution.run(fulltree, list(range(len(tracks))), -1, len(tracks))
+        operator = "and" if "and" in fulltree else "or"
+        for i, child in enumerate(root.children):
+            _render(child, " " + operator if i < len(root.children) - 1 else "", lines)
+        header = "Plan, match " + _annotation(root)
+    else:
+        positions = list(range(len(tracks)))
+        header = "Plan, no rules: %d rows" % len(positions)
+
+    limitStart = time.perf_counter()
+    selected = selectTracks(smartPlaylist, (tracks[p] for p in positions))
+    limitSeconds = time.perf_counter() - limitStart
+    limitLines = [line for line in smartPlaylist.output.split("\n") if line.startswith("Limited to ") or line == "Exclude unchecked items"]
+    if limitLines:
+        lines.append((limitLines[0], "limit: actual %d of %d rows, %.2f ms" % (len(selected), len(positions), limitSeconds * 1000)))
+        lines.extend((line, "") for line in limitLines[1:])
+    seconds = time.perf_counter() - start
+
+    width = max([len(text.expandtabs()) for text, _ in lines] + [0])
+    result = [header]
+    for text, annotation in lines:
+        if annotation:
+            text += " " * (width - len(text.expandtabs()) + 4) + "-- " + annotation
+        result.append(text)
+    result.append("Total: %d tracks in %.2f ms" % (len(selected), seconds * 1000))
+    return "\n".join(result)
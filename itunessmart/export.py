@@ -0,0 +1,340 @@
+"""
+Module to export many smart playlists to XSP files in worker processes
+"""
+
+import io
+import os
+import json
+import hashlib
+import logging
+import traceback
+import contextlib
+import multiprocessing
+from typing import Callable, Iterable, List
+
+from itunessmart._version import __version__
+from itunessmart.parse import SmartPlaylistParser
+from itunessmart.output import FileWriterPool, atomicWrite
+from itunessmart.xsp import writeXSP, SubPlaylistRegistry, PlaylistException, EmptyPlaylistException, _friendlyFilename
+from itunessmart.dependency import playlistDependencies
+
+__all__ = ["ExportResult", "ExportReport", "exportXSPFiles"]
+
+manifestFilename = ".itunessmart_manifest.json"
+
+
+class ExportResult:
+    """Outcome of the export of one playlist"""
+
+    def __init__(self, name: str):
+        """ Create an empty result
+        :param str name: the name of the playlist
+        """
+        self.name = name
+        self.filenames = []
+        self.subPlaylists = []  # Filenames of the sub playlists, they are included in filenames
+        self.subPlaylistsRendered = 0  # Number of sub playlists that were not created before for another playlist
+        self.error = None  # None, "decode", "empty", "skipped" or "failed"
+        self.message = ""
+        self.traceback = ""
+        self.references = {}  # Map persistent ID of a referenced playlist to the name that was used, None if the playlist is unknown
+        self.unchanged = False  # True if the playlist was not converted, because the manifest shows that the files are up to date
+
+    def __repr__(self):
+        if self.error:
+            return "ExportResult(%r, error=%r)" % (self.name, self.error)
+        return "ExportResult(%r, filenames=%r)" % (self.name, self.filenames)
+
+
+class ExportReport:
+    """Outcome of the export of all playlists"""
+
+    def __init__(self, results: List[ExportResult]):
+        """ Create the report
+        :param results: the ExportResult of each playlist
+        """
+        self.results = results
+        self.files = []  # Filenames of all files of the playlists
+        self.written = []  # Filenames of the files that were written
+        self.removed = []  # Filenames of the stale files that were removed
+
+    @property
+    def converted(self) -> int:
+        """Number of playlists without error"""
+        return sum(1 for result in self.results if not result.error)
+
+    @property
+    def unchanged(self) -> int:
+        """Number of playlists that were not converted again"""
+        return sum(1 for result in self.results if result.unchanged)
+
+    @property
+    def subPlaylistReferences(self) -> int:
+        """Number of sub playlists of all playlists, a sub playlist that is shared by several playlists is counted for each playlist"""
+        return sum(len(result.subPlaylists) for result in self.results)
+
+    @property
+    def subPlaylists(self) -> int:
+        """Number of distinct sub playlists"""
+        return len(set(filename for result in self.results for filename in result.subPlaylists))
+
+    @property
+    def subPlaylistsRendered(self) -> int:
+        """Number of sub playlists that were created, at most once per worker process for each distinct sub playlist"""
+        return sum(result.subPlaylistsRendered for result in self.results)
+
+    def __str__(self):
+        s = "Converted %d playlists to %d files: %d playlists unchanged, %d files written, %d stale files removed" % (self.converted, len(self.files), self.unchanged, len(self.written), len(self.removed))
+        references = self.subPlaylistReferences
+        if references:
+            s += "; %d distinct sub-playlists for %d references, %d created, %d saved" % (self.subPlaylists, references, self.subPlaylistsRendered, references - self.subPlaylistsRendered)
+        return s
+
+    def __repr__(self):
+        return "ExportReport(playlists=%d, files=%d, written=%d, removed=%d)" % (len(self.results), len(self.files), len(self.written), len(self.removed))
+
+
+def _smartPlaylists(playlists):
+    """The playlists with smart criteria, as (key, name, info, criteria). The key is the persistent ID or the name"""
+    for playlist in playlists:
+        if 'Name' in playlist and 'Smart Criteria' in playlist and 'Smart Info' in playlist and playlist['Smart Criteria']:
+            yield playlist.get('Playlist Persistent ID', playlist['Name']), playlist['Name'], playlist['Smart Info'], playlist['Smart Criteria']
+
+
+def _sourceHash(name, info, criteria):
+    h = hashlib.sha1(name.encode("utf-8"))
+    for data in (info, criteria):
+        h.update(b"\0")
+        h.update(data)
+    return h.hexdigest()
+
+
+def _contentHash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _readManifest(filepath, settings):
+    """Return the manifest of the last export, or an empty manifest if there is none or it was created with other settings"""
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("settings") == settings:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"settings": settings, "playlists": {}, "files": {}}
+
+
+def _diskHash(directory, filename, cache):
+    """Return the content hash of a file in the output directory, or None if it does not exist"""
+    if filename not in cache:
+        try:
+            with open(os.path.join(directory, filename), "rb") as f:
+                cache[filename] = _contentHash(f.read())
+        except OSError:
+            cache[filename] = None
+    return cache[filename]
+
+
+def _isUnchanged(entry, source, persistentIDMapping, files, directory, diskHashes):
+    """True if the source, the names of the referenced playlists and the files of a playlist are the same as in the manifest and on disk"""
+    if entry is None or entry["source"] != source:
+        return False
+    if any(persistentIDMapping.get(persistentID) != name for persistentID, name in entry["references"].items()):
+        return False
+    # The files must still hold the content of this playlist, not of another playlist with the same filename or an edit by hand
+    return all(files.get(filename) == h and _diskHash(directory, filename, diskHashes) == h for filename, h in entry["files"].items())
+
+
+_worker = {}  # State of a worker process: settings, the sub playlists and their encoded documents
+
+
+def _initWorker(createSubplaylists, persistentIDMapping, friendlyFilename):
+    _worker["createSubplaylists"] = createSubplaylists
+    _worker["persistentIDMapping"] = persistentIDMapping
+    _worker["friendlyFilename"] = friendlyFilename
+    _worker["subPlaylists"] = SubPlaylistRegistry()
+    _worker["subDocuments"] = {}  # Map document of a sub playlist to (filename, content hash)
+
+
+def _renderPlaylist(item):
+    """Parse and convert one playlist, return the ExportResult and a list of (filename, content hash, encoded content).
+    The encoded content of a sub playlist is only returned by the first playlist of the worker that uses it, then it is None"""
+    name, info, criteria = item
+    result = ExportResult(name)
+    parser = SmartPlaylistParser()
+    try:
+        parser.data(info, criteria)
+        parser.parse()
+        smartPlaylist = parser.result()
+    except Exception:
+        result.error = "decode"
+        result.traceback = traceback.format_exc()
+        return result, []
+
+    persistentIDMapping = _worker["persistentIDMapping"]
+    result.references = {persistentID: persistentIDMapping.get(persistentID) for persistentID in sorted(playlistDependencies(smartPlaylist.queryTree["fulltree"]))}
+    friendlyFilename = _worker["friendlyFilename"]
+    subDocuments = _worker["subDocuments"]
+    documents = []
+    sink = io.BytesIO()
+    try:
+        subdocuments = writeXSP(sink, name=name, smartPlaylist=smartPlaylist, createSubplaylists=_worker["createSubplaylists"], persistentIDMapping=persistentIDMapping, subPlaylists=_worker["subPlaylists"])
+    except EmptyPlaylistException as e:
+        result.error = "empty"
+        result.message = str(e)
+        return result, []
+    except PlaylistException as e:
+        result.error = "skipped"
+        result.message = str(e)
+        return result, []
+    except Exception as e:
+        result.error = "failed"
+        result.message = str(e)
+        result.traceback = traceback.format_exc()
+        return result, []
+
+    for playlistname, content in subdocuments:
+        if content in subDocuments:
+            filename, h = subDocuments[content]
+            documents.append((filename, h, None))
+        else:
+            data = content.encode("utf-8")
+            filename, h = subDocuments[content] = friendlyFilename(playlistname) + ".xsp", _contentHash(data)
+            documents.append((filename, h, data))
+            result.subPlaylistsRendered += 1
+        result.subPlaylists.append(filename)
+    data = sink.getvalue()
+    documents.append((friendlyFilename(name) + ".xsp", _contentHash(data), data))
+
+    result.filenames = [filename for filename, _, _ in documents]
+    return result, documents
+
+
+def exportXSPFiles(playlists: Iterable[dict], directory: str, createSubplaylists: bool = True, persistentIDMapping: dict = None, friendlyFilename: Callable[[str], str] = None, processes: int = None, incremental: bool = False, removeStale: bool = False, writers: int = 4) -> ExportReport:
+    """ Convert the smart playlists of a library to XSP files, see createXSPFile(). The playlists are parsed and converted in worker processes
+    and the files are written atomically by a pool of threads while the next playlists are converted. The files are the same as when
+    the playlists are converted one after another in the order of the library: if two playlists have the same filename, the file of the
+    later playlist is written.
+    With incremental=True, a manifest in the output directory records a hash of the source data of each playlist, the names of the playlists
+    it references and a hash of each file. On the next export, playlists with the same hashes are not converted again and only files with
+    a new content are written. The files are compared with the disk, so a file that was edited or deleted is written again.
+    :param playlists: the playlists of the library, library['Playlists'], playlists without smart criteria are left out
+    :param str directory: the output directory
+    :param bool createSubplaylists: if true subplaylists are created for nested rules/query, if false nestes rules are ommited
+    :param persistentIDMapping: Optional, necessary for rules containing other playlists
+    :param function friendlyFilename: Optional, function to create a filename from the playlist name, it is sent to the worker processes and has to be picklable
+    :param int processes: Optional, number of worker processes, default is the number of CPUs, 1 converts the playlists in this process
+    :param bool incremental: Optional, read and update the manifest and skip unchanged playlists and files
+    :param bool removeStale: Optional, with incremental=True, remove the files of the last export that no playlist creates anymore, files that were edited are kept
+    :param int writers: Optional, number of threads that write the files, see FileWriterPool
+    :return: the report with an ExportResult for each playlist in the order of the playlists
+    :rtype: ExportReport
+    """
+    if persistentIDMapping is None:
+        persistentIDMapping = {}
+    if friendlyFilename is None:
+        friendlyFilename = _friendlyFilename
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    items = list(_smartPlaylists(playlists))
+    sources = [_sourceHash(name, info, criteria) for _, name, info, criteria in items]
+
+    # The output depends on the settings, a manifest with other settings is not used
+    settings = {"version": __version__, "createSubplaylists": createSubplaylists,
+                "friendlyFilename": "%s.%s" % (getattr(friendlyFilename, "__module__", ""), getattr(friendlyFilename, "__qualname__", ""))}
+    manifestPath = os.path.join(directory, manifestFilename)
+    manifest = _readManifest(manifestPath, settings) if incremental else {"settings": settings, "playlists": {}, "files": {}}
+    oldFiles = manifest["files"]
+    diskHashes = {}  # Map filename to the content hash of the file on disk
+
+    rendered = [None] * len(items)
+    todo = []
+    for i, (key, name, _, _) in enumerate(items):
+        entry = manifest["playlists"].get(key)
+        if _isUnchanged(entry, sources[i], persistentIDMapping, oldFiles, directory, diskHashes):
+            result = ExportResult(name)
+            result.filenames = list(entry["files"])
+            result.subPlaylists = entry.get("subPlaylists", [])
+            result.error = entry["error"]
+            result.message = entry["message"]
+            result.traceback = entry["traceback"]
+            result.references = entry["references"]
+            result.unchanged = True
+            rendered[i] = (result, None)
+        else:
+            todo.append(i)
+
+    # An unchanged playlist keeps its files, unless a later playlist creates a file with the same name
+    owners = {}  # Map filename to the position of the last unchanged playlist with the file
+    for i, r in enumerate(rendered):
+        if r is not None:
+            for filename in r[0].filenames:
+                owners[filename] = i
+
+    files = {}  # Map filename to content hash
+    contents = {}  # Map content hash to encoded content, shared sub playlists are only sent once per worker process
+    written = {}  # Map filename to the content hash that was written
+    playlistEntries = {}
+    workerSettings = (createSubplaylists, persistentIDMapping, friendlyFilename)
+    with contextlib.ExitStack() as stack:
+        if processes > 1 and len(todo) > 1:
+            # Several chunks per process, so a process with cheap playlists takes over more work
+            size = max(1, len(todo) // (processes * 4))
+            pool = stack.enter_context(multiprocessing.Pool(processes, _initWorker, workerSettings))
+            renderedTodo = pool.imap(_renderPlaylist, [items[i][1:] for i in todo], size)
+        else:
+            _initWorker(*workerSettings)
+            renderedTodo = map(_renderPlaylist, [items[i][1:] for i in todo])
+        # The files are written while the next playlists are converted
+        writer = stack.enter_context(FileWriterPool(writers))
+
+        for i, ((key, _, _, _), source) in enumerate(zip(items, sources)):
+            if rendered[i] is None:
+                rendered[i] = next(renderedTodo)
+                result, documents = rendered[i]
+                fileHashes = {}
+                for filename, h, data in documents:
+                    fileHashes[filename] = h
+                    if data is None:
+                        data = contents[h]
+                    else:
+                        contents[h] = data
+                    if owners.get(filename, -1) > i:
+                        continue
+                    filepath = os.path.join(directory, filename)
+                    if filename in written:
+                        if written[filename] == h:
+                            continue
+                    elif oldFiles.get(filename) == h and _diskHash(directory, filename, diskHashes) == h:
+                        continue
+                    # Later playlists overwrite the files of earlier playlists with the same filename
+                    writer.write(filepath, data)
+                    written[filename] = h
+                    logging.info(filename)
+            else:
+                result = rendered[i][0]
+                fileHashes = manifest["playlists"][key]["files"]
+            files.update(fileHashes)
+            playlistEntries[key] = {"source": source, "references": result.references, "files": fileHashes, "subPlaylists": result.subPlaylists,
+                                    "error": result.error, "message": result.message, "traceback": result.traceback}
+
+    report = ExportReport([result for result, _ in rendered])
+    report.files = list(files)
+    report.written = list(written)
+
+    if incremental:
+        if removeStale:
+            for filename, h in oldFiles.items():
+                if filename not in files and _diskHash(directory, filename, diskHashes) == h:
+                    os.remove(os.path.join(directory, filename))
+                    report.removed.append(filename)
+        newManifest = {"settings": settings, "playlists": playlistEntries, "files": files}
+        if not removeStale:
+            # Files that are not removed are still recorded, so they can be removed by a later export
+            newManifest["files"] = dict({filename: h for filename, h in oldFiles.items() if filename not in files}, **newManifest["files"])
+        if newManifest != manifest:
+            atomicWrite(manifestPath, json.dumps(newManifest, indent=1).encode("utf-8"))
+
+    return report
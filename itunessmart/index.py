@@ -0,0 +1,285 @@
+"""
+Module to narrow down the tracks that can match the rules of a smart playlist with indexes
+"""
+
+import time
+import bisect
+from collections import defaultdict
+from typing import Iterable, List, Mapping, Optional, Set
+
+from itunessmart.data_structure import StringFields, IntFields, DateFields
+from itunessmart.parse import SmartPlaylist
+from itunessmart.library import searchKey
+from itunessmart.evaluate import compileSmartPlaylist
+from itunessmart.optimize import optimizeRules
+
+__all__ = ["StringIndex", "RangeIndex", "TrackIndex"]
+
+_stringTests = {
+    "like": lambda s, value: value in s,
+    "is": lambda s, value: s == value,
+    "starts with": lambda s, value: s.startswith(value),
+    "ends with": lambda s, value: s.endswith(value)
+}
+
+_negations = {
+    "not like": "like",
+    "is not": "is"
+}
+
+
+def _trigrams(s):
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class StringIndex:
+    """Index of a string field. The distinct search keys are indexed by their trigrams and kept in sorted order,
+    so `like` and `ends with` rules only verify the values that contain all trigrams of the rule value,
+    `starts with` rules are a range of the sorted values and `is` rules are a dictionary lookup."""
+
+    def __init__(self, values: List[str]):
+        """ Create the index
+        :param values: the search key of the field for each track position, see searchKey()
+        """
+        positions = {}
+        for position, value in enumerate(values):
+            positions.setdefault(value, []).append(position)
+        self.values = list(positions)  # Distinct values
+        self.positions = list(positions.values())  # Track positions of each distinct value
+        self._valueIds = {value: i for i, value in enumerate(self.values)}
+        self._sortedIds = sorted(range(len(self.values)), key=self.values.__getitem__)
+        self._sortedValues = [self.values[i] for i in self._sortedIds]
+        self._trigrams = defaultdict(list)  # Map trigram to the ids of the values containing it
+        for i, value in enumerate(self.values):
+            for trigram in _trigrams(value):
+                self._trigrams[trigram].append(i)
+
+    def valueIds(self, operator: str, value: str) -> Set[int]:
+        """ Return the ids of the distinct values that match the rule
+        :param str operator: like, not like, is, is not, starts with or ends with
+        :param str value: the normalized value of the rule
+        :return: set of indexes into self.values
+        :rtype: set
+        """
+        if operator in _negations:
+            return set(range(len(self.values))) - self.valueIds(_negations[operator], value)
+
+        if operator == "is":
+            return {self._valueIds[value]} if value in self._valueIds else set()
+
+        if operator == "starts with":
+            start = bisect.bisect_left(self._sortedValues, value)
+            end = start
+            while end < len(self._sortedValues) and self._sortedValues[end].startswith(value):
+                end += 1
+            return set(self._sortedIds[start:end])
+
+        test = _stringTests[operator]
+        trigrams = _trigrams(value)
+        if not trigrams:
+            # Short values have no trigrams, test all distinct values
+            candidates = range(len(self.values))
+        elif any(trigram not in self._trigrams for trigram in trigrams):
+            return set()
+        else:
+            postings = sorted((self._trigrams[trigram] for trigram in trigrams), key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    break
+        return {i for i in candidates if test(self.values[i], value)}
+
+    def lookup(self, operator: str, value: str) -> Set[int]:
+        """ Return the track positions that match the rule, see valueIds()
+        :return: set of track positions
+        :rtype: set
+        """
+        result = set()
+        for i in self.valueIds(operator, value):
+            result.update(self.positions[i])
+        return result
+
+
+class RangeIndex:
+    """Index of a numeric or date field. The values are sorted, so a range of values is a range of the sorted array
+    that is found with bisect. Missing dates are kept apart, they do not match any range."""
+
+    def __init__(self, values: List[Optional[float]]):
+        """ Create the index
+        :param values: the value of the field for each track position, None for missing dates
+        """
+        pairs = sorted((value, position) for position, value in enumerate(values) if value is not None)
+        self.keys = [value for value, _ in pairs]
+        self.positions = [position for _, position in pairs]
+        self.missing = {position for position, value in enumerate(values) if value is None}
+
+    def range(self, low: float = None, high: float = None, includeLow: bool = True, includeHigh: bool = True) -> range:
+        """ Return the range of the sorted arrays with values between low and high
+        :param low: Optional, lower bound, default is no lower bound
+        :param high: Optional, upper bound, default is no upper bound
+        :return: range of indexes into self.keys and self.positions
+        :rtype: range
+        """
+        start = 0 if low is None else (bisect.bisect_left if includeLow else bisect.bisect_right)(self.keys, low)
+        end = len(self.keys) if high is None else (bisect.bisect_right if includeHigh else bisect.bisect_left)(self.keys, high)
+        return range(start, max(start, end))
+
+    def lookup(self, operator: str, value, now: float = None) -> Set[int]:
+        """ Return the track positions that match the rule. Relative dates are compared with now, the result may contain tracks on the boundary
+        :param str operator: an int or date operator of the parser
+        :param value: the value of the rule
+        :param float now: Optional, unix timestamp for "in the last" rules
+        :return: set of track positions
+        :rtype: set
+        """
+        r = self.range(*_ranges[operator](value, now))
+        result = set(self.positions[r.start:r.stop])
+        if operator in _complements:
+            result = set(self.positions) - result
+        if operator in _missingMatches:
+            result |= self.missing
+        return result
+
+
+# Range (low, high, includeLow, includeHigh) of the values that match the rule or, for _complements, do not match.
+# The bounds of relative dates are inclusive, because now - value may be rounded
+_ranges = {
+    "greater than": lambda value, now: (value, None, False),
+    "less than": lambda value, now: (None, value, True, False),
+    "between": lambda value, now: (value[0], value[1]),
+    "is": lambda value, now: (value, value),
+    "is not": lambda value, now: (value, value),
+    "is after": lambda value, now: (value, None, False),
+    "is before": lambda value, now: (None, value, True, False),
+    "is in the range": lambda value, now: (value[0], value[1]),
+    "is not in the range": lambda value, now: (value[0], value[1]),
+    "is in the last": lambda value, now: (now - value, None),
+    "is not in the last": lambda value, now: (None, now - value)
+}
+_complements = {"is not", "is not in the range"}
+_missingMatches = {"is not in the range", "is not in the last"}
+
+
+class TrackIndex:
+    """Indexes over the track records of a library. An index is created on first use of its field and dropped when the field changes.
+    Rules that have no index are verified for the remaining candidates with the compiled predicate."""
+
+    def __init__(self, tracks: Iterable[dict]):
+        """Create the indexes for track records, see createTrackRecords()"""
+        self.tracks = list(tracks)
+        self._positions = {t["TrackID"]: i for i, t in enumerate(self.tracks)}
+        self._strings = {}
+        self._ranges = {}
+
+    def update(self, tracks: Iterable[dict]):
+        """ Replace or add track records. The indexes of the changed fields are created again on next use
+        :param tracks: new track records, see createTrackRecord()
+        """
+        changed = set()
+        for record in tracks:
+            position = self._positions.get(record["TrackID"])
+            if position is None:
+                self._positions[record["TrackID"]] = len(self.tracks)
+                self.tracks.append(record)
+                changed.update(record)
+            else:
+                old = self.tracks[position]
+                changed.update(key for key in record if record[key] != old.get(key))
+                self.tracks[position] = record
+        self.invalidate(changed)
+
+    def invalidate(self, fields: Iterable[str] = None):
+        """ Drop indexes
+        :param fields: Optional, the changed fields, default is all fields
+        """
+        if fields is None:
+            self._strings.clear()
+            self._ranges.clear()
+            return
+        for field in fields:
+            self._strings.pop(field, None)
+            self._ranges.pop(field, None)
+
+    def stringIndex(self, field: str) -> StringIndex:
+        """Return the index of a string field"""
+        if field not in self._strings:
+            self._strings[field] = StringIndex([t["SearchKeys"][field] for t in self.tracks])
+        return self._strings[field]
+
+    def rangeIndex(self, field: str) -> RangeIndex:
+        """Return the index of a numeric or date field"""
+        if field not in self._ranges:
+            self._ranges[field] = RangeIndex([t[field] for t in self.tracks])
+        return self._ranges[field]
+
+    def candidates(self, fulltree: dict, now: float = None) -> Optional[Set[int]]:
+        """ Return the positions of the tracks that can match the rules
+        :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :return: set of track positions or None if the indexes cannot narrow down the tracks
+        :rtype: set
+        """
+        if not fulltree:
+            return None
+        if now is None:
+            now = time.time()
+        return self._candidates(fulltree, now)
+
+    def supports(self, rule: dict) -> bool:
+        """Return True if an index can narrow down the tracks for the rule"""
+        ruletype = rule.get("type")
+        field = rule.get("field")
+        operator = rule.get("operator")
+        if ruletype == "string":
+            if field == "Kind":
+                return rule.get("kind_operator") == "like"
+            return field in StringFields.__members__ and (operator in _stringTests or operator in _negations)
+        if ruletype == "int":
+            return field in IntFields.__members__ and operator in _ranges
+        if ruletype == "date":
+            return field in DateFields.__members__ and operator in _ranges
+        return False
+
+    def evaluate(self, smartPlaylist: SmartPlaylist, now: float = None, playlists: Mapping = None) -> List[int]:
+        """ Return the TrackIDs of all tracks that match the rules of the playlist, see evaluateSmartPlaylist()"""
+        predicate = compileSmartPlaylist(smartPlaylist)
+        if now is None:
+            now = time.time()
+        if playlists is None:
+            playlists = {}
+        positions = self.candidates(optimizeRules(smartPlaylist.queryTree["fulltree"]), now)
+        tracks = self.tracks if positions is None else (self.tracks[i] for i in sorted(positions))
+        return [t["TrackID"] for t in tracks if predicate(t, now, playlists)]
+
+    def _candidates(self, obj, now):
+        if "and" in obj:
+            result = None
+            for x in obj["and"]:
+                positions = self._candidates(x, now)
+                if positions is not None:
+                    result = positions if result is None else result & positions
+                    if not result:
+                        break
+            return result
+
+        if "or" in obj:
+            result = set()
+            for x in obj["or"]:
+                positions = self._candidates(x, now)
+                if positions is None:
+                    return None
+                result |= positions
+            return result
+
+        if not self.supports(obj):
+            return None
+        operator = obj["operator"]
+        if obj["type"] == "string":
+            if obj["field"] == "Kind":
+                # The parser converts Kind rules to rules on the file extension
+                return self.stringIndex("Uri").lookup("ends with", obj["kind_value"])
+            return self.stringIndex(obj["field"]).lookup(operator, searchKey(obj["value"]))
+        if obj["type"] == "int":
+            return self.rangeIndex(obj["field"]).lookup(operator, obj["value"])
+        return self.rangeIndex(obj["field"]).lookup(operator, obj["value"], now)
@@ -5,7 +5,11 @@ Module for iTunes Library and library file `iTunes Music Library.xml`
 import time
 import datetime
 import base64
-from typing import BinaryIO, Tuple, Dict
+import functools
+import unicodedata
+from typing import BinaryIO, Iterator, Tuple, Dict, List
+
+from itunessmart.data_structure import StringFields, IntFields, DateFields, TrackKeys, TrackSortFallback
 
 try:
     import xml.etree.cElementTree as ET
@@ -34,6 +38,83 @@ def generatePersistentIDMapping(library: Library) -> Dict[str, str]:
     return persistentIDMapping
 
 
+def _plistValue(elem):
+    """Convert the text of a plist value element"""
+    if elem.tag == 'true':
+        return True
+    if elem.tag == 'false':
+        return False
+    if elem.tag == 'integer':
+        return int(elem.text)
+    if elem.tag == 'date':
+        try:
+            return int(time.mktime(datetime.datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ").timetuple()))
+        except ValueError:
+            return 0
+        except OverflowError as e:
+            t = datetime.datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ").timetuple()
+            if t.tm_year < 1971:
+                d = 1980 - t.tm_year
+                t2 = time.struct_time([t.tm_year + d, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday, t.tm_isdst])
+                return int(time.mktime(t2)) - d * 31557600
+            elif t.tm_year > 2030:
+                d = t.tm_year - 2040
+                t2 = time.struct_time([t.tm_year - d, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday, t.tm_isdst])
+                return int(time.mktime(t2)) + d * 31557600
+            else:
+                raise e
+    if elem.tag == 'data':
+        return base64.standard_b64decode("".join(elem.text.split()))
+    return elem.text
+
+
+def iterTrackRecords(libraryFileStream: BinaryIO) -> Iterator[dict]:
+    """Read the tracks of the library file `iTunes Music Library.xml` one at a time and yield a track record for each track, see createTrackRecord().
+    Only the current track is kept in memory, the playlists at the end of the file are not read.
+    :param stream libraryFileStream: file `iTunes Music Library.xml`
+    :return: iterator of track records
+    :rtype: iterator
+    """
+    parser = ET.iterparse(libraryFileStream, events=('start', 'end'))
+    _, plist = next(parser)
+
+    if plist.tag != "plist":
+        raise LibraryException("Root element is not <plist> element")
+    if plist.attrib['version'] != "1.0":
+        raise LibraryException("<plist> version is not 1.0")
+
+    depth = 0  # 1: library dict, 2: tracks dict, 3: track dict
+    key = None
+    tracksElem = None
+    track = None
+    for event, elem in parser:
+        if event == "start":
+            if elem.tag == 'dict' or elem.tag == 'array':
+                depth += 1
+                if depth == 2 and elem.tag == 'dict' and key == "Tracks":
+                    tracksElem = elem
+                elif depth == 3 and tracksElem is not None:
+                    track = {}
+            continue
+
+        if elem.tag == 'dict' or elem.tag == 'array':
+            depth -= 1
+            if elem is tracksElem:
+                break
+            if depth == 2 and track is not None:
+                yield createTrackRecord(track)
+                track = None
+                # Drop the finished tracks from the tree
+                tracksElem.clear()
+        elif elem.tag == 'key':
+            key = elem.text
+        elif depth == 3 and track is not None:
+            track[key] = _plistValue(elem)
+        if depth < 2:
+            elem.clear()
+    plist.clear()
+
+
 def readiTunesLibrary(libraryFileStream: BinaryIO) -> Library:
     """Read itunes library file `iTunes Music Library.xml` and return dict
     :param stream libraryFileStream: file `iTunes Music Library.xml`
@@ -89,32 +170,7 @@ def readiTunesLibrary(libraryFileStream: BinaryIO) -> Library:
                 current = parent.pop()
                 current_islist = isinstance(current, list)
             else:
-                if elem.tag == 'true':
-                    elem.text = True
-                elif elem.tag == 'false':
-                    elem.text = False
-                elif elem.tag == 'integer':
-                    elem.text = int(elem.text)
-                elif elem.tag == 'date':
-                    try:
-                        elem.text = int(time.mktime(datetime.datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ").timetuple()))
-                    except ValueError:
-                        elem.text = 0
-                    except OverflowError as e:
-                        t = datetime.datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ").timetuple()
-                        if t.tm_year < 1971:
-                            d = 1980 - t.tm_year
-                            t2 = time.struct_time([t.tm_year + d, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday, t.tm_isdst])
-                            elem.text = int(time.mktime(t2)) - d * 31557600
-                        elif t.tm_year > 2030:
-                            d = t.tm_year - 2040
-                            t2 = time.struct_time([t.tm_year - d, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday, t.tm_isdst])
-                            elem.text = int(time.mktime(t2)) + d * 31557600
-                        else:
-                            raise e
-
-                elif elem.tag == 'data':
-                    elem.text = base64.standard_b64decode("".join(elem.text.split()))
+                elem.text = _plistValue(elem)
 
                 if current_islist:
                     current.append(elem.text)
@@ -133,6 +189,106 @@ def readiTunesLibrary(libraryFileStream: BinaryIO) -> Library:
     return data
 
 
+def _mediaKind(track: dict) -> str:
+    if track.get("Podcast"):
+        return "Podcast"
+    if track.get("iTunesU"):
+        return "iTunes U"
+    if track.get("Music Video"):
+        return "Music Video"
+    if track.get("TV Show"):
+        return "TV Show"
+    if track.get("Movie"):
+        return "Movie"
+    if track.get("Has Video"):
+        return "Home Video"
+    kind = track.get("Kind", "").lower()
+    if "audiobook" in kind:
+        return "Audiobook"
+    if "voice memo" in kind:
+        return "Voice Memo"
+    if kind == "book" or "pdf" in kind:
+        return "Book"
+    return "Music"
+
+
+def _iCloudStatus(track: dict) -> str:
+    if track.get("Purchased"):
+        return "Purchased"
+    if track.get("Matched"):
+        return "Matched"
+    if track.get("Track Type") == "Remote":
+        return "Uploaded"
+    return "Local Only"
+
+
+def _loveStatus(track: dict) -> str:
+    if track.get("Loved") or track.get("Favorited"):
+        return "Loved"
+    if track.get("Disliked"):
+        return "Disliked"
+    return "None"
+
+
+@functools.lru_cache(maxsize=8192)
+def searchKey(value: str) -> str:
+    """ Normalize a string for case insensitive comparisons: Unicode NFKC normalization and case folding
+    :param str value: a string value of a track or a rule
+    :return: the normalized string
+    :rtype: str
+    """
+    return unicodedata.normalize("NFKC", value).casefold()
+
+
+_searchKeyFields = [field.name for field in StringFields] + ["SortArtist", "Uri"]
+
+
+def createTrackRecord(track: dict) -> dict:
+    """Create a flat track record from a track of the library. The keys of the record are the field names of the parser,
+    e.g. `Plays` instead of `Play Count`, and every field is present: missing strings are "", missing numbers are 0 and missing dates are None.
+    The rating is converted to stars like in the parser result.
+    `SearchKeys` maps each string field to its normalized value (see searchKey()), the string rules compare these keys.
+    :param dict track: a track from library['Tracks']
+    :return: track record
+    :rtype: dict
+    """
+    record = {"TrackID": track.get("Track ID"), "Uri": track.get("Location", "")}
+    for field in StringFields:
+        record[field.name] = track.get(TrackKeys[field.name], "")
+    record["SortArtist"] = track.get(TrackKeys["SortArtist"], "")
+    for field, fallback in TrackSortFallback.items():
+        if not record[field]:
+            record[field] = record[fallback]
+    for field in IntFields:
+        if field.name in TrackKeys:
+            record[field.name] = track.get(TrackKeys[field.name], 0)
+    record["Rating"] = 0 if track.get("Rating Computed") else int(track.get("Rating", 0) / 20)
+    record["Compilation"] = int(bool(track.get("Compilation")))
+    record["Podcast"] = int(bool(track.get("Podcast")))
+    for field in DateFields:
+        record[field.name] = track.get(TrackKeys[field.name])
+    record["HasArtwork"] = track.get("Artwork Count", 0) > 0
+    record["Purchased"] = bool(track.get("Purchased"))
+    record["Checked"] = not track.get("Disabled", False)
+    record["MediaKind"] = _mediaKind(track)
+    record["iCloudStatus"] = _iCloudStatus(track)
+    record["Love"] = _loveStatus(track)
+    record["Location"] = "iCloud" if track.get("Track Type") == "Remote" else "Computer"
+    record["SearchKeys"] = {field: searchKey(record[field]) for field in _searchKeyFields}
+    return record
+
+
+def createTrackRecords(library: Library) -> List[dict]:
+    """Create track records for all tracks in the library, see createTrackRecord()
+    :param Library library: the result of readiTunesLibrary()
+    :return: list of track records
+    :rtype: list
+    """
+    if 'Tracks' not in library:
+        return []
+    return [createTrackRecord(track) for track in library['Tracks'].values()]
+
+
 class Node:
     def __init__(self, data):
         if isinstance(data, str):
@@ -163,7 +319,7 @@ def createPlaylistTree(library: Library) -> Tuple[Node, dict]:
     for playlist in library['Playlists']:
         # Clean up tracks array
         if 'Playlist Items' in playlist:
-            playlist['Playlist Items'] = [[dictionary[x] for x in dictionary][0] for dictionary in playlist['Playlist Items']]
+            playlist['Playlist Items'] = [[dictionary[x] for x in dictionary][0] if isinstance(dictionary, dict) else dictionary for dictionary in playlist['Playlist Items']]
 
         if 'Playlist Persistent ID' not in playlist:
             otherPlaylists.append(playlist)
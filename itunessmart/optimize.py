@@ -0,0 +1,194 @@
+"""
+Module to simplify the rules of a parser result before they are evaluated or converted
+"""
+
+from typing import List
+
+__all__ = ["optimizeRules"]
+
+# Constant groups: an empty "and" is always true, an empty "or" is always false
+_TRUE = {"and": []}
+_FALSE = {"or": []}
+
+_intRangeOperators = ("greater than", "less than", "between", "is")
+
+
+def optimizeRules(fulltree: dict) -> dict:
+    """ Simplify the rules without changing which tracks match: nested groups with the same operator are flattened,
+    groups with one rule are replaced by the rule, duplicate rules are removed, `between` rules on one value become `is` rules,
+    int ranges and date limits on the same field are merged, and rules that are always true or always false are folded.
+    The tree is not modified, unchanged rules are shared with the new tree.
+    :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+    :return: the new fulltree, the top level is a group. {"and": []} matches all tracks, {"or": []} matches no tracks
+    :rtype: dict
+    """
+    if not fulltree:
+        return fulltree
+    result = _optimize(fulltree)
+    if "and" not in result and "or" not in result:
+        result = {"and" if "and" in fulltree or "or" not in fulltree else "or": [result]}
+    return result
+
+
+def _optimize(obj):
+    if "and" not in obj and "or" not in obj:
+        return _normalize(obj)
+
+    operator = "and" if "and" in obj else "or"
+    absorbing = _FALSE if operator == "and" else _TRUE
+    children = []
+    seen = set()  # Keys of the children, so duplicates are found in constant time
+    for x in obj[operator]:
+        y = _optimize(x)
+        if y == absorbing:
+            return absorbing
+        # Flatten the nested group, this also drops constants that do not change the result
+        for z in (y[operator] if operator in y else [y]):
+            key = _key(z)
+            if key not in seen:
+                seen.add(key)
+                children.append(z)
+
+    children = _mergeRanges(operator, children)
+    if absorbing in children:
+        return absorbing
+    if len(children) == 1:
+        return children[0]
+    return {operator: children}
+
+
+def _key(obj):
+    """Hashable key of a rule or a group, equal rules have equal keys"""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _key(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_key(v) for v in obj)
+    return obj
+
+
+def _normalize(rule):
+    """Normalize a single rule"""
+    ruletype = rule.get("type")
+    operator = rule.get("operator")
+    value = rule.get("value")
+    if ruletype == "int" and operator in ("between", "not between"):
+        if value[0] == value[1]:
+            return dict(rule, operator="is" if operator == "between" else "is not", value=value[0])
+        if value[0] > value[1]:
+            return _FALSE if operator == "between" else _TRUE
+    elif ruletype == "string" and rule.get("field") != "Kind" and value == "":
+        # Every string contains, starts and ends with the empty string
+        if operator in ("like", "starts with", "ends with"):
+            return _TRUE
+        if operator == "not like":
+            return _FALSE
+    return rule
+
+
+def _interval(rule):
+    """Inclusive bounds of an int rule, None is unbounded"""
+    operator = rule["operator"]
+    value = rule["value"]
+    if operator == "greater than":
+        return value + 1, None
+    if operator == "less than":
+        return None, value - 1
+    if operator == "between":
+        return value[0], value[1]
+    return value, value
+
+
+def _intRule(rule, low, high):
+    """Create a rule for the inclusive bounds"""
+    if low is None and high is None:
+        return _TRUE
+    if low is None:
+        return dict(rule, operator="less than", value=high + 1)
+    if high is None:
+        return dict(rule, operator="greater than", value=low - 1)
+    if low == high:
+        return dict(rule, operator="is", value=low)
+    return dict(rule, operator="between", value=(low, high))
+
+
+def _mergeRanges(operator, children) -> List[dict]:
+    """Merge int ranges and date limits on the same field. The merged rules take the place of the first rule on the field"""
+    groups = {}
+    for i, x in enumerate(children):
+        if x.get("type") == "int" and x.get("operator") in _intRangeOperators:
+            groups.setdefault((x["field"], "int"), []).append(i)
+        elif x.get("type") == "int" and x.get("operator") == "is not" and operator == "and":
+            groups.setdefault((x["field"], "int"), []).append(i)
+        elif x.get("type") == "date" and x.get("operator") in ("is after", "is before"):
+            groups.setdefault((x["field"], "date"), []).append(i)
+
+    replace = {}
+    for (field, kind), positions in groups.items():
+        if len(positions) < 2:
+            continue
+        rules = [children[i] for i in positions]
+        merged = _mergeInt(operator, rules) if kind == "int" else _mergeDate(operator, rules)
+        if merged is None:
+            continue
+        replace.update(dict.fromkeys(positions, []))
+        replace[positions[0]] = merged
+
+    if not replace:
+        return children
+    result = []
+    for i, x in enumerate(children):
+        result.extend(replace.get(i, [x]))
+    return result
+
+
+def _mergeInt(operator, rules):
+    ranges = [r for r in rules if r["operator"] != "is not"]
+    excluded = [r for r in rules if r["operator"] == "is not"]
+    if not ranges:
+        return None
+    intervals = [_interval(r) for r in ranges]
+
+    if operator == "and":
+        lows = [low for low, _ in intervals if low is not None]
+        highs = [high for _, high in intervals if high is not None]
+        low = max(lows) if lows else None
+        high = min(highs) if highs else None
+        if low is not None and high is not None and low > high:
+            return [_FALSE]
+        result = [_intRule(ranges[0], low, high)]
+        for r in excluded:
+            value = r["value"]
+            if low == high == value:
+                return [_FALSE]
+            if (low is None or low <= value) and (high is None or value <= high) and r not in result:
+                result.append(r)
+        return result
+
+    # Union of the intervals, adjacent intervals are merged
+    intervals.sort(key=lambda interval: float("-inf") if interval[0] is None else interval[0])
+    merged = [list(intervals[0])]
+    for low, high in intervals[1:]:
+        last = merged[-1]
+        if last[1] is None or low is None or low <= last[1] + 1:
+            if last[1] is not None and (high is None or high > last[1]):
+                last[1] = high
+        else:
+            merged.append([low, high])
+    return [_intRule(ranges[0], low, high) for low, high in merged]
+
+
+def _mergeDate(operator, rules):
+    """Missing dates match neither limit, so only limits in the same direction are merged"""
+    after = [r for r in rules if r["operator"] == "is after"]
+    before = [r for r in rules if r["operator"] == "is before"]
+    value = lambda r: r["value"]
+    if operator == "and":
+        after = max(after, key=value) if after else None
+        before = min(before, key=value) if before else None
+        if after and before and before["value"] - after["value"] <= 1:
+            return [_FALSE]
+    else:
+        after = min(after, key=value) if after else None
+        before = max(before, key=value) if before else None
+    result = [after, before] if rules[0]["operator"] == "is after" else [before, after]
+    return [r for r in result if r is not None]
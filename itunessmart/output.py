@@ -0,0 +1,105 @@
+"""
+Module to write files atomically, one at a time or in a small pool of threads
+"""
+
+import os
+import uuid
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator
+
+__all__ = ["atomicOpen", "atomicWrite", "FileWriterPool"]
+
+
+@contextlib.contextmanager
+def atomicOpen(filepath: str, buffering: int = -1) -> Iterator[BinaryIO]:
+    """ Open a temporary file in the same directory for writing, it replaces the file when the block ends without an exception.
+    A reader sees the old or the new content of the file, but never a partially written file.
+    :param str filepath: the file
+    :param int buffering: Optional, the buffer size, see open()
+    :return: context manager of a buffered binary file object
+    """
+    directory, filename = os.path.split(filepath)
+    temp = os.path.join(directory, ".%s.%s.tmp" % (filename, uuid.uuid4().hex))
+    try:
+        with open(temp, "wb", buffering=buffering) as f:
+            yield f
+        os.replace(temp, filepath)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def atomicWrite(filepath: str, data: bytes):
+    """ Write the data to a temporary file and replace the file, see atomicOpen()
+    :param str filepath: the file
+    :param bytes data: the new content
+    """
+    with atomicOpen(filepath) as f:
+        f.write(data)
+
+
+def _writeBatch(batch):
+    for filepath, data in batch:
+        atomicWrite(filepath, data)
+
+
+class FileWriterPool:
+    """Write files atomically in a small pool of threads, so the caller does not wait for a slow disk or network share.
+    The files are collected in batches, a thread writes one batch at a time. All files with the same path are written by the same thread,
+    so if a file is written twice, the last content is the content of the last write().
+    Errors are raised by flush() and close(), or use the pool as a context manager."""
+
+    def __init__(self, threads: int = 4, batch: int = 32):
+        """ Start the threads
+        :param int threads: Optional, number of threads
+        :param int batch: Optional, number of files per batch
+        """
+        self.batch = batch
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in range(max(1, threads))]
+        self._batches = [[] for _ in self._executors]
+        self._futures = []
+
+    def write(self, filepath: str, data: bytes):
+        """ Add a file to the batch of its thread
+        :param str filepath: the file
+        :param bytes data: the new content
+        """
+        shard = hash(os.path.normcase(os.path.abspath(filepath))) % len(self._executors)
+        self._batches[shard].append((filepath, data))
+        if len(self._batches[shard]) >= self.batch:
+            self._submit(shard)
+
+    def _submit(self, shard):
+        batch = self._batches[shard]
+        if batch:
+            self._batches[shard] = []
+            self._futures.append(self._executors[shard].submit(_writeBatch, batch))
+
+    def flush(self):
+        """Write the remaining batches and wait until all files are written, raise the first error"""
+        for shard in range(len(self._executors)):
+            self._submit(shard)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Write the remaining files and stop the threads"""
+        try:
+            self.flush()
+        finally:
+            for executor in self._executors:
+                executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not replace the exception of the block with an error of a write
+            for executor in self._executors:
+                executor.shutdown()
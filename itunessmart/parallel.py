@@ -0,0 +1,153 @@
+"""
+Module to evaluate smart playlists in worker processes over track columns in shared memory
+"""
+
+import os
+import time
+import multiprocessing
+import multiprocessing.util
+from multiprocessing import shared_memory
+from typing import Dict, Hashable, List, Mapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from itunessmart.parse import SmartPlaylist
+from itunessmart.evaluate import EvaluationException
+from itunessmart.columnar import TrackTable
+from itunessmart.optimize import optimizeRules
+from itunessmart.dependency import ruleFields
+
+__all__ = ["SharedTrackTable", "evaluateParallel"]
+
+
+class SharedTrackTable:
+    """The columns of a TrackTable in shared memory. Worker processes attach to the memory blocks by name, the arrays are not copied.
+    Strings are dictionary encoded: the codes are shared, the lists of distinct values are sent to each worker once.
+    The memory is released with close(), or use the table as a context manager."""
+
+    def __init__(self, tracks: List[dict], fields: List[str]):
+        """ Copy the columns to shared memory
+        :param tracks: the track records, see createTrackRecords()
+        :param fields: the fields that the rules read, see ruleFields()
+        """
+        table = TrackTable(tracks)
+        self._blocks = []
+        self.trackIDs = table.trackIDs
+        self.layout = {"TrackID": self._share(table.trackIDs), "columns": {}}  # Names, types and shapes of the arrays for the workers
+        for field in sorted(set(fields)):
+            column = table.column(field)
+            if isinstance(column, tuple):
+                categories, codes = column
+                self.layout["columns"][field] = (self._share(codes), categories)
+            else:
+                self.layout["columns"][field] = (self._share(column), None)
+
+    def _share(self, array):
+        # Shared memory blocks can not be empty
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self._blocks.append(block)
+        numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        return block.name, array.dtype.str, array.shape
+
+    @staticmethod
+    def attach(layout: dict):
+        """ Create a TrackTable over the shared arrays, in a worker process
+        :param dict layout: the layout attribute of the SharedTrackTable
+        :return: the table and the attached memory blocks, which must be kept open while the table is used
+        :rtype: tuple
+        """
+        blocks = []
+
+        def array(name, dtype, shape):
+            block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            return numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+        columns = {}
+        for field, (shared, categories) in layout["columns"].items():
+            columns[field] = array(*shared) if categories is None else (categories, array(*shared))
+        return TrackTable.fromColumns(array(*layout["TrackID"]), columns), blocks
+
+    def close(self):
+        """Release the shared memory"""
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_worker = {}  # State of a worker process: table, memory blocks, now and playlists
+
+
+def _initWorker(layout, now, playlists):
+    _worker["table"], _worker["blocks"] = SharedTrackTable.attach(layout)
+    _worker["now"] = now
+    _worker["playlists"] = playlists
+    # Close the memory blocks when the worker process exits
+    multiprocessing.util.Finalize(None, _closeWorker, exitpriority=10)
+
+
+def _closeWorker():
+    _worker.pop("table", None)
+    for block in _worker.pop("blocks", []):
+        block.close()
+
+
+def _evaluateChunk(chunk):
+    """Evaluate (key, fulltree) pairs, return (key, packed bitset) pairs"""
+    table = _worker["table"]
+    return [(key, numpy.packbits(table.mask(fulltree, _worker["now"], _worker["playlists"])).tobytes()) for key, fulltree in chunk]
+
+
+def evaluateParallel(smartPlaylists: Mapping[Hashable, SmartPlaylist], tracks: List[dict], now: float = None, playlists: Mapping = None, processes: int = None) -> Dict[Hashable, List[int]]:
+    """ Evaluate many playlists in worker processes. The columns that the rules read are placed in shared memory, the playlists are
+    distributed to the workers and each worker returns a bitset of the matching tracks per playlist. Requires NumPy.
+    :param smartPlaylists: mapping from a key, e.g. the playlist persistent ID, to the result of the parser
+    :param tracks: the track records, see createTrackRecords()
+    :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+    :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+    :param int processes: Optional, number of worker processes, default is the number of CPUs
+    :return: mapping from key to list of TrackIDs
+    :rtype: dict
+    """
+    if numpy is None:
+        raise EvaluationException("NumPy is not available")
+    if now is None:
+        now = time.time()
+    if playlists is None:
+        playlists = {}
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    fulltrees = [(key, optimizeRules(smartPlaylist.queryTree["fulltree"])) for key, smartPlaylist in smartPlaylists.items()]
+    fields = set()
+    for _, fulltree in fulltrees:
+        fields |= ruleFields(fulltree)
+    # Several chunks per process, so a process with cheap playlists takes over more work
+    size = max(1, len(fulltrees) // (processes * 4))
+    chunks = [fulltrees[i:i + size] for i in range(0, len(fulltrees), size)]
+
+    bitsets = {}
+    with SharedTrackTable(tracks, fields) as table:
+        with multiprocessing.Pool(processes, _initWorker, (table.layout, now, dict(playlists))) as pool:
+            for result in pool.imap_unordered(_evaluateChunk, chunks):
+                bitsets.update(result)
+            # Let the workers exit normally, so they close the memory blocks before the blocks are unlinked
+            pool.close()
+            pool.join()
+        trackIDs = table.trackIDs
+
+    result = {}
+    for key, _ in fulltrees:
+        mask = numpy.unpackbits(numpy.frombuffer(bitsets[key], dtype=numpy.uint8), count=len(trackIDs)).astype(bool)
+        result[key] = trackIDs[mask].tolist()
+    return result
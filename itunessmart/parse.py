@@ -26,6 +26,16 @@ class SmartPlaylist:
     def __repr__(self):
         return "SmartPlaylist(%s)" % json.dumps({"queryTree": self.queryTree, "ignore": self.ignore}, indent=2)
 
+    def explain(self, tracks, now=None, playlists=None, statistics=None, index=None):
+        """ Evaluate the playlist and describe the plan, indented like the output. See explainSmartPlaylist()
+        :param tracks: the track records, see createTrackRecords()
+        :return: the plan
+        :rtype: str
+        """
+        # Imported here, because the evaluation modules depend on this module
+        from itunessmart.explain import explainSmartPlaylist
+        return explainSmartPlaylist(self, tracks, now=now, playlists=playlists, statistics=statistics, index=index)
+
 
 class SmartPlaylistParser:
     def __init__(self, datastr_info=None, datastr_criteria=None):
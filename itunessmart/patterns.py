@@ -0,0 +1,112 @@
+"""
+Module to match many string rules on the same field in one scan of the value
+"""
+
+from collections import deque
+from typing import List, Set, Tuple
+
+from itunessmart.evaluate import EvaluationException
+
+__all__ = ["PatternMatcher"]
+
+_operators = ("like", "not like", "is", "is not", "starts with", "ends with")
+
+
+class PatternMatcher:
+    """Match the rules of many playlists on one string field at once. The patterns of `contains`, `begins with` and `ends with` rules
+    are compiled into one Aho-Corasick automaton, so each value is scanned once for all patterns."""
+
+    def __init__(self, rules: List[Tuple[str, str]]):
+        """ Compile the rules
+        :param rules: list of (operator, value) with the operators of the parser for string fields and normalized values, see searchKey()
+        """
+        self.rules = list(rules)
+        self._patterns = {}  # Map pattern to pattern id
+        self._ruleTests = []  # (operator, pattern id or value) for each rule
+        for operator, value in self.rules:
+            if operator not in _operators:
+                raise EvaluationException("Unsupported operator", operator)
+            if operator in ("is", "is not"):
+                self._ruleTests.append((operator, value))
+            else:
+                self._ruleTests.append((operator, self._patterns.setdefault(value, len(self._patterns))))
+        self._lengths = [len(pattern) for pattern in self._patterns]
+        self._build()
+
+    def _build(self):
+        """Create the trie of the patterns, the failure links and the outputs"""
+        self._goto = [{}]
+        self._outputs = [[]]  # Pattern ids that end in each state
+        for pattern, patternID in self._patterns.items():
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._outputs.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._outputs[state].append(patternID)
+
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._outputs[child] = self._outputs[child] + self._outputs[self._fail[child]]
+
+    def occurrences(self, s: str) -> Tuple[Set[int], Set[int], Set[int]]:
+        """ Scan the value once
+        :param str s: the search key of the value
+        :return: the ids of the patterns that s contains, starts with and ends with
+        :rtype: tuple
+        """
+        contains = set(self._outputs[0])  # The empty pattern
+        starts = set(contains)
+        ends = set(contains)
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        lengths = self._lengths
+        last = len(s) - 1
+        state = 0
+        for i, char in enumerate(s):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for patternID in outputs[state]:
+                contains.add(patternID)
+                if lengths[patternID] == i + 1:
+                    starts.add(patternID)
+                if i == last:
+                    ends.add(patternID)
+        return contains, starts, ends
+
+    def match(self, s: str) -> Set[int]:
+        """ Return the ids of the rules that match the value
+        :param str s: the search key of the value
+        :return: set of indexes into self.rules
+        :rtype: set
+        """
+        contains, starts, ends = self.occurrences(s)
+        result = set()
+        for ruleID, (operator, test) in enumerate(self._ruleTests):
+            if operator == "like":
+                matches = test in contains
+            elif operator == "not like":
+                matches = test not in contains
+            elif operator == "starts with":
+                matches = test in starts
+            elif operator == "ends with":
+                matches = test in ends
+            elif operator == "is":
+                matches = s == test
+            else:
+                matches = s != test
+            if matches:
+                result.add(ruleID)
+        return result
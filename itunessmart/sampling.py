@@ -0,0 +1,123 @@
+"""
+Module to estimate the number of tracks of a smart playlist from a random sample of the tracks
+"""
+
+import math
+import time
+import random
+from statistics import NormalDist
+from typing import Iterator, List, Mapping, Union
+
+from itunessmart.parse import SmartPlaylist
+from itunessmart.evaluate import compileSmartPlaylist, EvaluationException
+
+__all__ = ["CountEstimate", "estimateCount", "iterCountEstimates"]
+
+
+class CountEstimate:
+    """Estimated number of tracks of a playlist with a confidence interval"""
+
+    def __init__(self, matches: int, sampled: int, total: int, confidence: float, limit: int = None, seconds: float = 0.0):
+        """ Compute the estimate and the Wilson score interval of the sample, with finite population correction
+        :param int matches: number of matching tracks in the sample
+        :param int sampled: number of tracks in the sample
+        :param int total: number of tracks in the library
+        :param float confidence: confidence level of the interval, e.g. 0.95
+        :param int limit: Optional, the item limit of the playlist
+        :param float seconds: Optional, time spent on the sample
+        """
+        self.matches = matches
+        self.sampled = sampled
+        self.total = total
+        self.confidence = confidence
+        self.seconds = seconds
+        self.exact = sampled >= total
+
+        if self.exact or not sampled:
+            p = matches / sampled if sampled else 0.0
+            low, high = (matches, matches) if self.exact else (0, total)
+        else:
+            p = matches / sampled
+            z = NormalDist().inv_cdf((1.0 + confidence) / 2.0)
+            denominator = 1.0 + z * z / sampled
+            center = (p + z * z / (2.0 * sampled)) / denominator
+            half = z * math.sqrt(p * (1.0 - p) / sampled + z * z / (4.0 * sampled * sampled)) / denominator
+            half *= math.sqrt((total - sampled) / (total - 1))
+            # The tracks of the sample are known
+            low = max(matches, math.floor(total * (center - half)))
+            high = min(total - (sampled - matches), math.ceil(total * (center + half)))
+        count = matches if self.exact else round(p * total)
+        if limit is not None:
+            count, low, high = min(count, limit), min(low, limit), min(high, limit)
+        self.count = count
+        self.low = low
+        self.high = high
+
+    def __str__(self):
+        if self.exact:
+            return "%d tracks" % self.count
+        return "about %d tracks (%d to %d, %.0f%% confidence)" % (self.count, self.low, self.high, self.confidence * 100)
+
+    def __repr__(self):
+        return "CountEstimate(count=%d, low=%d, high=%d, sampled=%d of %d)" % (self.count, self.low, self.high, self.sampled, self.total)
+
+
+def iterCountEstimates(smartPlaylist: SmartPlaylist, tracks: List[dict], now: float = None, playlists: Mapping = None, confidence: float = 0.95, batch: int = 1000, seed: Union[int, str, bytes] = None) -> Iterator[CountEstimate]:
+    """ Evaluate the rules on a uniform random sample of the tracks that grows by `batch` tracks per step and yield a refined estimate after each step.
+    The last estimate is exact, because the sample then contains all tracks. Unchecked tracks are excluded if the playlist is set up to do so,
+    an item limit caps the count, other limits are not applied.
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param tracks: the track records, see createTrackRecords()
+    :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+    :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+    :param float confidence: Optional, confidence level of the intervals
+    :param int batch: Optional, number of tracks per step, at least 1
+    :param seed: Optional, int, str or bytes, seed of the sample. The same seed gives the same sample in every run
+    :return: iterator of CountEstimate
+    :rtype: iterator
+    """
+    if batch < 1:
+        raise EvaluationException("Batch size must be at least 1", batch)
+    predicate = compileSmartPlaylist(smartPlaylist)
+    if now is None:
+        now = time.time()
+    if playlists is None:
+        playlists = {}
+    queryTree = smartPlaylist.queryTree
+    onlychecked = queryTree.get("onlychecked")
+    limit = queryTree["number"] if "number" in queryTree and queryTree["type"] == "Items" else None
+
+    rng = random.Random(seed)
+    total = len(tracks)
+    swapped = {}  # Map position to the track at that position, if it differs from the identity permutation
+    matches = 0
+    sampled = 0
+    start = time.perf_counter()
+    while True:
+        end = min(total, sampled + batch)
+        # Partial Fisher-Yates shuffle of a sparse permutation: the first `end` positions are a uniform sample without replacement.
+        # Only the swapped positions are stored, so the memory grows with the sample, not with the library
+        for i in range(sampled, end):
+            j = rng.randrange(i, total)
+            t = tracks[swapped.get(j, j)]
+            swapped[j] = swapped.pop(i, i)
+            if predicate(t, now, playlists) and (not onlychecked or t["Checked"]):
+                matches += 1
+        sampled = end
+        yield CountEstimate(matches, sampled, total, confidence, limit, time.perf_counter() - start)
+        if sampled >= total:
+            return
+
+
+def estimateCount(smartPlaylist: SmartPlaylist, tracks: List[dict], now: float = None, playlists: Mapping = None, confidence: float = 0.95, budget: float = 0.05, batch: int = 1000, seed: Union[int, str, bytes] = None) -> CountEstimate:
+    """ Estimate the number of tracks of the playlist within a time budget, see iterCountEstimates().
+    At least one batch is evaluated, the estimate is exact if all tracks are evaluated within the budget.
+    :param float budget: Optional, time budget in seconds
+    :return: the last estimate
+    :rtype: CountEstimate
+    """
+    deadline = time.perf_counter() + budget
+    for estimate in iterCountEstimates(smartPlaylist, tracks, now, playlists, confidence, batch, seed):
+        if time.perf_counter() >= deadline:
+            break
+    return estimate
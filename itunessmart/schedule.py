@@ -0,0 +1,91 @@
+"""
+Module to find out when the result of a smart playlist with relative date rules can change
+"""
+
+import math
+import time
+import bisect
+from typing import Iterable, List
+
+from itunessmart.parse import SmartPlaylist
+from itunessmart.optimize import optimizeRules
+
+__all__ = ["DateSchedule", "nextChange"]
+
+_relativeOperators = ("is in the last", "is not in the last")
+
+
+def _relativeRules(fulltree):
+    result = []
+    stack = [fulltree] if fulltree else []
+    while stack:
+        obj = stack.pop()
+        if "and" in obj or "or" in obj:
+            stack.extend(obj["and"] if "and" in obj else obj["or"])
+        elif obj.get("type") == "date" and obj.get("operator") in _relativeOperators:
+            result.append(obj)
+    return result
+
+
+class DateSchedule:
+    """Sorted date values of the tracks. Rules like `is in the last 7 days` compare the date with the current time,
+    so the result of such a rule only changes when now - date passes the value of the rule for one of the tracks.
+    The sorted dates of a field are created on first use and dropped when the field changes."""
+
+    def __init__(self, tracks: List[dict]):
+        """ Create the schedule
+        :param tracks: the track records, see createTrackRecords()
+        """
+        self.tracks = tracks
+        self._dates = {}
+
+    def dates(self, field: str) -> List[float]:
+        """Return the sorted dates of a field, missing dates are left out"""
+        if field not in self._dates:
+            self._dates[field] = sorted(t[field] for t in self.tracks if t[field] is not None)
+        return self._dates[field]
+
+    def invalidate(self, fields: Iterable[str] = None):
+        """ Drop sorted dates
+        :param fields: Optional, the changed fields, default is all fields
+        """
+        if fields is None:
+            self._dates.clear()
+            return
+        for field in fields:
+            self._dates.pop(field, None)
+
+    def nextChange(self, fulltree: dict, now: float) -> float:
+        """ Return the first instant after now at which a relative date rule of the tree changes for one of the tracks.
+        The result of the rules at now is valid for all instants before that. Rules on other playlists are not considered.
+        :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+        :param float now: unix timestamp of the evaluation
+        :return: unix timestamp, math.inf if the result does not change with time
+        :rtype: float
+        """
+        result = math.inf
+        for rule in _relativeRules(fulltree):
+            dates = self.dates(rule["field"])
+            value = rule["value"]
+            if rule["operator"] == "is in the last":
+                # now - date < value is True until now reaches date + value
+                i = bisect.bisect_right(dates, now - value)
+            else:
+                # now - date > value is False until now passes date + value
+                i = bisect.bisect_left(dates, now - value)
+            if i < len(dates):
+                result = min(result, dates[i] + value)
+        return result
+
+
+def nextChange(smartPlaylist: SmartPlaylist, tracks: List[dict], now: float = None) -> float:
+    """ Return the first instant at which the tracks of the playlist can change because time passes, see DateSchedule.nextChange()
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param tracks: the track records, see createTrackRecords()
+    :param float now: Optional, unix timestamp of the evaluation, default is the current time
+    :return: unix timestamp, math.inf if the result does not change with time
+    :rtype: float
+    """
+    if now is None:
+        now = time.time()
+    return DateSchedule(tracks).nextChange(optimizeRules(smartPlaylist.queryTree["fulltree"]), now)
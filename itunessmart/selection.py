@@ -0,0 +1,143 @@
+"""
+Module to apply the limit of a smart playlist to the matching tracks
+"""
+
+import heapq
+import random
+from typing import Iterable, List, Set, Union
+
+from itunessmart.data_structure import StringFields, DateFields
+from itunessmart.parse import SmartPlaylist
+
+__all__ = ["selectTracks", "limitFields"]
+
+# Limit type: (field, factor) the budget is number * factor in units of the field
+_budgets = {
+    "Minutes": ("Duration", 60 * 1000),
+    "Hours": ("Duration", 60 * 60 * 1000),
+    "MB": ("Size", 1024 * 1024),
+    "GB": ("Size", 1024 * 1024 * 1024)
+}
+
+
+class _Descending:
+    """Reverse the order of a sort key"""
+    __slots__ = ("key", )
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def _orderKey(order):
+    """Return the sort key function and the direction for an order string like `Plays DESC`"""
+    field, _, direction = order.partition(" ")
+    if field in StringFields.__members__ or field == "SortArtist":
+        key = lambda t: t[field].lower()
+    elif field in DateFields.__members__:
+        # Missing dates are older than all dates
+        key = lambda t: (t[field] is not None, t[field] or 0)
+    else:
+        key = lambda t: t[field]
+    return key, direction == "DESC"
+
+
+def limitFields(smartPlaylist: SmartPlaylist) -> Set[str]:
+    """ Return the fields of the track records that are read to apply the limit of the playlist
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :return: set of field names
+    :rtype: set
+    """
+    queryTree = smartPlaylist.queryTree
+    fields = set()
+    if queryTree.get("onlychecked"):
+        fields.add("Checked")
+    if "number" in queryTree:
+        if queryTree["type"] in _budgets:
+            fields.add(_budgets[queryTree["type"]][0])
+        if queryTree["order"] != "RANDOM()":
+            fields.add(queryTree["order"].partition(" ")[0])
+    return fields
+
+
+def selectTracks(smartPlaylist: SmartPlaylist, tracks: Iterable[dict], seed: Union[int, str, bytes] = None) -> List[dict]:
+    """ Apply the limit of the playlist and exclude unchecked items, if the playlist is set up to do so.
+    Item limits keep the top k tracks in a heap, size and time limits fill the budget in the order of the selection method.
+    Random selection is a reservoir sample of the stream of tracks, it does not keep more tracks in memory than it selects.
+    :param SmartPlaylist smartPlaylist: the result of the parser
+    :param tracks: the matching track records in playlist order
+    :param seed: Optional, int, str or bytes, seed for playlists that are selected by random. Default is a seed derived from the rules, so the selection is stable between runs
+    :return: list of selected track records
+    :rtype: list
+    """
+    queryTree = smartPlaylist.queryTree
+    if queryTree.get("onlychecked"):
+        tracks = (t for t in tracks if t["Checked"])
+
+    if "number" not in queryTree:
+        return list(tracks)
+
+    number = queryTree["number"]
+    limittype = queryTree["type"]
+
+    if queryTree["order"] == "RANDOM()":
+        if seed is None:
+            seed = "%s\n%s" % (smartPlaylist.query, smartPlaylist.output)
+        if limittype == "Items":
+            return _reservoir(tracks, random.Random(seed), None, number)
+        return _reservoir(tracks, random.Random(seed), *_budget(limittype, number))
+
+    key, descending = _orderKey(queryTree["order"])
+    if limittype == "Items":
+        if descending:
+            return heapq.nlargest(number, tracks, key=key)
+        return heapq.nsmallest(number, tracks, key=key)
+
+    # Sorting all tracks is not necessary, the budget is usually exhausted after a few pops
+    wrap = _Descending if descending else (lambda k: k)
+    heap = [(wrap(key(t)), i, t) for i, t in enumerate(tracks)]
+    heapq.heapify(heap)
+    return _fillBudget((heapq.heappop(heap)[2] for _ in range(len(heap))), *_budget(limittype, number))
+
+
+def _budget(limittype, number):
+    field, factor = _budgets[limittype]
+    return field, number * factor
+
+
+def _reservoir(tracks, rng, field, budget):
+    """Every track gets a random key. Keep the tracks with the smallest keys that fit in the budget,
+    i.e. the selection is the beginning of a random permutation of all tracks. If field is None, every track counts as 1"""
+    heap = []  # Max-heap of the selected tracks: (-key, index, weight, track)
+    total = 0
+    cutoff = 1.0  # Smallest key of a track that did not fit, the permutation is cut before this track
+    for i, t in enumerate(tracks):
+        key = rng.random()
+        if key >= cutoff:
+            continue
+        weight = 1 if field is None else t[field]
+        heapq.heappush(heap, (-key, i, weight, t))
+        total += weight
+        while total > budget:
+            negativeKey, _, removed, _ = heapq.heappop(heap)
+            total -= removed
+            cutoff = -negativeKey
+    heap.sort(reverse=True)
+    return [entry[3] for entry in heap]
+
+
+def _fillBudget(tracks, field, budget):
+    """Take tracks until the next track does not fit in the budget"""
+    result = []
+    total = 0
+    for t in tracks:
+        total += t[field]
+        if total > budget:
+            break
+        result.append(t)
+    return result
@@ -0,0 +1,184 @@
+"""
+Module to evaluate rules that are repeated across smart playlists only once
+"""
+
+import time
+from collections import Counter
+from typing import Dict, Hashable, List, Mapping
+
+from itunessmart.parse import SmartPlaylist
+from itunessmart.library import searchKey
+from itunessmart.evaluate import _compileSource, _ruleSource, _treeSource
+from itunessmart.optimize import optimizeRules
+from itunessmart.explain import _ruleOutput
+from itunessmart.patterns import PatternMatcher
+
+__all__ = ["RuleGraph"]
+
+
+class _Node:
+    """A distinct rule or group. Groups refer to the ids of their children"""
+
+    def __init__(self, nodeID, obj, operator=None, children=()):
+        self.id = nodeID
+        self.obj = obj
+        self.operator = operator
+        self.children = children
+        self.references = 0  # Number of occurrences in all playlists
+
+
+class RuleGraph:
+    """The rules of many playlists as one graph of distinct rules (hash-consing). Two rules are the same node if they compile
+    to the same Python expression, two groups are the same node if they have the same operator and the same children in any order.
+    Every node is evaluated once per run to a bitset of the track positions and the bitset is reused by all playlists that contain the node.
+    String rules on the same field are matched together with a PatternMatcher, so the field of each track is scanned once."""
+
+    def __init__(self, smartPlaylists: Mapping[Hashable, SmartPlaylist]):
+        """ Canonicalize the optimized rules of the playlists
+        :param smartPlaylists: mapping from a key, e.g. the playlist persistent ID, to the result of the parser
+        """
+        self.nodes = []  # List of _Node, children come before their groups
+        self.roots = {}  # Map key to the node id of the playlist, None for playlists without rules
+        self._ids = {}  # Map canonical key to node id
+        for key, smartPlaylist in smartPlaylists.items():
+            fulltree = optimizeRules(smartPlaylist.queryTree["fulltree"])
+            self.roots[key] = self._intern(fulltree) if fulltree else None
+        self.patternFields = {}  # Map field to the node ids of the string rules that are matched together
+        for node in self.nodes:
+            if node.operator is None and node.obj.get("type") == "string" and node.obj["field"] != "Kind":
+                self.patternFields.setdefault(node.obj["field"], []).append(node.id)
+        self.patternFields = {field: nodeIDs for field, nodeIDs in self.patternFields.items() if len(nodeIDs) > 1}
+        self._patternField = {nodeID: field for field, nodeIDs in self.patternFields.items() for nodeID in nodeIDs}
+        self.evaluations = 0  # Number of node evaluations of the last run
+        self.trackTests = 0  # Number of predicate calls of the last run
+        self.trackCount = 0  # Number of tracks of the last run
+
+    def _intern(self, obj):
+        """Return the id of the node for a rule or a group, create the node on first sight"""
+        if "and" in obj or "or" in obj:
+            operator = "and" if "and" in obj else "or"
+            children = tuple(sorted({self._intern(x) for x in obj[operator]}))
+            if len(children) == 1:
+                # The rules of the group are the same after canonicalization
+                return children[0]
+            key = (operator, children)
+        else:
+            operator = None
+            children = ()
+            key = _ruleSource(obj)
+        nodeID = self._ids.get(key)
+        if nodeID is None:
+            nodeID = self._ids[key] = len(self.nodes)
+            self.nodes.append(_Node(nodeID, obj, operator, children))
+        self.nodes[nodeID].references += 1
+        return nodeID
+
+    def evaluate(self, tracks: List[dict], now: float = None, playlists: Mapping = None) -> Dict[Hashable, List[int]]:
+        """ Return the TrackIDs of all tracks that match the rules of each playlist, see evaluateSmartPlaylist()
+        :param tracks: the track records, see createTrackRecords()
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, necessary for rules containing other playlists
+        :return: mapping from key to list of TrackIDs
+        :rtype: dict
+        """
+        if now is None:
+            now = time.time()
+        if playlists is None:
+            playlists = {}
+        everything = (1 << len(tracks)) - 1
+        bitsets = {}  # Map node id to bitset, bit i is the track at position i
+        self.evaluations = 0
+        self.trackTests = 0
+        self.trackCount = len(tracks)
+
+        def bitset(nodeID):
+            if nodeID not in bitsets:
+                if nodeID in self._patternField:
+                    field = self._patternField[nodeID]
+                    bitsets.update(self._patternBitsets(field, tracks))
+                    self.evaluations += len(self.patternFields[field])
+                else:
+                    bitsets[nodeID] = self._bitset(self.nodes[nodeID], bitset, tracks, now, playlists, everything)
+                    self.evaluations += 1
+            return bitsets[nodeID]
+
+        result = {}
+        for key, root in self.roots.items():
+            bits = everything if root is None else bitset(root)
+            positions = bin(bits)[:1:-1]
+            result[key] = [tracks[i]["TrackID"] for i, bit in enumerate(positions) if bit == "1"]
+        return result
+
+    def _bitset(self, node, bitset, tracks, now, playlists, everything):
+        if node.operator == "and":
+            bits = everything
+            for child in node.children:
+                bits &= bitset(child)
+                if not bits:
+                    break
+            return bits
+        if node.operator == "or":
+            bits = 0
+            for child in node.children:
+                bits |= bitset(child)
+                if bits == everything:
+                    break
+            return bits
+        predicate = _compileSource(_treeSource(node.obj))
+        self.trackTests += len(tracks)
+        digits = "".join("1" if predicate(t, now, playlists) else "0" for t in reversed(tracks))
+        return int(digits, 2) if digits else 0
+
+    def _patternBitsets(self, field, tracks):
+        """Scan each distinct value of the field once for all string rules on the field"""
+        nodeIDs = self.patternFields[field]
+        matcher = PatternMatcher([(self.nodes[nodeID].obj["operator"], searchKey(self.nodes[nodeID].obj["value"])) for nodeID in nodeIDs])
+        positions = {}
+        for i, t in enumerate(tracks):
+            positions.setdefault(t["SearchKeys"][field], []).append(i)
+        self.trackTests += len(tracks)
+        matches = [[] for _ in nodeIDs]
+        for value, valuePositions in positions.items():
+            for ruleID in matcher.match(value):
+                matches[ruleID].extend(valuePositions)
+        return {nodeID: _positionsBitset(matches[ruleID], len(tracks)) for ruleID, nodeID in enumerate(nodeIDs)}
+
+    def report(self, top: int = 10) -> str:
+        """ Describe how much work the sharing saves: the number of rules and groups in all playlists, the number of distinct nodes,
+        the evaluations of the last run and the rules that are shared most often
+        :param int top: Optional, number of shared rules to list
+        :return: the report
+        :rtype: str
+        """
+        references = sum(node.references for node in self.nodes)
+        rules = [node for node in self.nodes if node.operator is None]
+        ruleReferences = sum(node.references for node in rules)
+        lines = [
+            "Playlists: %d, rules and groups: %d, distinct: %d" % (len(self.roots), references, len(self.nodes)),
+            "Rules: %d, distinct: %d, saved: %d (%.0f%%)" % (ruleReferences, len(rules), ruleReferences - len(rules),
+                                                          100.0 * (ruleReferences - len(rules)) / ruleReferences if ruleReferences else 0.0)
+        ]
+        if self.evaluations:
+            lines.append("Last run: %d evaluations instead of %d, %d track tests instead of %d" % (
+                self.evaluations, references, self.trackTests, ruleReferences * self.trackCount))
+        if self.patternFields:
+            lines.append("Matched together: " + ", ".join("%s %d rules" % (field, len(nodeIDs)) for field, nodeIDs in sorted(self.patternFields.items())))
+        shared = Counter({node.id: node.references for node in self.nodes if node.references > 1})
+        if shared:
+            lines.append("Shared:")
+        for nodeID, count in shared.most_common(top):
+            node = self.nodes[nodeID]
+            if node.operator is None:
+                description = _ruleOutput(node.obj)
+            else:
+                description = "[%s of %d rules]" % ("all" if node.operator == "and" else "any", len(node.children))
+            lines.append("\t%dx %s" % (count, description))
+        return "\n".join(lines)
+
+
+def _positionsBitset(positions, n):
+    """Create a bitset from a list of track positions"""
+    bits = bytearray((n + 7) // 8)
+    for p in positions:
+        bits[p >> 3] |= 1 << (p & 7)
+    return int.from_bytes(bits, "little")
@@ -0,0 +1,241 @@
+"""
+Module to evaluate smart playlists with SQLite
+"""
+
+import time
+import sqlite3
+from typing import Iterable, List, Mapping, Tuple
+
+from itunessmart.data_structure import StringFields, IntFields, DateFields, BooleanFields
+from itunessmart.parse import SmartPlaylist
+from itunessmart.library import searchKey
+from itunessmart.evaluate import EvaluationException
+from itunessmart.optimize import optimizeRules
+from itunessmart.dependency import playlistDependencies
+
+__all__ = ["TrackDatabase"]
+
+_stringColumns = [field.name for field in StringFields] + ["SortArtist", "Uri"]
+_intColumns = [field.name for field in IntFields] + [field.name for field in DateFields]
+_boolColumns = [field.name for field in BooleanFields]
+_categoryColumns = ["MediaKind", "iCloudStatus", "Love", "Location"]
+
+# Columns that are indexed by default
+_indexedColumns = ["Artist", "AlbumArtist", "Album", "Genre", "Name", "Year", "Plays", "Rating", "DateAdded", "LastPlayed", "MediaKind"]
+
+
+def _successor(value):
+    """Smallest string that is greater than all strings starting with value. Surrogates are skipped, they cannot be encoded.
+    If there is no such string, i.e. value is empty or only consists of U+10FFFF, an empty BLOB is returned, it is greater than all strings"""
+    while value:
+        code = ord(value[-1]) + 1
+        if 0xd800 <= code <= 0xdfff:
+            code = 0xe000
+        if code <= 0x10ffff:
+            return value[:-1] + chr(code)
+        # Carry: the last character is the maximum, increment the previous one
+        value = value[:-1]
+    return b""
+
+
+def _escapeLike(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _single(value, now):
+    return (value, )
+
+
+def _pair(value, now):
+    return (value[0], value[1])
+
+
+def _relative(value, now):
+    return (now - value, )
+
+
+# (SQL, parameters) of the rules. {column} is the quoted column name
+_sqlRules = {
+    "string": {
+        "like": ("instr({column}, ?) > 0", _single),
+        "not like": ("instr({column}, ?) = 0", _single),
+        "is": ("{column} = ?", _single),
+        "is not": ("{column} != ?", _single),
+        "starts with": ("({column} >= ? AND {column} < ?)", lambda value, now: (value, _successor(value))),
+        "ends with": ("{column} LIKE ? ESCAPE '\\'", lambda value, now: ("%" + _escapeLike(value), ))
+    },
+    "int": {
+        "is": ("{column} = ?", _single),
+        "is not": ("{column} != ?", _single),
+        "greater than": ("{column} > ?", _single),
+        "less than": ("{column} < ?", _single),
+        "between": ("{column} BETWEEN ? AND ?", _pair)
+    },
+    "date": {
+        "is after": ("{column} > ?", _single),
+        "is before": ("{column} < ?", _single),
+        "is in the range": ("{column} BETWEEN ? AND ?", _pair),
+        "is not in the range": ("({column} IS NULL OR {column} NOT BETWEEN ? AND ?)", _pair),
+        "is in the last": ("{column} > ?", _relative),
+        "is not in the last": ("({column} IS NULL OR {column} < ?)", _relative)
+    },
+    "boolean": {
+        "is": ("{column} = ?", lambda value, now: (int(value), ))
+    },
+    "playlist": {
+        "is": ('"TrackID" IN (SELECT "TrackID" FROM playlist_items WHERE "PersistentID" = ?)', _single),
+        "is not": ('"TrackID" NOT IN (SELECT "TrackID" FROM playlist_items WHERE "PersistentID" = ?)', _single)
+    },
+    "kind": {
+        "like": ('"Uri" LIKE ? ESCAPE \'\\\'', lambda value, now: ("%" + _escapeLike(value), )),
+        "not like": ('"Uri" NOT LIKE ? ESCAPE \'\\\'', lambda value, now: ("%" + _escapeLike(value), ))
+    }
+}
+for _listtype in ("mediakind", "cloud", "love", "location"):
+    _sqlRules[_listtype] = {
+        "is": ("{column} = ?", _single),
+        "is not": ("{column} != ?", _single)
+    }
+
+
+class TrackDatabase:
+    """Track records in a SQLite database. The rules of a playlist are translated to parameterized SQL.
+    The SQL of a playlist only depends on the fields and operators of its rules, not on the values,
+    so playlists with the same shape share the translation and the prepared statement."""
+
+    def __init__(self, tracks: Iterable[dict] = None, filename: str = ":memory:"):
+        """ Open or create a database
+        :param tracks: Optional, track records to insert, see createTrackRecords()
+        :param str filename: Optional, database file, default is an in-memory database
+        """
+        self.connection = sqlite3.connect(filename, cached_statements=1024)
+        self._sqlByShape = {}
+        self._playlists = {}  # Map PlaylistPersistentId to the frozenset of TrackIDs in playlist_items
+        self._createTables()
+        if tracks is not None:
+            self.insertTracks(tracks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _createTables(self):
+        columns = ['"Position" INTEGER PRIMARY KEY', '"TrackID" INTEGER UNIQUE NOT NULL']
+        columns += ['"%s" TEXT' % column for column in _stringColumns + _categoryColumns]
+        columns += ['"%s" INTEGER' % column for column in _intColumns + _boolColumns]
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tracks (%s)" % ", ".join(columns))
+            self.connection.execute('CREATE TABLE IF NOT EXISTS playlist_items ("PersistentID" TEXT, "TrackID" INTEGER, PRIMARY KEY ("PersistentID", "TrackID")) WITHOUT ROWID')
+
+    def createIndex(self, column: str):
+        """Create an index on a column of the tracks table"""
+        if column not in _stringColumns + _categoryColumns + _intColumns + _boolColumns:
+            raise EvaluationException("Unknown column", column)
+        self.connection.execute('CREATE INDEX IF NOT EXISTS "tracks_%s" ON tracks ("%s")' % (column, column))
+
+    def insertTracks(self, tracks: Iterable[dict]):
+        """ Insert or update track records, an updated track keeps its position. The default indexes are created after the first insert.
+        String values are stored as search keys, because all string rules ignore the case, see searchKey()
+        :param tracks: the track records, see createTrackRecords()
+        """
+        columns = ["TrackID"] + _stringColumns + _categoryColumns + _intColumns + _boolColumns
+        lower = len(_stringColumns) + 1
+        rows = ([t["SearchKeys"][column] if 0 < i < lower else t[column] for i, column in enumerate(columns)] for t in tracks)
+        sql = 'INSERT INTO tracks (%s) VALUES (%s) ON CONFLICT ("TrackID") DO UPDATE SET %s' % (
+            ", ".join('"%s"' % column for column in columns), ", ".join("?" * len(columns)),
+            ", ".join('"%s" = excluded."%s"' % (column, column) for column in columns[1:]))
+        with self.connection:
+            empty = self.connection.execute("SELECT 1 FROM tracks LIMIT 1").fetchone() is None
+            self.connection.executemany(sql, rows)
+            if empty:
+                # Creating the indexes after the first insert is faster than updating them for each row
+                for column in _indexedColumns:
+                    self.createIndex(column)
+                self.connection.execute("ANALYZE")
+
+    def setPlaylist(self, persistentID: str, trackIDs: Iterable[int]):
+        """ Set the tracks of a playlist, necessary for rules containing other playlists. The table is only written if the tracks changed.
+        :param str persistentID: the playlist persistent ID
+        :param trackIDs: the TrackIDs of the playlist
+        """
+        members = trackIDs if isinstance(trackIDs, frozenset) else frozenset(trackIDs)
+        if self._playlists.get(persistentID) == members:
+            return
+        self._playlists[persistentID] = members
+        with self.connection:
+            self.connection.execute('DELETE FROM playlist_items WHERE "PersistentID" = ?', (persistentID, ))
+            self.connection.executemany('INSERT INTO playlist_items VALUES (?, ?)', ((persistentID, trackID) for trackID in members))
+
+    def translate(self, fulltree: dict, now: float = None) -> Tuple[str, list]:
+        """ Translate the rules to SQL
+        :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :return: tuple (sql, parameters)
+        :rtype: tuple
+        """
+        if now is None:
+            now = time.time()
+        params = []
+        shape = _shape(fulltree, now, params) if fulltree else "1"
+        try:
+            sql = self._sqlByShape[shape]
+        except KeyError:
+            sql = 'SELECT "TrackID" FROM tracks WHERE %s ORDER BY "Position"' % _shapeSql(shape)
+            self._sqlByShape[shape] = sql
+        return sql, params
+
+    def evaluate(self, smartPlaylist: SmartPlaylist, now: float = None, playlists: Mapping = None) -> List[int]:
+        """ Return the TrackIDs of all tracks that match the rules of the playlist, see evaluateSmartPlaylist()
+        :param SmartPlaylist smartPlaylist: the result of the parser
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, the playlists that the rules refer to are stored with setPlaylist()
+        :return: list of TrackIDs
+        :rtype: list
+        """
+        if playlists:
+            for persistentID in playlistDependencies(smartPlaylist.queryTree["fulltree"]):
+                if persistentID in playlists:
+                    self.setPlaylist(persistentID, playlists[persistentID])
+        sql, params = self.translate(optimizeRules(smartPlaylist.queryTree["fulltree"]), now)
+        return [row[0] for row in self.connection.execute(sql, params)]
+
+
+def _shape(obj, now, params):
+    """Return the shape of the rules, i.e. the rules without values, and collect the values in params"""
+    if "and" in obj or "or" in obj:
+        operator = "and" if "and" in obj else "or"
+        return (operator, tuple(_shape(x, now, params) for x in obj[operator]))
+
+    ruletype = obj.get("type")
+    field = obj.get("field")
+    operator = obj.get("operator")
+    value = obj.get("value")
+    if ruletype == "string" and field == "Kind":
+        if "kind_value" not in obj:
+            return "0" if operator not in ("not like", "is not") else "1"
+        ruletype, operator, value = "kind", obj["kind_operator"], obj["kind_value"]
+    elif ruletype == "string":
+        value = searchKey(value)
+
+    try:
+        sql, parameters = _sqlRules[ruletype][operator]
+    except KeyError:
+        raise EvaluationException("Unsupported rule", obj)
+    params.extend(parameters(value, now))
+    return (ruletype, field, operator)
+
+
+def _shapeSql(shape):
+    if isinstance(shape, str):
+        return shape
+    if shape[0] in ("and", "or"):
+        if not shape[1]:
+            return "1" if shape[0] == "and" else "0"
+        return "(%s)" % (" %s " % shape[0].upper()).join(_shapeSql(x) for x in shape[1])
+    ruletype, field, operator = shape
+    return _sqlRules[ruletype][operator][0].format(column='"%s"' % field)
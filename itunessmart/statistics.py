@@ -0,0 +1,218 @@
+"""
+Module to estimate the selectivity and the cost of rules from statistics of the tracks of a library
+"""
+
+import time
+import bisect
+import weakref
+from collections import Counter
+from typing import List, Mapping, Tuple
+
+from itunessmart.data_structure import StringFields
+from itunessmart.library import searchKey
+
+__all__ = ["FieldStatistics", "LibraryStatistics"]
+
+_frequentValues = 64  # Number of most common values with exact counts
+_buckets = 64  # Number of buckets of the equi-depth histograms
+_sampleSize = 1000  # Number of values to estimate string patterns
+
+_stringTests = {
+    "like": lambda s, value: value in s,
+    "starts with": lambda s, value: s.startswith(value),
+    "ends with": lambda s, value: s.endswith(value)
+}
+
+
+class FieldStatistics:
+    """Statistics of a field: number of tracks, missing values, distinct values, the most common values,
+    an equi-depth histogram of numbers and dates, and the average length and a sample of strings"""
+
+    def __init__(self, values: list):
+        """ Collect the statistics
+        :param values: the value of the field for each track, None for missing dates, strings as search keys
+        """
+        self.count = len(values)
+        present = [v for v in values if v is not None]
+        self.missing = self.count - len(present)
+        counter = Counter(present)
+        self.distinct = len(counter)
+        self.frequent = dict(counter.most_common(_frequentValues))
+        others = self.distinct - len(self.frequent)
+        self._otherCount = (len(present) - sum(self.frequent.values())) / others if others else 0
+
+        self.length = 0.0
+        self.sample = []
+        self.quantiles = []
+        if present and isinstance(present[0], str):
+            self.length = sum(len(v) for v in present) / len(present)
+            step = max(1, len(values) // _sampleSize)
+            self.sample = values[::step]
+        elif present and not isinstance(present[0], bool):
+            present.sort()
+            self.quantiles = [present[i * (len(present) - 1) // _buckets] for i in range(_buckets + 1)]
+
+    def equal(self, value) -> float:
+        """Estimated fraction of the tracks with the value"""
+        if not self.count:
+            return 0.0
+        if value in self.frequent:
+            return self.frequent[value] / self.count
+        return self._otherCount / self.count
+
+    def below(self, value, inclusive: bool = False) -> float:
+        """Estimated fraction of the tracks with a value less than (or equal to) value. Missing values are not counted"""
+        if not self.quantiles:
+            return 0.0
+        position = (bisect.bisect_right if inclusive else bisect.bisect_left)(self.quantiles, value)
+        return position / len(self.quantiles) * (self.count - self.missing) / self.count
+
+    def between(self, low, high) -> float:
+        """Estimated fraction of the tracks with low <= value <= high"""
+        return max(0.0, self.below(high, inclusive=True) - self.below(low))
+
+    def matching(self, operator: str, value: str) -> float:
+        """Estimated fraction of the tracks whose string value matches a like, starts with or ends with rule"""
+        if not self.sample:
+            return 0.0
+        test = _stringTests[operator]
+        matches = sum(1 for s in self.sample if test(s, value))
+        return (matches + 0.5) / (len(self.sample) + 1)
+
+
+class LibraryStatistics:
+    """Statistics of the track records of a library. The statistics of a field are collected on first use.
+    The estimates are used to reorder the rules of `and` and `or` groups, so the evaluation short-circuits early:
+    in `and` groups cheap rules that exclude many tracks come first, in `or` groups cheap rules that include many tracks."""
+
+    def __init__(self, tracks: List[dict], now: float = None, playlists: Mapping = None):
+        """ Create the statistics
+        :param tracks: the track records, see createTrackRecords()
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs, to estimate rules containing other playlists
+        """
+        self.tracks = tracks
+        self.now = time.time() if now is None else now
+        self.playlists = {} if playlists is None else playlists
+        self._fields = {}
+        self._predicates = weakref.WeakKeyDictionary()  # Map SmartPlaylist to the compiled predicate of the reordered rules
+
+    def field(self, name: str) -> FieldStatistics:
+        """Return the statistics of a field"""
+        if name not in self._fields:
+            if name in StringFields.__members__ or name == "Uri":
+                values = [t["SearchKeys"][name] for t in self.tracks]
+            else:
+                values = [t[name] for t in self.tracks]
+            self._fields[name] = FieldStatistics(values)
+        return self._fields[name]
+
+    def estimate(self, obj: dict) -> Tuple[float, float]:
+        """ Estimate a rule or a group of rules
+        :param dict obj: a rule or a group of rules of a fulltree
+        :return: tuple (selectivity, cost): the estimated fraction of the tracks that match and the relative cost of the evaluation per track
+        :rtype: tuple
+        """
+        _, selectivity, cost = self._plan(obj)
+        return selectivity, cost
+
+    def reorder(self, fulltree: dict) -> dict:
+        """ Reorder the rules of all groups by selectivity and cost. The result matches the same tracks. The tree is not modified.
+        :param dict fulltree: the parsed rules, smartPlaylist.queryTree["fulltree"]
+        :return: the new fulltree
+        :rtype: dict
+        """
+        if not fulltree:
+            return fulltree
+        return self._plan(fulltree)[0]
+
+    def _plan(self, obj):
+        """Return the reordered rules, the selectivity and the cost"""
+        if "and" in obj or "or" in obj:
+            operator = "and" if "and" in obj else "or"
+            children = [self._plan(x) for x in obj[operator]]
+            if operator == "and":
+                # Rank: cost per excluded track
+                children.sort(key=lambda c: c[2] / max(1.0 - c[1], 1e-6))
+            else:
+                # Rank: cost per included track
+                children.sort(key=lambda c: c[2] / max(c[1], 1e-6))
+            reach = 1.0  # Fraction of the tracks that are evaluated by the next rule
+            cost = 0.0
+            for _, selectivity, childCost in children:
+                cost += reach * childCost
+                reach *= selectivity if operator == "and" else 1.0 - selectivity
+            selectivity = reach if operator == "and" else 1.0 - reach
+            return {operator: [c[0] for c in children]}, selectivity, cost
+        return (obj, ) + self._estimateRule(obj)
+
+    def _estimateRule(self, obj):
+        ruletype = obj.get("type")
+        field = obj.get("field")
+        operator = obj.get("operator")
+        value = obj.get("value")
+
+        if ruletype == "string":
+            if field == "Kind":
+                if "kind_value" not in obj:
+                    return (1.0 if operator in ("not like", "is not") else 0.0), 0.0
+                statistics = self.field("Uri")
+                selectivity = statistics.matching("ends with", obj["kind_value"])
+                if obj["kind_operator"] == "not like":
+                    selectivity = 1.0 - selectivity
+                return selectivity, 1.0 + statistics.length / 16
+            statistics = self.field(field)
+            value = searchKey(value)
+            cost = 1.0 + statistics.length / 16
+            if operator == "is":
+                return statistics.equal(value), cost
+            if operator == "is not":
+                return 1.0 - statistics.equal(value), cost
+            if operator == "not like":
+                return 1.0 - statistics.matching("like", value), cost
+            if operator in _stringTests:
+                return statistics.matching(operator, value), cost
+
+        elif ruletype == "int":
+            statistics = self.field(field)
+            if operator == "is":
+                return statistics.equal(value), 1.0
+            if operator == "is not":
+                return 1.0 - statistics.equal(value), 1.0
+            if operator == "greater than":
+                return 1.0 - statistics.below(value, inclusive=True), 1.0
+            if operator == "less than":
+                return statistics.below(value), 1.0
+            if operator == "between":
+                return statistics.between(value[0], value[1]), 1.0
+
+        elif ruletype == "date":
+            statistics = self.field(field)
+            present = (statistics.count - statistics.missing) / statistics.count if statistics.count else 0.0
+            if operator == "is after":
+                return present - statistics.below(value, inclusive=True), 1.0
+            if operator == "is before":
+                return statistics.below(value), 1.0
+            if operator == "is in the range":
+                return statistics.between(value[0], value[1]), 1.0
+            if operator == "is not in the range":
+                return 1.0 - statistics.between(value[0], value[1]), 1.0
+            if operator == "is in the last":
+                return present - statistics.below(self.now - value, inclusive=True), 1.0
+            if operator == "is not in the last":
+                return 1.0 - present + statistics.below(self.now - value), 1.0
+
+        elif ruletype in ("boolean", "mediakind", "cloud", "love", "location"):
+            statistics = self.field(field)
+            if operator == "is":
+                return statistics.equal(value), 1.0
+            if operator == "is not":
+                return 1.0 - statistics.equal(value), 1.0
+
+        elif ruletype == "playlist":
+            selectivity = 0.5
+            if value in self.playlists and self.tracks:
+                selectivity = len(self.playlists[value]) / len(self.tracks)
+            return (selectivity if operator == "is" else 1.0 - selectivity), 1.5
+
+        return 0.5, 1.0
@@ -0,0 +1,168 @@
+"""
+Module to evaluate many smart playlists in a single pass over a stream of tracks
+"""
+
+import time
+import itertools
+from typing import Dict, Hashable, Iterable, List, Mapping
+
+from itunessmart.parse import SmartPlaylist
+from itunessmart.evaluate import compileSmartPlaylist, _compileSource, _treeSource
+from itunessmart.optimize import optimizeRules
+from itunessmart.selection import selectTracks, limitFields
+from itunessmart.dependency import playlistDependencies, ruleFields, _topologicalOrder
+
+__all__ = ["StreamEvaluator", "evaluateStream"]
+
+
+class _Query:
+    """A compiled playlist and its membership buffer"""
+
+    def __init__(self, key, smartPlaylist):
+        self.key = key
+        self.smartPlaylist = smartPlaylist
+        self.predicate = compileSmartPlaylist(smartPlaylist)
+        self.limited = "number" in smartPlaylist.queryTree
+        self.onlychecked = bool(smartPlaylist.queryTree.get("onlychecked"))
+        # Limited playlists keep the fields of the limit for each match, the other playlists only the TrackID
+        self.fields = sorted(limitFields(smartPlaylist) | {"TrackID"}) if self.limited else None
+        self.buffer = []
+        self.members = None  # Set of TrackIDs, if other playlists of the stream depend on this playlist
+        self.filters = None  # List of (predicate, playlists) to filter the candidates, if the playlist is resolved after the pass
+        self.searchKeys = None  # The search keys that the rules read, if the playlist is resolved after the pass
+
+
+class _Everything:
+    """Membership of a playlist that contains all tracks"""
+
+    def __contains__(self, item):
+        return True
+
+
+_everything = _Everything()
+_maxUnresolved = 3  # Test all memberships of the unresolved playlists only for at most 2 ** 3 combinations
+
+
+def _relaxRules(obj, unresolved):
+    """Replace the rules on unresolved playlists by true. There is no negation of groups, so the rules match all tracks that the original rules match"""
+    if "and" in obj or "or" in obj:
+        operator = "and" if "and" in obj else "or"
+        return {operator: [_relaxRules(x, unresolved) for x in obj[operator]]}
+    if obj.get("type") == "playlist" and obj["value"] in unresolved:
+        return {"and": []}
+    return obj
+
+
+class StreamEvaluator:
+    """Evaluate many smart playlists in a single pass over the tracks. All playlists are compiled at once,
+    each track is tested against all predicates and the matches are appended to a buffer per playlist, so the tracks
+    can be read from a stream, e.g. iterTrackRecords(), and the memory depends on the size of the playlists, not of the library.
+    Rules on a playlist of the stream are evaluated track by track in dependency order. The members of a limited playlist are only known
+    after the pass, so a playlist that depends on a limited playlist (directly or through other playlists) is deferred: it buffers the rule
+    fields of the tracks that can match for some membership of the unresolved playlists, and is resolved by result(), see the deferred attribute.
+    If it depends on more than 3 unresolved playlists, the candidates are the tracks that match when the rules on these playlists are true."""
+
+    def __init__(self, smartPlaylists: Mapping[Hashable, SmartPlaylist], now: float = None, playlists: Mapping = None):
+        """ Compile the playlists
+        :param smartPlaylists: mapping from playlist persistent ID (or another key) to the result of the parser
+        :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+        :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs for rules on playlists that are not in the stream
+        """
+        self.now = time.time() if now is None else now
+        self.count = 0  # Number of tracks
+        dependencies = {key: sorted(d for d in playlistDependencies(sp.queryTree["fulltree"]) if d in smartPlaylists) for key, sp in smartPlaylists.items()}
+        self._queries = [_Query(key, smartPlaylists[key]) for key in _topologicalOrder(dependencies, smartPlaylists)]
+
+        self._playlists = dict(playlists) if playlists is not None else {}
+        self.deferred = []  # Keys of the playlists that are resolved after the pass
+        unresolved = set()
+        for query in self._queries:
+            if any(d in unresolved for d in dependencies[query.key]):
+                self.deferred.append(query.key)
+                query.searchKeys = sorted(ruleFields(query.smartPlaylist.queryTree["fulltree"]))
+                query.fields = sorted(set(query.searchKeys) | limitFields(query.smartPlaylist) | {"TrackID", "Checked"})
+            if query.limited or query.key in unresolved or query.key in self.deferred:
+                unresolved.add(query.key)
+        queries = {query.key: query for query in self._queries}
+        for key in sorted(set().union(*dependencies.values()) - unresolved, key=str):
+            queries[key].members = set()
+            self._playlists[key] = queries[key].members
+        for key in self.deferred:
+            query = queries[key]
+            unknown = [d for d in dependencies[key] if d in unresolved]
+            if len(unknown) <= _maxUnresolved:
+                query.filters = []
+                for memberships in itertools.product((_everything, ()), repeat=len(unknown)):
+                    overlay = dict(self._playlists)
+                    overlay.update(zip(unknown, memberships))
+                    query.filters.append((query.predicate, overlay))
+            else:
+                relaxed = optimizeRules(_relaxRules(query.smartPlaylist.queryTree["fulltree"], set(unknown)))
+                query.filters = [(_compileSource(_treeSource(relaxed)), self._playlists)]
+
+    def add(self, track: dict):
+        """Test a track record against all playlists, see createTrackRecord()"""
+        now = self.now
+        playlists = self._playlists
+        for query in self._queries:
+            if query.filters is not None:
+                # Deferred, keep the fields of the track if it can match for some membership of the unresolved playlists
+                if any(predicate(track, now, overlay) for predicate, overlay in query.filters):
+                    candidate = {field: track[field] for field in query.fields if field in track}
+                    searchKeys = track["SearchKeys"]
+                    candidate["SearchKeys"] = {field: searchKeys[field] for field in query.searchKeys if field in searchKeys}
+                    query.buffer.append(candidate)
+                continue
+            if not query.predicate(track, now, playlists):
+                continue
+            if query.limited:
+                query.buffer.append({field: track[field] for field in query.fields})
+            elif not query.onlychecked or track["Checked"]:
+                query.buffer.append(track["TrackID"])
+                if query.members is not None:
+                    query.members.add(track["TrackID"])
+        self.count += 1
+
+    def run(self, tracks: Iterable[dict]) -> Dict[Hashable, List[int]]:
+        """ Add all tracks of the stream and return the result
+        :param tracks: iterable of track records, e.g. iterTrackRecords()
+        :return: mapping from key to list of TrackIDs
+        :rtype: dict
+        """
+        for track in tracks:
+            self.add(track)
+        return self.result()
+
+    def result(self) -> Dict[Hashable, List[int]]:
+        """ Return the TrackIDs of each playlist for the tracks that have been added, the limits are applied and the deferred playlists are resolved
+        :return: mapping from key to list of TrackIDs
+        :rtype: dict
+        """
+        result = {}
+        playlists = dict(self._playlists)
+        for query in self._queries:
+            if query.filters is not None:
+                matches = [t for t in query.buffer if query.predicate(t, self.now, playlists)]
+                if query.limited:
+                    result[query.key] = [t["TrackID"] for t in selectTracks(query.smartPlaylist, matches)]
+                else:
+                    result[query.key] = [t["TrackID"] for t in matches if not query.onlychecked or t["Checked"]]
+            elif query.limited:
+                result[query.key] = [t["TrackID"] for t in selectTracks(query.smartPlaylist, query.buffer)]
+            else:
+                result[query.key] = list(query.buffer)
+            if query.key not in playlists:
+                playlists[query.key] = set(result[query.key])
+        return result
+
+
+def evaluateStream(smartPlaylists: Mapping[Hashable, SmartPlaylist], tracks: Iterable[dict], now: float = None, playlists: Mapping = None) -> Dict[Hashable, List[int]]:
+    """ Evaluate many playlists in a single pass over a stream of tracks, see StreamEvaluator
+    :param smartPlaylists: mapping from playlist persistent ID (or another key) to the result of the parser
+    :param tracks: iterable of track records, e.g. iterTrackRecords()
+    :param float now: Optional, unix timestamp for "in the last" rules, default is the current time
+    :param playlists: Optional, mapping from playlist persistent ID to a set of TrackIDs for rules on playlists that are not in the stream
+    :return: mapping from key to list of TrackIDs
+    :rtype: dict
+    """
+    return StreamEvaluator(smartPlaylists, now, playlists).run(tracks)
@@ -2,19 +2,20 @@
 Module to convert from a parser result to a XSP playlist
 """
 import logging
-import copy
 import hashlib
 import unicodedata
 import re
 import html
 import os.path
 from collections.abc import Mapping
-from typing import Callable, List, Tuple
+from typing import BinaryIO, Callable, Hashable, List, Tuple
 
 from itunessmart.xsp_structure import *
 from itunessmart.parse import SmartPlaylist
+from itunessmart.optimize import optimizeRules, _key
+from itunessmart.output import atomicOpen, atomicWrite
 
-__all__ = ["createXSPFile", "createXSP", "PlaylistException", "EmptyPlaylistException"]
+__all__ = ["createXSPFile", "createXSP", "writeXSP", "SubPlaylistRegistry", "PlaylistException", "EmptyPlaylistException"]
 
 
 class PlaylistException(Exception):
@@ -25,6 +26,45 @@ class EmptyPlaylistException(PlaylistException):
     pass
 
 
+class SubPlaylistRegistry:
+    """Sub playlists of many playlists. Identical nested rules in different playlists create the same sub playlist.
+    Pass the same registry to createXSP() for all playlists and the XSP document of each distinct sub playlist is created once."""
+
+    def __init__(self):
+        self._groups = {}  # Map key of nested rules to the list of (operator, rules) that they create
+        self._documents = {}  # Map (prefix, operator, rules) to (name, document)
+        self.references = 0  # Number of sub playlists returned by createXSP()
+
+    def __len__(self):
+        """Number of distinct sub playlists"""
+        return len(self._documents)
+
+    def group(self, key: Hashable, build: Callable[[], List[tuple]]) -> List[tuple]:
+        """ Return the sub playlists of nested rules, they are built once per key
+        :param key: hashable key of the nested rules
+        :param build: function that returns the list of (operator, rules) of the sub playlists that the nested rules create
+        :return: list of (operator, rules)
+        :rtype: list
+        """
+        if key not in self._groups:
+            self._groups[key] = build()
+        return self._groups[key]
+
+    def document(self, operator: str, rules: str, prefix: str) -> Tuple[str, str]:
+        """ Return the name and the XSP document of a sub playlist, the document is created once per distinct sub playlist
+        :param str operator: the operator of the rules of the sub playlist, and or or
+        :param str rules: the XML rules of the sub playlist
+        :param str prefix: prefix of the name of the sub playlist
+        :return: tuple (name, document)
+        :rtype: tuple
+        """
+        self.references += 1
+        key = (prefix, operator, rules)
+        if key not in self._documents:
+            self._documents[key] = _subPlaylist(operator, rules, prefix)
+        return self._documents[key]
+
+
 def createXSPFile(directory: str, name: str, smartPlaylist: SmartPlaylist, createSubplaylists: bool = True, persistentIDMapping: dict = None, friendlyFilename: Callable[[str], str] = None) -> List[str]:
     """ Create XSP playlist file(s) from the parser result queryTree, returns a list of filenames of the generates files
     :param str directory: the output directory
@@ -38,59 +78,75 @@ def createXSPFile(directory: str, name: str, smartPlaylist: SmartPlaylist, creat
     """
 
     if friendlyFilename is None:
-        friendlyFilename = lambda name: re.sub(r'[^\w\s-]', '', unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode("utf-8")).strip()
+        friendlyFilename = _friendlyFilename
 
     r = []
-    for playlistname, content in createXSP(name=name, smartPlaylist=smartPlaylist, createSubplaylists=createSubplaylists, persistentIDMapping=persistentIDMapping):
-        filename = friendlyFilename(playlistname) + ".xsp"
-        filepath = os.path.join(directory, filename)
-        with open(filepath, "wb") as f:
-            f.write(content.encode("utf-8"))
-        logging.info(filename)
-        r.append(filename)
+    filename = friendlyFilename(name) + ".xsp"
+    # The playlist is written to a temporary file, it replaces the file after the sub playlists are written
+    with atomicOpen(os.path.join(directory, filename)) as f:
+        subdocuments = writeXSP(f, name=name, smartPlaylist=smartPlaylist, createSubplaylists=createSubplaylists, persistentIDMapping=persistentIDMapping)
+        for playlistname, content in subdocuments:
+            subfilename = friendlyFilename(playlistname) + ".xsp"
+            atomicWrite(os.path.join(directory, subfilename), content.encode("utf-8"))
+            logging.info(subfilename)
+            r.append(subfilename)
+    logging.info(filename)
+    r.append(filename)
 
     return r
 
 
-def createXSP(name: str, smartPlaylist: SmartPlaylist, createSubplaylists: bool = True, persistentIDMapping: dict = None, subPlaylistPrefix: str = "zzzsub_") -> List[Tuple[str, str]]:
+def _friendlyFilename(name):
+    """Default filename of a playlist: ASCII letters, digits, whitespace, underscores and hyphens"""
+    return re.sub(r'[^\w\s-]', '', unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode("utf-8")).strip()
+
+
+def createXSP(name: str, smartPlaylist: SmartPlaylist, createSubplaylists: bool = True, persistentIDMapping: dict = None, subPlaylistPrefix: str = "zzzsub_", subPlaylists: SubPlaylistRegistry = None) -> List[Tuple[str, str]]:
     """ Create XSP playlist(s) from the parser result queryTree, returns a list of tuples (playlist_name, xml_content)
     :param str name: the new name of the playlist
     :param SmartPlaylist smartPlaylist: the result of the parser
     :param bool createSubplaylists: if true subplaylists are created for nested rules/query, if false nestes rules are ommited
     :param persistentIDMapping: Optional, necessary for rules containing other playlists
     :param subPlaylistPrefix: Prefix for name of sub playlists (prefix is followed by the md5 hash of the subplaylist xml)
+    :param SubPlaylistRegistry subPlaylists: Optional, sub playlists that were already created for other playlists, they are reused
     :return: list of tuples: (playlist_name, xml_content)
     :rtype: list
     """
 
+    subdocuments = []
+    document = "".join(_renderXSP(name, smartPlaylist, createSubplaylists, persistentIDMapping, subPlaylistPrefix, subPlaylists, subdocuments))
+    subdocuments.append((name, document))
+    return subdocuments
+
+
+def writeXSP(sink: BinaryIO, name: str, smartPlaylist: SmartPlaylist, createSubplaylists: bool = True, persistentIDMapping: dict = None, subPlaylistPrefix: str = "zzzsub_", subPlaylists: SubPlaylistRegistry = None) -> List[Tuple[str, str]]:
+    """ Write the XSP playlist to a binary file, one rule after another, instead of creating the whole document first. See createXSP()
+    :param sink: a binary file object, e.g. a buffered file or io.BytesIO()
+    :return: list of tuples: (playlist_name, xml_content) of the sub playlists, they are not written to the sink
+    :rtype: list
+    """
+
+    subdocuments = []
+    for chunk in _renderXSP(name, smartPlaylist, createSubplaylists, persistentIDMapping, subPlaylistPrefix, subPlaylists, subdocuments):
+        sink.write(chunk.encode("utf-8"))
+    return subdocuments
+
+
+def _renderXSP(name, smartPlaylist, createSubplaylists, persistentIDMapping, subPlaylistPrefix, subPlaylists, subdocuments):
+    """Generate the XML of the playlist piece by piece, the sub playlists are appended to subdocuments"""
+
     if persistentIDMapping is None:
         persistentIDMapping = {}
 
     queryTree = smartPlaylist.queryTree
-    fulltree = copy.deepcopy(queryTree["fulltree"])
+    fulltree = queryTree["fulltree"]
 
     if not fulltree:
         raise EmptyPlaylistException("Playlist is empty", name)
 
-    if "and" in fulltree:
-        globalmatch = "and"
-    else:
-        globalmatch = "or"
-
-    f = _minimize(_combineRules(fulltree, persistentIDMapping, createSubplaylists))
-
-    if f:
-        y = _convertRule(f, depth=0, docs=[])
-        if len(y) == 3:
-            # Complete doc
-            globalmatch, rules, subplaylists = y
-        else:
-            # Only one rule
-            globalmatch = "and"
-            rules = y
-            subplaylists = []
+    f = _minimize(_combineRules(optimizeRules(fulltree), persistentIDMapping, createSubplaylists))
 
-    else:
+    if not f:
         raise PlaylistException("Playlist is incompatible. All of the rules are incompatible with XSP format", name)
 
     limit = ('    <limit>%d</limit>' % queryTree['number']) if 'number' in queryTree else ''
@@ -103,43 +159,70 @@ def createXSP(name: str, smartPlaylist: SmartPlaylist, createSubplaylists: bool
 
     meta = limit + '\n' + order
 
-    r = []
-    if createSubplaylists and subplaylists:
-        for sub_globalmatch, sub_rules in subplaylists:
-            sub_name = subPlaylistPrefix + hashlib.md5(sub_rules.encode('utf-8')).hexdigest()
-            subdocument = xml_doc.format(dec=xml_dec, name=_escapeHTML(sub_name), globalmatch=xsp_operators[sub_globalmatch], rules=sub_rules, meta="")
-            rules += "\n" + xml_rule.format(field="playlist", operator="is", values=xml_value.format(value=_escapeHTML(sub_name)))
-            r.append((sub_name, subdocument))
+    head, _, tail = xml_doc.partition("{rules}")
+    docs = []
+    if isinstance(f, tuple) and f[1]:
+        # Complete doc
+        yield head.format(dec=xml_dec, name=_escapeHTML(name), globalmatch=xsp_operators[f[0]])
+        first = True
+        for x in f[1]:
+            y = _convertRule(obj=x, depth=1, docs=docs, subPlaylists=subPlaylists)
+            if y:
+                yield y if first else "\n" + y
+                first = False
+    else:
+        # Only one rule
+        yield head.format(dec=xml_dec, name=_escapeHTML(name), globalmatch=xsp_operators["and"])
+        yield _convertRule(f, depth=0, docs=docs, subPlaylists=subPlaylists)
+
+    if createSubplaylists and docs:
+        for sub_globalmatch, sub_rules in docs:
+            if subPlaylists is None:
+                sub_name, subdocument = _subPlaylist(sub_globalmatch, sub_rules, subPlaylistPrefix)
+            else:
+                sub_name, subdocument = subPlaylists.document(sub_globalmatch, sub_rules, subPlaylistPrefix)
+            subdocuments.append((sub_name, subdocument))
+            yield "\n" + xml_rule.format(field="playlist", operator="is", values=xml_value.format(value=_escapeHTML(sub_name)))
 
-    document = xml_doc.format(dec=xml_dec, name=_escapeHTML(name), globalmatch=xsp_operators[globalmatch], rules=rules, meta=meta)
+    yield tail.format(meta=meta)
 
-    r.append((name, document))
 
-    return r
+def _subPlaylist(globalmatch, rules, prefix):
+    """Create the name and the document of a sub playlist"""
+    name = prefix + hashlib.md5(rules.encode('utf-8')).hexdigest()
+    return name, xml_doc.format(dec=xml_dec, name=_escapeHTML(name), globalmatch=xsp_operators[globalmatch], rules=rules, meta="")
+
+
+_maxIsValues = 100  # Longest int range that is converted to an "is" rule with many values
 
 
-def _combineRules(obj, persistentIDMapping, createSubplaylists):
-    """Remove incompatible rules and combine similar rules"""
+def _combineRules(obj, persistentIDMapping, createSubplaylists, parent=None):
+    """Remove incompatible rules and combine similar rules. The rules are not modified, changed rules are new dicts"""
     if "and" in obj or "or" in obj:
         result = []
         for operator in obj:
             t = (operator, [])
+            combined = {}  # Map (field, operator) to (position in t[1], values) of the first rule of an "or"
             for x in obj[operator]:
-                y = _combineRules(x, persistentIDMapping, createSubplaylists)
-                if y:
+                y = _combineRules(x, persistentIDMapping, createSubplaylists, operator)
+                # A range that became two rules with the same operator as this group does not need a sub playlist
+                for z in (y[1] if isinstance(y, tuple) and y[0] == operator else [y]):
+                    if not z:
+                        continue
 
                     # combine with existing rule
-                    combined = False
-                    if operator == "or" and isinstance(y, Mapping):
-                        for r in t[1]:
-                            if isinstance(r, Mapping) and r["field"] == y["field"] and r["operator"] == y["operator"]:
-                                if not isinstance(r["value"], list):
-                                    r["value"] = [r["value"]]
-                                r["value"].append(y["value"])
-                                combined = True
-                                break
-                    if not combined:
-                        t[1].append(y)
+                    if operator == "or" and isinstance(z, Mapping):
+                        key = (z["field"], z["operator"])
+                        if key in combined:
+                            combined[key][1].extend(z["value"] if isinstance(z["value"], list) else [z["value"]])
+                            continue
+                        combined[key] = (len(t[1]), [])
+                    t[1].append(z)
+
+            for position, values in combined.values():
+                if values:
+                    r = t[1][position]
+                    t[1][position] = dict(r, value=(list(r["value"]) if isinstance(r["value"], list) else [r["value"]]) + values)
 
             if len(t[1]) > 1:
                 result.append((operator, t[1]))
@@ -150,23 +233,18 @@ def _combineRules(obj, persistentIDMapping, createSubplaylists):
         if obj["field"] not in xsp_allowed_fields:
             return None
 
+        # optimizeRules() has replaced ranges with one value by "is" and "is not" rules
         if obj["operator"] == "between":
-            if obj["value"][0] == obj["value"][1]:
-                # return "is" the first value if both vaules are the same e.g. Rating BETWEEN 4 AND 4
-                obj["operator"] = "is"
-                obj["value"] = obj["value"][0]
-                return obj
+            low, high = obj["value"]
+            if parent == "or" and obj.get("type") == "int" and high - low < _maxIsValues:
+                # A short range in an "or", e.g. merged from `Rating is 4 or Rating is 5`, is one rule with a value for each number
+                return dict(obj, operator="is", value=list(range(low, high + 1)))
             return ('and', [
                 {'field': obj["field"], 'operator': 'greater than', 'value': obj["value"][0] - 1},
                 {'field': obj["field"], 'operator': 'less than', 'value': obj["value"][1] + 1}
                 ])
         elif obj["operator"] == "not between":
-             if obj["value"][0] == obj["value"][1]:
-                # return "is not" the first value if both values are the same
-                obj["operator"] = "is not"
-                obj["value"] = obj["value"][0]
-                return obj
-             return ('and', [
+            return ('or', [
                 {'field': obj["field"], 'operator': 'less than', 'value': obj["value"][0]},
                 {'field': obj["field"], 'operator': 'greater than', 'value': obj["value"][1]}
                 ])
@@ -177,7 +255,7 @@ def _combineRules(obj, persistentIDMapping, createSubplaylists):
         if obj["field"] == "PlaylistPersistentID":
             if obj["value"] in persistentIDMapping:
                 # Replace PersistentID with playlistname
-                obj["value"] = persistentIDMapping[obj["value"]]
+                obj = dict(obj, value=persistentIDMapping[obj["value"]])
                 if not createSubplaylists:
                     try:
                         logging.warning("# Playlist dependency ignored: Depends on '%s'" % obj["value"])
@@ -234,31 +312,26 @@ def _escapeHTML(x):
     return [_escapeHTML(i) for i in x]
 
 
-def _convertRule(obj, depth, docs):
+def _convertRule(obj, depth, docs, subPlaylists=None):
     """Create XML rules"""
 
     if isinstance(obj, tuple):
         if not obj[1]:
             return ""
-        operator = obj[0]
-        rules = []
-        for x in obj[1]:
-            y = _convertRule(obj=x, depth=depth+1, docs=docs)
-            if y:
-                rules.append(y)
-        if depth > 0:
-            docs.append((operator, "\n".join(rules)))
+        if depth > 0 and subPlaylists is not None:
+            # Nested rules and the sub playlists inside them are converted once per registry
+            def build():
+                entries = []
+                _convertGroup(obj, depth, entries, subPlaylists)
+                return entries
+            docs.extend(subPlaylists.group(_key(obj), build))
             return ""
-        else:
-            return operator, "\n".join(rules), docs
+        return _convertGroup(obj, depth, docs, subPlaylists)
 
     elif isinstance(obj, dict):
-        if "value_date" in obj:
-            obj["value"] = obj["value_date"]
-        if not isinstance(obj["value"], list):
-            obj["value"] = [obj["value"]]
+        value = obj["value_date"] if "value_date" in obj else obj["value"]
         values = []
-        for value in obj["value"]:
+        for value in (value if isinstance(value, list) else [value]):
             values.append(xml_value.format(value=_escapeHTML(value)))
         values = "\n".join(values)
         return xml_rule.format(field=xsp_fields[obj["field"]], operator=xsp_operators[obj["operator"]], values=values)
@@ -266,10 +339,25 @@ def _convertRule(obj, depth, docs):
     elif isinstance(obj, list):
         rules = []
         for x in obj:
-            y = _convertRule(obj=x, depth=depth, docs=docs)
+            y = _convertRule(obj=x, depth=depth, docs=docs, subPlaylists=subPlaylists)
             if y:
                 rules.append(y)
         return "\n".join(rules)
 
     else:
         raise PlaylistException("Unknown obj type", repr(obj))
+
+
+def _convertGroup(obj, depth, docs, subPlaylists):
+    """Create XML rules of a group, nested groups are added to docs"""
+    operator = obj[0]
+    rules = []
+    for x in obj[1]:
+        y = _convertRule(obj=x, depth=depth+1, docs=docs, subPlaylists=subPlaylists)
+        if y:
+            rules.append(y)
+    if depth > 0:
+        docs.append((operator, "\n".join(rules)))
+        return ""
+    else:
+        return operator, "\n".join(rules), docs
@@ -0,0 +1,1159 @@
+import os
+import math
+import base64
+import types
+import random
+
+try:
+    import itunessmart
+except ImportError:
+    import sys
+    include = os.path.relpath(os.path.join(os.path.dirname(__file__), ".."))
+    sys.path.insert(0, include)
+    import itunessmart
+    print("Imported itunessmart from %s" % os.path.abspath(os.path.join(include, "itunessmart")))
+
+NOW = 1510000000
+DAY = 86400
+
+testdata = {
+    "strings": {
+        "desc": "Only Stringfield",
+        "info": ("AQEAAwAAAAIAAAAZAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEcBAAABAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAUAEIAZQBlAG4AaQBlACAATQBhAG4AAAAD"
+                  "AQAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAGABB"
+                  "AHIAdAAgAGEAbgBkACAATABpAGYAZQ==")
+    },
+    "intrange_notlike": {
+        "desc": "int range: 512 - 999999,  string: Whatever",
+        "info": ("AQEAAwAAAAIAAAAZAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABYAAAEAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABEAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAPQj8AAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAADAwAAAgAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEABXAGgAYQB0"
+                  "AGUAdgBlAHI=")
+    },
+    "playlist": {
+        "desc": "Playlist is PersistentID",
+        "info": ("AQEAAgAAAAIAAAAAAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACgAAAABAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABEInHfMHVNPhoAAAAAAAAAAAAAAAAAAAAB"
+                  "InHfMHVNPhoAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+    },
+    "inthelast": {
+        "desc": "date added: in the last 1 weeks",
+        "info": ("AQEAAwAAAAIAAAAZAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAAAAIAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABELa4tri2uLa7//////////wAAAAAACTqA"
+                  "La4tri2uLa4AAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+    },
+    "nested": {
+        "desc": "Sub expression: Plays > 15 ANY:(  PLAYS > 16 AND PLAYS > 17 ) RATING > 4",
+        "info": ("AQEAAwAAAAIAAAAZAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAADAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABYAAAAQAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABEAAAAAAAAAA8AAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAAAA8AAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAQEA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAB/FNMc3QAAQAB"
+                  "AAAAAwAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAWAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAQ"
+                  "AAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAFgAAABAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEQAAAAAAAAAEQAAAAAAAAAA"
+                  "AAAAAAAAAAEAAAAAAAAAEQAAAAAAAAAAAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "ABYAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABE"
+                  "AAAAAAAAABIAAAAAAAAAAAAAAAAAAAABAAAAAAAAABIAAAAAAAAAAAAAAAAAAAABAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAZAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAARAAAAAAAAABZAAAAAAAAAAAAAAAAAAAAAQAAAAAAAABZAAAAAAAA"
+                  "AAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAA")
+    },
+    "startsends": {
+        "desc": "Album starts with `Sól` or Album ends with `IDo` (Exclude unchecked items)",
+        "info": ("AQEAAwAAAAIAAAAZAQAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAGAU0xzdAABAAEAAAACAAAAAQAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAADwAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAABEAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA8AAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAg"
+                  "AAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEBAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAQRTTHN0AAEAAQAAAAIAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAwEAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAYAUwDzAGwAAAADAQAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAABgBJAEQAbw==")
+    },
+    "limit_items": {
+        "desc": "BPM is 60 or BPM is in the range of 70 to 80 (Limited to 25 Items selected by highest rated, exclude unchecked items)",
+        "info": ("AQEBAwAAABwAAAAZAQAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAGAU0xzdAABAAEAAAACAAAAAQAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAADwAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAABEAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA8AAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAg"
+                  "AAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEBAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAYBTTHN0AAEAAQAAAAIAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAIwAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAEQAAAAAAAAAPAAAAAAAAAAAAAAAAAAAAAEAAAAAAAAAPAAAAAAAAAAA"
+                  "AAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACMAAAEAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABEAAAAAAAAAEYAAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAAAFAAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+    },
+    "mixed": {
+        "desc": "BPM is not 60 or PlaylistPersistentID is not CF3419CE9A5B19E2 or LastPlayed is before 2017-10-06 or DateModified is not in the last 3 days or BitRate is 128 or Love is Loved Limited to 25 Items selected by random Exclude unchecked items",
+        "info": ("AQEBAwAAAAIAAAAZAQAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAGAU0xzdAABAAEAAAACAAAAAQAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAADwAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAABEAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA8AAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAg"
+                  "AAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEBAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA+xTTHN0AAEAAQAAAAcAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAIwIAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAEQAAAAAAAAAPAAAAAAAAAAAAAAAAAAAAAEAAAAAAAAAPAAAAAAAAAAA"
+                  "AAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACgCAAABAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABEzzQZzppbGeIAAAAAAAAAAAAAAAAAAAAB"
+                  "zzQZzppbGeIAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAXAAAAQAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAADV/HgA"
+                  "AAAAAAAAAAAAAAAAAAAAAQAAAADV/HgAAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAKQAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAEQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAoCAAIAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAABELa4tri2uLa7//////////QAAAAAAAVGALa4tri2u"
+                  "La4AAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAFAAAAAQAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAAAAAACAAAAAAAAA"
+                  "AAAAAAAAAAAAAQAAAAAAAACAAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAmgAAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AEQAAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAEAAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAEAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAA==")
+    },
+    "limit_sortartist": {
+        "desc": "order by ",
+        "info": ("AQEBAwAAAAcAAAAZAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAACAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABAQAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAGAU0xzdAABAAEAAAACAAAAAQAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAADwAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAABEAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAABAAAAAAAAAAEAAAAAAAAAAAAAAAAAAAAB"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA8AAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAARAAAAAAAAAAgAAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAg"
+                  "AAAAAAAAAAAAAAAAAAAAAQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAEBAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAWRTTHN0AAEAAQAAAAMAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAARwEAAAgAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAgAQwBoAGkAcAAAAAMBAAAEAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAmAEwAZQBhAGcAdQBlACAAbwBmACAATQB5ACAATwB3"
+                  "AG4AIABJAEkAAAADAwAAAgAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAABgBJAEkASQ==")
+    },
+    "limit_mb_random": {
+        "desc": "date added: not in the last 1 months,  Limit to 9876 MB selected by RANDOM",
+        "info": ("AQEBAgAAAAIAACaUAAAAAAAAAAcAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAA=="),
+        "criteria": ("U0xzdAABAAEAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABACAAIAAAAAAAAAAAAAAAAAAAAAAAAA"
+                  "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABELa4tri2uLa7//////////wAAAAAAKBmg"
+                  "La4tri2uLa4AAAAAAAAAAAAAAAAAAAABAAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+    }
+}
+
+# Reference implementations of the playlists in testdata, written by hand
+reference = {
+    "strings": lambda t: t["AlbumArtist"].lower() == "beenie man" and t["Album"].lower() == "art and life",
+    "intrange_notlike": lambda t: 512 <= t["Plays"] <= 999999 and "whatever" not in t["Album"].lower(),
+    "inthelast": lambda t: t["DateAdded"] is not None and NOW - t["DateAdded"] < 7 * DAY,
+    "nested": lambda t: t["Plays"] > 15 and (t["Plays"] > 16 or t["Plays"] > 17 or t["Plays"] > 18) and t["Rating"] > 4,
+    "startsends": lambda t: t["MediaKind"] in ("Music", "Music Video") and (t["Album"].lower().startswith("sól") or t["Album"].lower().endswith("ido")),
+    "limit_items": lambda t: t["MediaKind"] in ("Music", "Music Video") and (t["BPM"] == 60 or 70 <= t["BPM"] <= 80),
+    "mixed": lambda t: t["MediaKind"] in ("Music", "Music Video") and (
+        t["BPM"] != 60 or
+        t["TrackID"] not in PLAYLISTS["CF3419CE9A5B19E2"] or
+        (t["LastPlayed"] is not None and t["LastPlayed"] < 1507248000) or
+        not t["Purchased"] or
+        t["DateModified"] is None or NOW - t["DateModified"] > 3 * DAY or
+        t["BitRate"] == 128 or
+        t["Love"] == "Loved"),
+    "limit_sortartist": lambda t: t["MediaKind"] in ("Music", "Music Video") and t["AlbumArtist"].lower().endswith("chip") and t["Album"].lower().startswith("league of my own ii") and "iii" not in t["Album"].lower(),
+    "playlist": lambda t: t["TrackID"] in PLAYLISTS["2271DF30754D3E1A"],
+    "limit_mb_random": lambda t: t["DateAdded"] is None or NOW - t["DateAdded"] > 2628000,
+}
+
+PLAYLISTS = {"CF3419CE9A5B19E2": {2, 3, 5, 7, 11, 13}, "2271DF30754D3E1A": {1, 2, 3, 4, 5}}
+
+
+def randomLibrary(n, seed=1):
+    """Create a library with n random tracks"""
+    rnd = random.Random(seed)
+    artists = ["Beenie Man", "Chip", "Sólstafir", "Adele", "Gnarls Barkley", "Santogold", "ZZ Ward"]
+    albums = ["Art and Life", "League of My Own II", "League of My Own III", "Sól", "Kveðja IDo", "Whatever", "21", "St. Elsewhere"]
+    genres = ["Hip-Hop/Rap", "Reggae", "Metal", "Pop", "Jazz"]
+    kinds = ["MPEG audio file", "AAC audio file", "Protected AAC audio file"]
+    tracks = {}
+    for i in range(1, n + 1):
+        artist = rnd.choice(artists)
+        track = {
+            "Track ID": i,
+            "Name": "Track %d" % i,
+            "Artist": artist,
+            "Album Artist": artist,
+            "Album": rnd.choice(albums),
+            "Genre": rnd.choice(genres),
+            "Kind": rnd.choice(kinds),
+            "Size": rnd.randint(1000000, 20000000),
+            "Total Time": rnd.randint(60000, 600000),
+            "Year": rnd.randint(1970, 2017),
+            "BPM": rnd.choice([0, 60, 70, 75, 80, 120]),
+            "Bit Rate": rnd.choice([128, 256, 320]),
+            "Date Added": NOW - rnd.randint(0, 60 * DAY),
+            "Date Modified": NOW - rnd.randint(0, 10 * DAY),
+            "Location": "file://localhost/Music/%d.mp3" % i,
+        }
+        if rnd.random() < 0.8:
+            track["Play Count"] = rnd.randint(1, 30)
+            track["Play Date UTC"] = NOW - rnd.randint(0, 90 * DAY)
+        if rnd.random() < 0.7:
+            track["Rating"] = rnd.choice([20, 40, 60, 80, 100])
+        if rnd.random() < 0.1:
+            track["Podcast"] = True
+        if rnd.random() < 0.2:
+            track["Purchased"] = True
+        if rnd.random() < 0.2:
+            track["Loved"] = True
+        if rnd.random() < 0.1:
+            track["Disabled"] = True
+        if rnd.random() < 0.3:
+            track["Comments"] = rnd.choice(["#completealbum", "#completeep", "live", "Remastered #CompleteAlbum"])
+        tracks[str(i)] = track
+    return {"Tracks": tracks, "Playlists": []}
+
+
+def smartPlaylistEntry(name, persistentID, key, parentPersistentID=None, replacePersistentID=None):
+    """Create a smart playlist entry for the library from testdata"""
+    criteria = base64.standard_b64decode(testdata[key]["criteria"])
+    if replacePersistentID:
+        criteria = criteria.replace(bytes.fromhex("2271DF30754D3E1A"), bytes.fromhex(replacePersistentID))
+    playlist = {
+        "Name": name,
+        "Playlist Persistent ID": persistentID,
+        "Smart Info": base64.standard_b64decode(testdata[key]["info"]),
+        "Smart Criteria": criteria
+    }
+    if parentPersistentID:
+        playlist["Parent Persistent ID"] = parentPersistentID
+    return playlist
+
+
+def playlistLibrary(n):
+    """Create a library with random tracks and playlists that depend on each other"""
+    library = randomLibrary(n)
+    library["Playlists"] = [
+        {"Name": "Library", "Master": True, "Playlist Persistent ID": "E48098B57CA4D12E",
+            "Playlist Items": [{"Track ID": t["Track ID"]} for t in library["Tracks"].values()]},
+        {"Name": "Folder", "Folder": True, "Playlist Persistent ID": "2271DF30754D3E1A"},
+        {"Name": "Static", "Playlist Persistent ID": "CF3419CE9A5B19E2", "Parent Persistent ID": "2271DF30754D3E1A",
+            "Playlist Items": [{"Track ID": i} for i in (13, 11, 7, 5, 3, 2)]},
+        smartPlaylistEntry("Nested", "0000000000000003", "nested", parentPersistentID="2271DF30754D3E1A"),
+        smartPlaylistEntry("Mixed", "0000000000000004", "mixed"),
+        smartPlaylistEntry("Playlist is Folder", "0000000000000005", "playlist"),
+    ]
+    return library
+
+
+def readLibrary(filename):
+    path = os.path.join(os.path.dirname(__file__), filename)
+    with open(path, "rb") as fs:
+        library = itunessmart.readiTunesLibrary(fs)
+    return library
+
+
+def test_track_record(verbose=False):
+    library = readLibrary("library_minimal.xml")
+    records = itunessmart.createTrackRecords(library)
+    assert [t["TrackID"] for t in records] == [1, 2]
+
+    record = records[0]
+    assert record["Name"] == "League of My Own (The Intro)"
+    assert record["SortName"] == record["Name"]
+    assert record["AlbumArtist"] == "Chip"
+    assert record["Duration"] == 262708
+    assert record["Plays"] == 0
+    assert record["Rating"] == 0
+    assert record["LastPlayed"] is None
+    assert record["Comments"] == ""
+    assert record["Checked"] is True
+    assert record["MediaKind"] == "Music"
+    assert record["Love"] == "None"
+    assert record["Location"] == "Computer"
+
+    record = itunessmart.createTrackRecord({"Track ID": 5, "Rating": 80, "Loved": True, "Disabled": True, "Podcast": True, "Track Type": "Remote"})
+    assert record["Rating"] == 4
+    assert record["Love"] == "Loved"
+    assert record["Checked"] is False
+    assert record["MediaKind"] == "Podcast"
+    assert record["Podcast"] == 1
+    assert record["Location"] == "iCloud"
+
+    record = itunessmart.createTrackRecord({"Track ID": 6, "Rating": 80, "Rating Computed": True})
+    assert record["Rating"] == 0
+
+
+def test_search_keys(verbose=False):
+    assert itunessmart.searchKey("Straße") == "strasse"
+    assert itunessmart.searchKey("ﬁle ＡＢＣ") == "file abc"
+
+    records = [itunessmart.createTrackRecord({"Track ID": i, "Name": name, "Album": album}) for i, (name, album) in enumerate([
+        ("Die Straße", "Café"), ("STRASSE", "Cafe\u0301"), ("ﬁre", "ＣＡＦＥ"), ("Fire", "cafe")], start=1)]
+    assert records[0]["SearchKeys"]["Name"] == "die strasse"
+    assert records[1]["SearchKeys"]["Album"] == "café"
+
+    rules = [("Name", "like", "straße", [1, 2]), ("Name", "is", "FIRE", [3, 4]), ("Album", "is", "Café", [1, 2]), ("Album", "starts with", "caf", [1, 2, 3, 4])]
+    for field, operator, value, expected in rules:
+        fulltree = {"and": [{"field": field, "type": "string", "operator": operator, "value": value}]}
+        smartPlaylist = itunessmart.SmartPlaylist(types.SimpleNamespace(output="", query="", queryTree={"fulltree": fulltree}, ignore=""))
+        assert itunessmart.evaluateSmartPlaylist(smartPlaylist, records) == expected
+        assert itunessmart.TrackIndex(records).evaluate(smartPlaylist) == expected
+        with itunessmart.TrackDatabase(records) as database:
+            assert database.evaluate(smartPlaylist) == expected
+        if itunessmart.columnar.numpy is not None:
+            assert itunessmart.TrackTable(records).evaluate(smartPlaylist) == expected
+
+
+def test_evaluate_library_minimal(verbose=False):
+    library = readLibrary("library_minimal.xml")
+    records = itunessmart.createTrackRecords(library)
+    playlist = library['Playlists'][1]
+    parser = itunessmart.BytesParser(playlist['Smart Info'], playlist['Smart Criteria'])
+
+    assert itunessmart.evaluateSmartPlaylist(parser.result, records) == [1, 2]
+
+
+def test_evaluate_reference(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    for key, test in testdata.items():
+        parser = itunessmart.Parser(test["info"], test["criteria"])
+        if verbose:
+            print(itunessmart.predicateSource(parser.result))
+        result = itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW, playlists=PLAYLISTS)
+        expected = [t["TrackID"] for t in records if reference[key](t)]
+        assert result == expected, test["desc"]
+
+
+def test_compile_memoized(verbose=False):
+    parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+    predicate = itunessmart.compileSmartPlaylist(parser.result)
+    assert itunessmart.compileSmartPlaylist(parser.result) is predicate
+
+    # Same rules in another parser result share the compiled code
+    other = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+    assert itunessmart.compileSmartPlaylist(other.result) is predicate
+
+
+def test_compile_unsupported(verbose=False):
+    parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+    parser.result.queryTree["fulltree"]["and"][0]["operator"] = "unknown"
+    try:
+        itunessmart.compileSmartPlaylist(parser.result)
+    except itunessmart.EvaluationException:
+        pass
+    else:
+        raise AssertionError("EvaluationException not raised")
+
+
+def test_columnar(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    smartPlaylists = {key: itunessmart.Parser(test["info"], test["criteria"]).result for key, test in testdata.items()}
+    expected = {key: itunessmart.evaluateSmartPlaylist(p, records, now=NOW, playlists=PLAYLISTS) for key, p in smartPlaylists.items()}
+
+    assert itunessmart.evaluateSmartPlaylists(smartPlaylists, records, now=NOW, playlists=PLAYLISTS) == expected
+
+    if itunessmart.columnar.numpy is None:
+        try:
+            itunessmart.TrackTable(records)
+        except itunessmart.EvaluationException:
+            pass
+        else:
+            raise AssertionError("EvaluationException not raised")
+    else:
+        table = itunessmart.TrackTable(records)
+        categories, codes = table.column("Artist")
+        assert len(categories) == 7 and len(codes) == len(records)
+
+        # Fall back to compiled predicates without NumPy
+        numpy = itunessmart.columnar.numpy
+        itunessmart.columnar.numpy = None
+        try:
+            assert itunessmart.evaluateSmartPlaylists(smartPlaylists, records, now=NOW, playlists=PLAYLISTS) == expected
+        finally:
+            itunessmart.columnar.numpy = numpy
+
+
+def test_parallel(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(1000))
+    smartPlaylists = {key: itunessmart.Parser(test["info"], test["criteria"]).result for key, test in testdata.items()}
+    if itunessmart.parallel.numpy is None:
+        try:
+            itunessmart.evaluateParallel(smartPlaylists, records, now=NOW, playlists=PLAYLISTS)
+        except itunessmart.EvaluationException:
+            pass
+        else:
+            raise AssertionError("EvaluationException not raised")
+        return
+
+    expected = {key: itunessmart.evaluateSmartPlaylist(p, records, now=NOW, playlists=PLAYLISTS) for key, p in smartPlaylists.items()}
+    assert itunessmart.evaluateParallel(smartPlaylists, records, now=NOW, playlists=PLAYLISTS, processes=2) == expected
+
+    # The workers see the same columns
+    with itunessmart.SharedTrackTable(records, ["Artist", "Plays", "LastPlayed"]) as shared:
+        table, blocks = itunessmart.SharedTrackTable.attach(shared.layout)
+        assert table.trackIDs.tolist() == [t["TrackID"] for t in records]
+        assert table.column("Plays").tolist() == [t["Plays"] for t in records]
+        categories, codes = table.column("Artist")
+        assert [categories[c] for c in codes] == [t["SearchKeys"]["Artist"] for t in records]
+        try:
+            table.column("Genre")
+        except itunessmart.EvaluationException:
+            pass
+        else:
+            raise AssertionError("EvaluationException not raised")
+        del table, codes
+        for block in blocks:
+            block.close()
+
+        # A worker closes its memory blocks when it exits
+        itunessmart.parallel._initWorker(shared.layout, NOW, PLAYLISTS)
+        blocks = itunessmart.parallel._worker["blocks"]
+        itunessmart.parallel._closeWorker()
+        assert "table" not in itunessmart.parallel._worker and all(block.buf is None for block in blocks)
+
+
+def test_sqlite(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    with itunessmart.TrackDatabase(records) as database:
+        for key, test in testdata.items():
+            parser = itunessmart.Parser(test["info"], test["criteria"])
+            result = database.evaluate(parser.result, now=NOW, playlists=PLAYLISTS)
+            expected = itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW, playlists=PLAYLISTS)
+            assert result == expected, test["desc"]
+
+        # The memberships are only written when they change
+        statements = []
+        database.connection.set_trace_callback(statements.append)
+        parser = itunessmart.Parser(testdata["playlist"]["info"], testdata["playlist"]["criteria"])
+        playlists = dict(PLAYLISTS, **{"%016X" % i: {i} for i in range(100)})
+        for _ in range(3):
+            assert database.evaluate(parser.result, now=NOW, playlists=playlists) == itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW, playlists=playlists)
+        assert not [sql for sql in statements if "playlist_items" in sql and not sql.startswith("SELECT")]
+        playlists["2271DF30754D3E1A"] = {1, 2}
+        assert database.evaluate(parser.result, now=NOW, playlists=playlists) == [1, 2]
+        assert len([sql for sql in statements if sql.startswith("DELETE FROM playlist_items")]) == 1
+        database.connection.set_trace_callback(None)
+
+        # Values are parameters, the SQL only depends on the shape of the rules
+        parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+        sql, params = database.translate(parser.result.queryTree["fulltree"])
+        assert params == [15, 16, 17, 18, 4]
+        assert sql == 'SELECT "TrackID" FROM tracks WHERE ("Plays" > ? AND ("Plays" > ? OR "Plays" > ? OR "Plays" > ?) AND "Rating" > ?) ORDER BY "Position"'
+        parser.result.queryTree["fulltree"]["and"][0]["value"] = 3
+        assert database.translate(parser.result.queryTree["fulltree"])[0] is sql
+
+        # String values are not interpolated
+        database.insertTracks([itunessmart.createTrackRecord({"Track ID": 9999, "Album": "100% it's_me"})])
+        fulltree = {"and": [{"field": "Album", "type": "string", "operator": "ends with", "value": "% It's_Me"}]}
+        sql, params = database.translate(fulltree)
+        assert [row[0] for row in database.connection.execute(sql, params)] == [9999]
+
+        # Starts with values at the end of the code points
+        successor = itunessmart.sql._successor
+        assert successor("ab") == "ac" and successor("a\ud7ff") == "a\ue000" and successor("a\U0010ffff") == "b" and successor("\U0010ffff") == b""
+        database.insertTracks([itunessmart.createTrackRecord({"Track ID": 10000 + i, "Album": album}) for i, album in enumerate(["x\ud7ff", "x\ud7ffy", "x\ue000", "\U0010ffff", "\U0010ffffz", "y"])])
+        for value, expected in (("x\ud7ff", [10000, 10001]), ("\U0010ffff", [10003, 10004]), ("", None)):
+            fulltree = {"and": [{"field": "Album", "type": "string", "operator": "starts with", "value": value}]}
+            sql, params = database.translate(fulltree)
+            result = [row[0] for row in database.connection.execute(sql, params)]
+            assert result == (expected or [row[0] for row in database.connection.execute('SELECT "TrackID" FROM tracks ORDER BY "Position"')]), value
+
+        # Updated tracks keep their position, the indexes are only created and analyzed for the first insert
+        statements = []
+        database.connection.set_trace_callback(statements.append)
+        updated = [dict(records[0], Plays=100), dict(records[1], Plays=100)]
+        database.insertTracks(updated)
+        database.connection.set_trace_callback(None)
+        assert not [sql for sql in statements if sql.startswith(("CREATE INDEX", "ANALYZE"))]
+        records = updated + records[2:]
+        parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+        assert [row[0] for row in database.connection.execute('SELECT "TrackID" FROM tracks ORDER BY "Position" LIMIT 2')] == [1, 2]
+        assert database.evaluate(parser.result, now=NOW) == itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW)
+
+
+def test_string_index(verbose=False):
+    index = itunessmart.StringIndex(["art and life", "sól", "league of my own ii", "sól", "", "league of my own iii"])
+    assert index.values == ["art and life", "sól", "league of my own ii", "", "league of my own iii"]
+    assert index.lookup("is", "sól") == {1, 3}
+    assert index.lookup("is not", "sól") == {0, 2, 4, 5}
+    assert index.lookup("like", "own ii") == {2, 5}
+    assert index.lookup("like", "own iii") == {5}
+    assert index.lookup("like", "xyz") == set()
+    assert index.lookup("like", "l") == {0, 1, 2, 3, 5}
+    assert index.lookup("not like", "l") == {4}
+    assert index.lookup("like", "") == {0, 1, 2, 3, 4, 5}
+    assert index.lookup("starts with", "league") == {2, 5}
+    assert index.lookup("starts with", "s") == {1, 3}
+    assert index.lookup("starts with", "z") == set()
+    assert index.lookup("ends with", "ii") == {2, 5}
+    assert index.lookup("ends with", "own ii") == {2}
+
+
+def test_track_index(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    index = itunessmart.TrackIndex(records)
+    for key, test in testdata.items():
+        parser = itunessmart.Parser(test["info"], test["criteria"])
+        result = index.evaluate(parser.result, now=NOW, playlists=PLAYLISTS)
+        expected = itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW, playlists=PLAYLISTS)
+        assert result == expected, test["desc"]
+
+    # Only the tracks of the matching albums are candidates
+    parser = itunessmart.Parser(testdata["startsends"]["info"], testdata["startsends"]["criteria"])
+    candidates = index.candidates(parser.result.queryTree["fulltree"])
+    assert candidates == {i for i, t in enumerate(records) if t["Album"] in ("Sól", "Kveðja IDo")}
+
+    # Rules without index
+    parser = itunessmart.Parser(testdata["playlist"]["info"], testdata["playlist"]["criteria"])
+    assert index.candidates(parser.result.queryTree["fulltree"]) is None
+
+
+def test_range_index(verbose=False):
+    index = itunessmart.RangeIndex([5, None, 1, 3, 3, None, 8])
+    assert index.keys == [1, 3, 3, 5, 8]
+    assert index.lookup("greater than", 3) == {0, 6}
+    assert index.lookup("less than", 3) == {2}
+    assert index.lookup("between", (3, 5)) == {0, 3, 4}
+    assert index.lookup("is", 3) == {3, 4}
+    assert index.lookup("is not", 3) == {0, 2, 6}
+    assert index.lookup("is in the range", (4, 7)) == {0}
+    assert index.lookup("is not in the range", (4, 7)) == {1, 2, 3, 4, 5, 6}
+    assert index.lookup("is in the last", 4, now=10) == {6}
+    assert index.lookup("is not in the last", 4, now=10) == {0, 1, 2, 3, 4, 5}
+    assert index.range(9) == range(5, 5)
+
+    # Indexes are created on first use and dropped when the field changes
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    index = itunessmart.TrackIndex(records)
+    parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+    expected = itunessmart.evaluateSmartPlaylist(parser.result, records)
+    assert index.evaluate(parser.result) == expected
+    assert index.candidates(parser.result.queryTree["fulltree"]) == {i for i, t in enumerate(records) if t["Plays"] > 16 and t["Rating"] > 4}
+    plays = index.rangeIndex("Plays")
+    rating = index.rangeIndex("Rating")
+
+    changed = [dict(t, Plays=t["Plays"] + 1) for t in records[:100]]
+    changed.append(itunessmart.createTrackRecord({"Track ID": 5000, "Play Count": 20, "Rating": 100}))
+    index.update(changed)
+    assert index.rangeIndex("Rating") is not rating
+    assert index.rangeIndex("Plays") is not plays
+    records = records[:]
+    records[:100] = changed[:100]
+    records.append(changed[100])
+    assert index.evaluate(parser.result) == itunessmart.evaluateSmartPlaylist(parser.result, records)
+
+    rating = index.rangeIndex("Rating")
+    index.update([dict(records[0], Plays=0)])
+    assert index.rangeIndex("Rating") is rating
+
+
+def test_optimize(verbose=False):
+    plays = lambda operator, value: {"field": "Plays", "type": "int", "operator": operator, "value": value}
+    added = lambda operator, value: {"field": "DateAdded", "type": "date", "operator": operator, "value": value}
+    rating = {"field": "Rating", "type": "int", "operator": "greater than", "value": 4}
+
+    fulltree = {"and": [plays("greater than", 15), {"and": [plays("greater than", 16), plays("greater than", 17)]}, rating]}
+    assert itunessmart.optimizeRules(fulltree) == {"and": [plays("greater than", 17), rating]}
+    assert fulltree["and"][1]["and"][1] == plays("greater than", 17)
+    fulltree = {"and": [plays("greater than", 15), {"or": [plays("greater than", 16), plays("greater than", 17)]}, rating]}
+    assert itunessmart.optimizeRules(fulltree) == {"and": [plays("greater than", 16), rating]}
+
+    assert itunessmart.optimizeRules({"and": [plays("between", (5, 5))]}) == {"and": [plays("is", 5)]}
+    assert itunessmart.optimizeRules({"and": [plays("greater than", 5), plays("less than", 10)]}) == {"and": [plays("between", (6, 9))]}
+    assert itunessmart.optimizeRules({"and": [plays("greater than", 5), plays("less than", 6), rating]}) == {"or": []}
+    assert itunessmart.optimizeRules({"or": [plays("less than", 5), plays("greater than", 3), rating]}) == {"and": []}
+    assert itunessmart.optimizeRules({"or": [plays("less than", 5), plays("is", 5), plays("greater than", 7)]}) == {"or": [plays("less than", 6), plays("greater than", 7)]}
+    assert itunessmart.optimizeRules({"and": [plays("between", (1, 5)), plays("is not", 3), plays("is not", 9)]}) == {"and": [plays("between", (1, 5)), plays("is not", 3)]}
+    assert itunessmart.optimizeRules({"and": [plays("is", 3), plays("is not", 3)]}) == {"or": []}
+    assert itunessmart.optimizeRules({"or": [rating, {"and": [rating]}, {"or": []}]}) == {"or": [rating]}
+    assert itunessmart.optimizeRules({"and": [added("is after", 5), added("is before", 100), added("is after", 10)]}) == {"and": [added("is after", 10), added("is before", 100)]}
+    assert itunessmart.optimizeRules({"and": [added("is after", 5), added("is before", 6)]}) == {"or": []}
+
+    # The optimized rules match the same tracks
+    records = itunessmart.createTrackRecords(randomLibrary(500))
+    compile = lambda fulltree: itunessmart.evaluate._compileSource(itunessmart.evaluate._treeSource(fulltree))
+    rnd = random.Random(5)
+    rules = [lambda: plays(rnd.choice(["greater than", "less than", "is", "is not"]), rnd.randint(0, 30)),
+             lambda: plays("between", tuple(sorted(rnd.sample(range(30), 2)))),
+             lambda: added(rnd.choice(["is after", "is before"]), NOW - rnd.randint(0, 60) * DAY),
+             lambda: dict(rating, operator=rnd.choice(["greater than", "less than"]), value=rnd.randint(0, 5))]
+
+    def randomTree(depth):
+        if depth == 0 or rnd.random() < 0.4:
+            return rnd.choice(rules)()
+        return {rnd.choice(["and", "or"]): [randomTree(depth - 1) for _ in range(rnd.randint(1, 4))]}
+
+    for _ in range(100):
+        fulltree = {rnd.choice(["and", "or"]): [randomTree(3) for _ in range(rnd.randint(1, 4))]}
+        optimized = itunessmart.optimizeRules(fulltree)
+        predicate, optimizedPredicate = compile(fulltree), compile(optimized)
+        expected = [t["TrackID"] for t in records if predicate(t, NOW, {})]
+        assert [t["TrackID"] for t in records if optimizedPredicate(t, NOW, {})] == expected, fulltree
+
+
+def test_statistics(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(5000))
+    statistics = itunessmart.LibraryStatistics(records, now=NOW)
+    fraction = lambda test: sum(1 for t in records if test(t)) / len(records)
+
+    artist = statistics.field("Artist")
+    assert artist.distinct == 7 and artist.count == 5000 and artist.missing == 0
+    assert abs(artist.equal("adele") - fraction(lambda t: t["Artist"] == "Adele")) < 1e-9
+    estimates = [
+        ({"field": "Plays", "type": "int", "operator": "greater than", "value": 15}, lambda t: t["Plays"] > 15),
+        ({"field": "Year", "type": "int", "operator": "between", "value": (1980, 1990)}, lambda t: 1980 <= t["Year"] <= 1990),
+        ({"field": "LastPlayed", "type": "date", "operator": "is in the last", "value": 7 * DAY}, lambda t: t["LastPlayed"] is not None and NOW - t["LastPlayed"] < 7 * DAY),
+        ({"field": "LastPlayed", "type": "date", "operator": "is not in the last", "value": 7 * DAY}, lambda t: t["LastPlayed"] is None or NOW - t["LastPlayed"] > 7 * DAY),
+        ({"field": "Comments", "type": "string", "operator": "like", "value": "#Complete"}, lambda t: "#complete" in t["Comments"].lower()),
+        ({"field": "MediaKind", "type": "mediakind", "operator": "is", "value": "Podcast"}, lambda t: t["MediaKind"] == "Podcast"),
+        ({"and": [{"field": "Rating", "type": "int", "operator": "less than", "value": 3},
+                  {"field": "Genre", "type": "string", "operator": "is not", "value": "Pop"}]}, lambda t: t["Rating"] < 3 and t["Genre"] != "Pop"),
+    ]
+    for rule, test in estimates:
+        selectivity, cost = statistics.estimate(rule)
+        assert abs(selectivity - fraction(test)) < 0.05, (rule, selectivity, fraction(test))
+        assert cost > 0
+
+    # The selective and cheap rule is evaluated first
+    comments = {"field": "Comments", "type": "string", "operator": "like", "value": "#complete"}
+    podcast = {"field": "MediaKind", "type": "mediakind", "operator": "is", "value": "Podcast"}
+    assert statistics.reorder({"and": [comments, podcast]}) == {"and": [podcast, comments]}
+    assert statistics.reorder({"or": [podcast, comments]}) == {"or": [comments, podcast]}
+
+    parser = itunessmart.Parser(testdata["mixed"]["info"], testdata["mixed"]["criteria"])
+    source = itunessmart.predicateSource(parser.result, statistics)
+    assert source != itunessmart.predicateSource(parser.result)
+    predicate = itunessmart.compileSmartPlaylist(parser.result, statistics)
+    assert itunessmart.compileSmartPlaylist(parser.result, statistics) is predicate
+    result = itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW, playlists=PLAYLISTS, statistics=statistics)
+    assert result == itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW, playlists=PLAYLISTS)
+
+    evaluator = itunessmart.LibraryEvaluator(playlistLibrary(500), now=NOW)
+    evaluator.evaluateAll()
+    order = evaluator.ruleOrder("0000000000000003")
+    # Rating > 4 excludes more tracks than Plays > 16
+    assert order == {"and": [{"field": "Rating", "type": "int", "operator": "greater than", "value": 4},
+                             {"field": "Plays", "type": "int", "operator": "greater than", "value": 16}]}
+
+
+def test_explain(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+    expected = itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW)
+
+    plan = parser.result.explain(records, now=NOW)
+    if verbose:
+        print(plan)
+    lines = plan.split("\n")
+    assert lines[0].startswith("Plan, match all: estimated ")
+    assert lines[1].startswith("Rating is greater than 4 and ") and "-- scan: estimated " in lines[1]
+    assert lines[2].startswith("Plays is greater than 16 ") and ", actual %d of " % len(expected) in lines[2]
+    assert lines[3].startswith("Total: %d tracks in " % len(expected))
+
+    plan = itunessmart.explainSmartPlaylist(parser.result, records, now=NOW, index=itunessmart.TrackIndex(records))
+    assert "-- index: " in plan.split("\n")[1]
+
+    parser = itunessmart.Parser(testdata["startsends"]["info"], testdata["startsends"]["criteria"])
+    plan = parser.result.explain(records, now=NOW)
+    if verbose:
+        print(plan)
+    lines = plan.split("\n")
+    assert lines[1].startswith("[ ") and "-- any: " in lines[1]
+    assert lines[2].startswith("\tAlbum ")
+    assert [line for line in lines if line.startswith("]")][0] == "] and"
+    assert lines[-2].startswith("Exclude unchecked items ") and "-- limit: " in lines[-2]
+
+
+def test_stream(verbose=False):
+    # Streaming reader
+    path = os.path.join(os.path.dirname(__file__), "library_minimal.xml")
+    with open(path, "rb") as fs:
+        assert list(itunessmart.iterTrackRecords(fs)) == itunessmart.createTrackRecords(readLibrary("library_minimal.xml"))
+
+    library = playlistLibrary(500)
+    previous = "0000000000000003"
+    for i in range(5):
+        persistentID = "10000000000000%02d" % i
+        library["Playlists"].append(smartPlaylistEntry("Chain %d" % i, persistentID, "playlist", replacePersistentID=previous))
+        previous = persistentID
+    evaluator = itunessmart.LibraryEvaluator(library, now=NOW)
+    expected = evaluator.evaluateAll()
+
+    # Playlists of the stream depend on each other, the folder and the static playlist are given
+    playlists = {p: evaluator.members(p) for p in ("2271DF30754D3E1A", "CF3419CE9A5B19E2")}
+    stream = itunessmart.StreamEvaluator(evaluator.smartPlaylists, now=NOW, playlists=playlists)
+    result = stream.run(iter(evaluator.tracks))
+    assert stream.count == 500
+    assert set(result) == set(evaluator.smartPlaylists)
+    for persistentID, trackIDs in result.items():
+        assert trackIDs == expected[persistentID]
+    assert result["1000000000000004"] == result["0000000000000003"]
+
+    # Only the matches are buffered, limited playlists keep the fields of the limit
+    for query in stream._queries:
+        if query.limited:
+            assert set(query.buffer[0]) == {"TrackID"} | itunessmart.limitFields(query.smartPlaylist)
+        else:
+            assert query.buffer == result[query.key]
+
+    # Rules on a limited playlist of the stream are resolved after the pass from the buffered candidates
+    library["Playlists"].append(smartPlaylistEntry("On Mixed", "2000000000000001", "playlist", replacePersistentID="0000000000000004"))
+    library["Playlists"].append(smartPlaylistEntry("On On Mixed", "2000000000000002", "playlist", replacePersistentID="2000000000000001"))
+    evaluator = itunessmart.LibraryEvaluator(library, now=NOW)
+    expected = evaluator.evaluateAll()
+    stream = itunessmart.StreamEvaluator(evaluator.smartPlaylists, now=NOW, playlists=playlists)
+    result = stream.run(evaluator.tracks)
+    assert stream.deferred == ["2000000000000001", "2000000000000002"]
+    assert result == {persistentID: expected[persistentID] for persistentID in evaluator.smartPlaylists}
+    assert set(result["2000000000000002"]) == set(result["0000000000000004"])
+
+    # Many limited dependencies: the rules on them are true for the candidates, the buffer only keeps the candidates
+    mixed = [smartPlaylistEntry("Mixed %d" % i, "50000000000000%02d" % i, "mixed") for i in range(5)]
+    evaluator = itunessmart.LibraryEvaluator(dict(library, Playlists=library["Playlists"][:3] + mixed), now=NOW)
+    smartPlaylists = {p["Playlist Persistent ID"]: evaluator.smartPlaylists[p["Playlist Persistent ID"]] for p in mixed}
+    fulltree = {"and": [
+        {"field": "Plays", "type": "int", "operator": "greater than", "value": 25},
+        {"or": [{"field": "PlaylistPersistentID", "type": "playlist", "operator": "is", "value": p} for p in smartPlaylists]}]}
+    parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": fulltree}, ignore="")
+    smartPlaylists["On Many"] = itunessmart.SmartPlaylist(parser)
+    stream = itunessmart.StreamEvaluator(smartPlaylists, now=NOW, playlists=playlists)
+    result = stream.run(evaluator.tracks)
+    assert stream.deferred == ["On Many"]
+    members = {p: set(result[p]) for p in smartPlaylists if p != "On Many"}
+    assert result["On Many"] and result["On Many"] == itunessmart.evaluateSmartPlaylist(smartPlaylists["On Many"], evaluator.tracks, now=NOW, playlists=members)
+    buffer = next(query.buffer for query in stream._queries if query.key == "On Many")
+    assert len(buffer) == len([t for t in evaluator.tracks if t["Plays"] > 25]) < len(evaluator.tracks) / 4
+    assert set(buffer[0]["SearchKeys"]) <= {"Plays"}
+
+    # All playlists of the sample library
+    library = readLibrary("library_onlysmartplaylists.xml")
+    evaluator = itunessmart.LibraryEvaluator(library, tracks=itunessmart.createTrackRecords(randomLibrary(300)), now=NOW)
+    expected = evaluator.evaluateAll()
+    playlists = {}
+    for sp in evaluator.smartPlaylists.values():
+        for persistentID in itunessmart.playlistDependencies(sp.queryTree["fulltree"]):
+            if persistentID not in evaluator.smartPlaylists and persistentID in evaluator.dependencies:
+                playlists[persistentID] = evaluator.members(persistentID)
+    stream = itunessmart.StreamEvaluator(evaluator.smartPlaylists, now=NOW, playlists=playlists)
+    result = stream.run(evaluator.tracks)
+    assert stream.deferred
+    assert result == {persistentID: expected[persistentID] for persistentID in evaluator.smartPlaylists}
+    if verbose:
+        print("Deferred playlists: %d of %d" % (len(stream.deferred), len(result)))
+
+
+def test_rule_graph(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(300))
+    smartPlaylists = {key: itunessmart.Parser(data["info"], data["criteria"]).result for key, data in testdata.items()}
+    graph = itunessmart.RuleGraph(smartPlaylists)
+    result = graph.evaluate(records, now=NOW, playlists=PLAYLISTS)
+    for key, smartPlaylist in smartPlaylists.items():
+        assert result[key] == itunessmart.evaluateSmartPlaylist(smartPlaylist, records, now=NOW, playlists=PLAYLISTS)
+
+    # Same rules in a different order and case are one node
+    a = {"and": [{"field": "Genre", "type": "string", "operator": "is", "value": "Jazz"}, {"field": "Rating", "type": "int", "operator": "greater than", "value": 3}]}
+    b = {"and": [{"field": "Rating", "type": "int", "operator": "greater than", "value": 3}, {"field": "Genre", "type": "string", "operator": "is", "value": "jazz"}]}
+    c = {"or": [a, {"field": "Plays", "type": "int", "operator": "is", "value": 0}]}
+    playlists = {}
+    for name, fulltree in (("a", a), ("b", b), ("c", c)):
+        parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": fulltree}, ignore="")
+        playlists[name] = itunessmart.SmartPlaylist(parser)
+    graph = itunessmart.RuleGraph(playlists)
+    assert graph.roots["a"] == graph.roots["b"]
+    assert len(graph.nodes) == 5
+    result = graph.evaluate(records, now=NOW)
+    assert result["a"] == result["b"] == [t["TrackID"] for t in records if t["Genre"] == "Jazz" and t["Rating"] > 3]
+    assert graph.evaluations == 5
+    assert graph.trackTests == 3 * len(records)
+
+    report = graph.report()
+    if verbose:
+        print(report)
+    assert report.startswith("Playlists: 3, rules and groups: 11, distinct: 5")
+    assert "Rules: 7, distinct: 3, saved: 4 (57%)" in report
+    assert "5 evaluations instead of 11, 900 track tests instead of 2100" in report
+    assert "\t3x Genre is \"Jazz\"" in report
+
+
+def test_pattern_matcher(verbose=False):
+    rules = [("like", "he"), ("like", "she"), ("not like", "his"), ("starts with", "he"), ("ends with", "hers"), ("is", "ushers"), ("is not", "he"), ("ends with", "e")]
+    matcher = itunessmart.PatternMatcher(rules)
+    assert matcher.match("ushers") == {0, 1, 2, 4, 5, 6}
+    assert matcher.match("he") == {0, 2, 3, 7}
+    assert matcher.match("") == {2, 6}
+
+    # Many playlists with string rules on the same field
+    records = itunessmart.createTrackRecords(randomLibrary(300))
+    words = ["#complete", "album", "live", "remastered", "#completeep", "ep", "a", "#"]
+    smartPlaylists = {}
+    for i, (operator, word) in enumerate((operator, word) for operator in ("like", "not like", "starts with", "ends with", "is") for word in words):
+        rule = {"field": "Comments", "type": "string", "operator": operator, "value": word.upper() if i % 2 else word}
+        parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": {"and": [rule]}}, ignore="")
+        smartPlaylists[i] = itunessmart.SmartPlaylist(parser)
+    graph = itunessmart.RuleGraph(smartPlaylists)
+    assert len(graph.patternFields["Comments"]) == len(smartPlaylists)
+    result = graph.evaluate(records)
+    for key, smartPlaylist in smartPlaylists.items():
+        assert result[key] == itunessmart.evaluateSmartPlaylist(smartPlaylist, records)
+    assert graph.trackTests == len(records)
+    assert "Matched together: Comments 40 rules" in graph.report()
+
+
+def test_count_estimate(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(3000))
+    smartPlaylist = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"]).result
+    exact = len(itunessmart.evaluateSmartPlaylist(smartPlaylist, records, now=NOW))
+
+    estimates = list(itunessmart.iterCountEstimates(smartPlaylist, records, now=NOW, batch=500, seed=1))
+    assert [e.sampled for e in estimates] == [500, 1000, 1500, 2000, 2500, 3000]
+    assert estimates[-1].exact and estimates[-1].count == estimates[-1].low == estimates[-1].high == exact
+    assert str(estimates[-1]) == "%d tracks" % exact
+    # The intervals get narrower and contain the exact count
+    widths = [e.high - e.low for e in estimates]
+    assert widths == sorted(widths, reverse=True)
+    covered = 0
+    for seed in range(40):
+        estimate = next(itunessmart.iterCountEstimates(smartPlaylist, records, now=NOW, batch=300, seed=seed))
+        covered += estimate.low <= exact <= estimate.high
+        assert estimate.low <= estimate.count <= estimate.high
+    assert covered >= 34
+
+    # Time budget
+    estimate = itunessmart.estimateCount(smartPlaylist, records, now=NOW, budget=0, batch=100, seed=1)
+    assert estimate.sampled == 100 and not estimate.exact
+    assert str(estimate).startswith("about %d tracks" % estimate.count)
+    estimate = itunessmart.estimateCount(smartPlaylist, records, now=NOW, budget=10)
+    assert estimate.exact and estimate.count == exact
+
+    # The sample draws every track once, without a list of all positions
+    class Recorder(list):
+        def __getitem__(self, i):
+            drawn.append(i)
+            return list.__getitem__(self, i)
+
+    drawn = []
+    estimates = itunessmart.iterCountEstimates(smartPlaylist, Recorder(records[:50]), now=NOW, batch=7, seed=3)
+    next(estimates)
+    assert len(drawn) == len(set(drawn)) == 7
+    list(estimates)
+    assert sorted(drawn) == list(range(50))
+    try:
+        next(itunessmart.iterCountEstimates(smartPlaylist, records, now=NOW, batch=0))
+    except itunessmart.EvaluationException:
+        pass
+    else:
+        raise AssertionError("EvaluationException not raised")
+
+    # Item limits cap the count, unchecked tracks are excluded
+    smartPlaylist = itunessmart.Parser(testdata["mixed"]["info"], testdata["mixed"]["criteria"]).result
+    selected = itunessmart.selectTracks(smartPlaylist, [records[i - 1] for i in itunessmart.evaluateSmartPlaylist(smartPlaylist, records, now=NOW, playlists=PLAYLISTS)])
+    estimate = itunessmart.estimateCount(smartPlaylist, records, now=NOW, playlists=PLAYLISTS, budget=10)
+    assert estimate.count == len(selected) == smartPlaylist.queryTree["number"]
+
+
+def test_select_items(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    byID = {t["TrackID"]: t for t in records}
+
+    # Limited to 25 Items selected by highest rated, exclude unchecked items
+    parser = itunessmart.Parser(testdata["limit_items"]["info"], testdata["limit_items"]["criteria"])
+    matches = [byID[i] for i in itunessmart.evaluateSmartPlaylist(parser.result, records, now=NOW)]
+    selected = itunessmart.selectTracks(parser.result, matches)
+    expected = sorted((t for t in matches if t["Checked"]), key=lambda t: t["Rating"], reverse=True)[:25]
+    assert selected == expected
+
+    # Limited to 25 Items selected by artist
+    parser = itunessmart.Parser(testdata["limit_sortartist"]["info"], testdata["limit_sortartist"]["criteria"])
+    selected = itunessmart.selectTracks(parser.result, records)
+    assert selected == sorted(records, key=lambda t: t["SortArtist"].lower())[:25]
+
+    # No limit
+    parser = itunessmart.Parser(testdata["nested"]["info"], testdata["nested"]["criteria"])
+    assert itunessmart.selectTracks(parser.result, iter(records)) == records
+
+
+def test_select_budget(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(2000))
+    parser = itunessmart.Parser(testdata["limit_items"]["info"], testdata["limit_items"]["criteria"])
+    parser.result.queryTree["type"] = "Minutes"
+    parser.result.queryTree["number"] = 60
+    parser.result.queryTree["order"] = "LastPlayed ASC"
+    selected = itunessmart.selectTracks(parser.result, records)
+
+    ordered = sorted((t for t in records if t["Checked"]), key=lambda t: (t["LastPlayed"] is not None, t["LastPlayed"] or 0))
+    total = sum(t["Duration"] for t in selected)
+    assert selected == ordered[:len(selected)]
+    assert total <= 60 * 60000 < total + ordered[len(selected)]["Duration"]
+
+    # Limit to 9876 MB selected by RANDOM
+    parser = itunessmart.Parser(testdata["limit_mb_random"]["info"], testdata["limit_mb_random"]["criteria"])
+    selected = itunessmart.selectTracks(parser.result, records, seed=1)
+    assert sum(t["Size"] for t in selected) <= 9876 * 1024 * 1024
+    assert len(set(t["TrackID"] for t in selected)) == len(selected)
+    assert selected == itunessmart.selectTracks(parser.result, iter(records), seed=1)
+    assert selected != itunessmart.selectTracks(parser.result, records, seed=2)
+
+
+def test_select_random(verbose=False):
+    records = itunessmart.createTrackRecords(randomLibrary(20))
+
+    # Limited to 25 Items selected by random, exclude unchecked items
+    parser = itunessmart.Parser(testdata["mixed"]["info"], testdata["mixed"]["criteria"])
+    parser.result.queryTree["number"] = 10
+    checked = [t for t in records if t["Checked"]]
+
+    # Default seed is stable
+    selected = itunessmart.selectTracks(parser.result, iter(records))
+    assert selected == itunessmart.selectTracks(parser.result, records)
+    assert len(selected) == 10 and all(t in checked for t in selected)
+
+    # Uniform
+    counts = {t["TrackID"]: 0 for t in checked}
+    runs = 2000
+    for seed in range(runs):
+        for t in itunessmart.selectTracks(parser.result, records, seed=seed):
+            counts[t["TrackID"]] += 1
+    expected = runs * 10 / len(checked)
+    assert all(abs(count - expected) < 0.15 * expected for count in counts.values())
+
+    # The selection is the beginning of the permutation by the random keys, whatever order the tracks arrive in
+    class Keys:
+        def __init__(self, keys):
+            self.keys = iter(keys)
+
+        def random(self):
+            return next(self.keys)
+
+    tracks = [{"TrackID": "A", "Size": 9, "Key": .1}, {"TrackID": "E", "Size": 5, "Key": .2}, {"TrackID": "T", "Size": 1, "Key": .3}]
+    rnd = random.Random(5)
+    tracks += [{"TrackID": i, "Size": rnd.randint(1, 6), "Key": rnd.random()} for i in range(5)]
+    for budget in (1, 10, 20):
+        expected = itunessmart.selection._fillBudget(sorted(tracks, key=lambda t: t["Key"]), "Size", budget)
+        for _ in range(50):
+            rnd.shuffle(tracks)
+            selected = itunessmart.selection._reservoir(tracks, Keys([t["Key"] for t in tracks]), "Size", budget)
+            assert selected == expected, budget
+    aet = sorted((t for t in tracks if isinstance(t["TrackID"], str)), key=lambda t: t["Key"])
+    for order in ([0, 1, 2], [2, 0, 1], [1, 2, 0]):
+        order = [aet[i] for i in order]
+        selected = itunessmart.selection._reservoir(order, Keys([t["Key"] for t in order]), "Size", 10)
+        assert [t["TrackID"] for t in selected] == ["A"]
+
+
+def test_dependency_order(verbose=False):
+    library = playlistLibrary(500)
+    evaluator = itunessmart.LibraryEvaluator(library, now=NOW)
+    records = evaluator.tracks
+    byID = {t["TrackID"]: t for t in records}
+
+    order = evaluator.order()
+    for persistentID, dependencies in evaluator.dependencies.items():
+        assert all(order.index(d) < order.index(persistentID) for d in dependencies)
+    assert evaluator.dependencies["0000000000000005"] == ["2271DF30754D3E1A"]
+    assert evaluator.dependencies["0000000000000004"] == ["CF3419CE9A5B19E2"]
+
+    result = evaluator.evaluateAll()
+    nested = evaluator.smartPlaylists["0000000000000003"]
+    mixed = evaluator.smartPlaylists["0000000000000004"]
+    static = [13, 11, 7, 5, 3, 2]
+    assert result["CF3419CE9A5B19E2"] == static
+    assert result["0000000000000003"] == itunessmart.evaluateSmartPlaylist(nested, records, now=NOW)
+    assert result["2271DF30754D3E1A"] == static + [i for i in result["0000000000000003"] if i not in static]
+    assert result["0000000000000005"] == [t["TrackID"] for t in records if t["TrackID"] in result["2271DF30754D3E1A"]]
+    matches = itunessmart.evaluateSmartPlaylist(mixed, records, now=NOW, playlists={"CF3419CE9A5B19E2": set(static)})
+    assert result["0000000000000004"] == [t["TrackID"] for t in itunessmart.selectTracks(mixed, [byID[i] for i in matches])]
+    assert len(result["E48098B57CA4D12E"]) == 500
+
+    # Real library with folders
+    library = readLibrary("library_onlysmartplaylists.xml")
+    evaluator = itunessmart.LibraryEvaluator(library)
+    order = evaluator.order()
+    assert len(order) == len(library["Playlists"])
+    for persistentID, dependencies in evaluator.dependencies.items():
+        assert all(order.index(d) < order.index(persistentID) for d in dependencies if d in evaluator.dependencies)
+
+
+def test_dependency_chain(verbose=False):
+    library = playlistLibrary(200)
+    # Chain: each playlist depends on the previous one
+    previous = "CF3419CE9A5B19E2"
+    for i in range(20):
+        persistentID = "10000000000000%02d" % i
+        library["Playlists"].append(smartPlaylistEntry("Chain %d" % i, persistentID, "playlist", replacePersistentID=previous))
+        previous = persistentID
+    evaluator = itunessmart.LibraryEvaluator(library)
+    assert evaluator.evaluate(previous) == [2, 3, 5, 7, 11, 13]
+    assert len(evaluator.order([previous])) == 21
+    assert evaluator.members("1000000000000000") == frozenset([2, 3, 5, 7, 11, 13])
+
+    # Cycle
+    library = playlistLibrary(10)
+    library["Playlists"].append(smartPlaylistEntry("A", "2000000000000001", "playlist", replacePersistentID="2000000000000002"))
+    library["Playlists"].append(smartPlaylistEntry("B", "2000000000000002", "playlist", replacePersistentID="2000000000000001"))
+    evaluator = itunessmart.LibraryEvaluator(library)
+    assert evaluator.evaluate("0000000000000003")
+    try:
+        evaluator.evaluate("2000000000000001")
+    except itunessmart.PlaylistCycleException as e:
+        assert e.args[1] == ["2000000000000001", "2000000000000002", "2000000000000001"]
+    else:
+        raise AssertionError("PlaylistCycleException not raised")
+
+
+def test_incremental_update(verbose=False):
+    library = playlistLibrary(500)
+    library["Playlists"].append(smartPlaylistEntry("Playlist is Library", "4000000000000001", "playlist", replacePersistentID="E48098B57CA4D12E"))
+    evaluator = itunessmart.LibraryEvaluator(library, now=NOW)
+    evaluator.evaluateAll()
+
+    index = evaluator.fieldIndex
+    assert index.fields["0000000000000003"] == {"Plays", "Rating"}
+    assert index.fields["0000000000000004"] == {"MediaKind", "BPM", "LastPlayed", "Purchased", "DateModified", "BitRate", "Love", "Checked"}
+    assert index.affected(["Plays", "Artist"]) == {"0000000000000003"}
+    assert index.affected(["Comments"]) == set()
+
+    # Play counts and ratings change
+    rnd = random.Random(3)
+    changed = []
+    for t in rnd.sample(evaluator.tracks, 100):
+        t = dict(t)
+        t["Plays"] += rnd.randint(0, 20)
+        t["Rating"] = rnd.randint(0, 5)
+        t["LastPlayed"] = NOW
+        changed.append(t)
+    # New track
+    changed.append(itunessmart.createTrackRecord({"Track ID": 1000, "Play Count": 20, "Rating": 100}))
+
+    changes = evaluator.update(changed)
+    fresh = itunessmart.LibraryEvaluator(library, tracks=evaluator.tracks, now=NOW)
+    assert evaluator.evaluateAll() == fresh.evaluateAll()
+    # The new track is added to the library playlist and the playlists on the library
+    assert changes["E48098B57CA4D12E"] == ({1000}, set())
+    assert evaluator.evaluate("4000000000000001")[-1] == 1000
+    assert 1000 in changes["0000000000000003"][0]
+    assert 1000 in changes["2271DF30754D3E1A"][0]
+    assert 1000 in changes["0000000000000005"][0]
+    assert "CF3419CE9A5B19E2" not in changes
+
+    # Fields that no playlist reads
+    changed = [dict(t, Comments="changed") for t in evaluator.tracks[:10]]
+    assert evaluator.update(changed) == {}
+
+
+def test_time_schedule(verbose=False):
+    library = playlistLibrary(500)
+    library["Playlists"].append(smartPlaylistEntry("In the last", "3000000000000001", "inthelast"))
+    library["Playlists"].append(smartPlaylistEntry("On In the last", "3000000000000002", "playlist", replacePersistentID="3000000000000001"))
+    evaluator = itunessmart.LibraryEvaluator(library, now=NOW)
+    evaluator.evaluateAll()
+
+    week = 7 * DAY
+    expected = min(t["DateAdded"] + week for t in evaluator.tracks if t["DateAdded"] + week > NOW)
+    validUntil = evaluator.validUntil("3000000000000001")
+    assert validUntil == expected
+    assert itunessmart.nextChange(evaluator.smartPlaylists["3000000000000001"], evaluator.tracks, NOW) == expected
+    assert evaluator.validUntil("3000000000000002") == validUntil
+    assert evaluator.validUntil("0000000000000003") == math.inf
+    assert evaluator.validUntil("CF3419CE9A5B19E2") == math.inf
+
+    # Nothing changes before validUntil
+    assert evaluator.refresh(validUntil - 1) == {}
+    changes = evaluator.refresh(validUntil)
+    assert set(changes) == {"3000000000000001", "3000000000000002"}
+    assert changes["3000000000000001"][0] == set() and changes["3000000000000001"][1]
+    fresh = itunessmart.LibraryEvaluator(library, tracks=evaluator.tracks, now=validUntil)
+    assert evaluator.evaluateAll() == fresh.evaluateAll()
+    assert evaluator.validUntil("3000000000000001") > validUntil
+
+    # Not in the last: the result changes after the date passes
+    smartPlaylist = itunessmart.Parser(testdata["limit_mb_random"]["info"], testdata["limit_mb_random"]["criteria"]).result
+    month = smartPlaylist.queryTree["fulltree"]["and"][0]["value"]
+    change = itunessmart.nextChange(smartPlaylist, evaluator.tracks, NOW)
+    assert change == min(t["DateAdded"] + month for t in evaluator.tracks if t["DateAdded"] + month >= NOW)
+    before = itunessmart.evaluateSmartPlaylist(smartPlaylist, evaluator.tracks, now=NOW)
+    assert itunessmart.evaluateSmartPlaylist(smartPlaylist, evaluator.tracks, now=change) == before
+    assert itunessmart.evaluateSmartPlaylist(smartPlaylist, evaluator.tracks, now=change + 1) != before
+
+    # Changed dates move validUntil
+    evaluator.update([dict(t, DateAdded=evaluator.now - week + 10) for t in evaluator.tracks[:3]])
+    assert evaluator.validUntil("3000000000000001") == evaluator.now + 10
+
+
+def run_all(verbose=False):
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print("%s()" % fname)
+            f(verbose)
+            print("Ok.")
+
+
+if __name__ == '__main__':
+    run_all(verbose=False)
@@ -1,6 +1,9 @@
 import os
 import json
 import copy
+import io
+import types
+import tempfile
 
 try:
     import itunessmart
@@ -311,7 +314,7 @@ testdata = [
         "expected" : {
             "query" : "(Plays > 15) AND ( (Plays > 16) AND (Plays > 17) AND (Plays > 18) ) AND (Rating > 4)"
         },
-        "xsp" : [('zzzsub_0e0db45ffe89e65c0b8396121fe654a1', '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<smartplaylist type="songs">\n    <name>zzzsub_0e0db45ffe89e65c0b8396121fe654a1</name>\n    <match>all</match>\n    <rule field="playcount" operator="greaterthan">\n        <value>16</value>\n    </rule>\n    <rule field="playcount" operator="greaterthan">\n        <value>17</value>\n    </rule>\n    <rule field="playcount" operator="greaterthan">\n        <value>18</value>\n    </rule>\n\n</smartplaylist>'), ('example', '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<smartplaylist type="songs">\n    <name>example</name>\n    <match>all</match>\n    <rule field="playcount" operator="greaterthan">\n        <value>15</value>\n    </rule>\n    <rule field="userrating" operator="greaterthan">\n        <value>4</value>\n    </rule>\n    <rule field="playlist" operator="is">\n        <value>zzzsub_0e0db45ffe89e65c0b8396121fe654a1</value>\n    </rule>\n\n\n</smartplaylist>')]
+        "xsp" : [('example', '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<smartplaylist type="songs">\n    <name>example</name>\n    <match>all</match>\n    <rule field="playcount" operator="greaterthan">\n        <value>18</value>\n    </rule>\n    <rule field="userrating" operator="greaterthan">\n        <value>4</value>\n    </rule>\n\n\n</smartplaylist>')]
     },
     {
         "desc" : "Sub expression: Plays > 15 ANY:(  PLAYS > 16 AND PLAYS > 17 ) RATING > 4",
@@ -322,7 +325,7 @@ testdata = [
         "expected" : {
             "query" : "(Plays > 15) AND ( (Plays > 16) OR (Plays > 17) OR (Plays > 18) ) AND (Rating > 4)"
         },
-        "xsp" : [('example', '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<smartplaylist type="songs">\n    <name>example</name>\n    <match>all</match>\n    <rule field="playcount" operator="greaterthan">\n        <value>15</value>\n    </rule>\n    <rule field="playcount" operator="greaterthan">\n        <value>16</value>\n        <value>17</value>\n        <value>18</value>\n    </rule>\n    <rule field="userrating" operator="greaterthan">\n        <value>4</value>\n    </rule>\n\n\n</smartplaylist>')]
+        "xsp" : [('example', '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<smartplaylist type="songs">\n    <name>example</name>\n    <match>all</match>\n    <rule field="playcount" operator="greaterthan">\n        <value>16</value>\n    </rule>\n    <rule field="userrating" operator="greaterthan">\n        <value>4</value>\n    </rule>\n\n\n</smartplaylist>')]
     },
     {
         "desc" : "Location is/not on Computer/iCloud",
@@ -679,6 +682,238 @@ def test_xsp_subplaylists(verbose=False):
         if os.path.isfile(file):
             os.remove(file)
 
+def test_xsp_immutable(verbose=False):
+    library = readLibrary("library_onlysmartplaylists.xml")
+    persistentIDMapping = itunessmart.generatePersistentIDMapping(library)
+    parser = itunessmart.Parser()
+    for playlist in library['Playlists']:
+        if 'Name' in playlist and ('HipHop' in playlist['Name'] or 'rap' in playlist['Name']):
+            parser.update_data_bytes(playlist['Smart Info'], playlist['Smart Criteria'])
+            before = copy.deepcopy(parser.result.queryTree)
+            first = itunessmart.createXSP(name=playlist['Name'], smartPlaylist=parser.result, createSubplaylists=True, persistentIDMapping=persistentIDMapping)
+            # The parser result is not modified, so the conversion can be repeated
+            assert parser.result.queryTree == before
+            assert itunessmart.createXSP(name=playlist['Name'], smartPlaylist=parser.result, createSubplaylists=True, persistentIDMapping=persistentIDMapping) == first
+
+
+def test_xsp_combine(verbose=False):
+    # OR'd rules with the same field and operator become one rule with many values, in the order of the rules
+    rules = []
+    for i in range(300):
+        rules.append({"field": "Artist", "type": "string", "operator": "is", "value": "Artist %d" % i})
+        rules.append({"field": "Genre", "type": "string", "operator": "like", "value": "Genre %d" % i})
+    rules.append({"field": "Artist", "type": "string", "operator": "is not", "value": "Other"})
+    parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": {"or": rules}}, ignore="")
+    smartPlaylist = itunessmart.SmartPlaylist(parser)
+    [(name, xsp)] = itunessmart.createXSP(name="example", smartPlaylist=smartPlaylist)
+    assert xsp.count("<rule ") == 3
+    artists = xsp.split('<rule field="artist" operator="is">')[1].split("</rule>")[0]
+    assert [value.split("</value>")[0] for value in artists.split("<value>")[1:]] == ["Artist %d" % i for i in range(300)]
+    assert xsp.index('field="artist" operator="is"') < xsp.index('field="genre"') < xsp.index('operator="isnot"')
+
+
+def test_xsp_export(verbose=False):
+    library = readLibrary("library_onlysmartplaylists.xml")
+    persistentIDMapping = itunessmart.generatePersistentIDMapping(library)
+    with tempfile.TemporaryDirectory() as sequential, tempfile.TemporaryDirectory() as parallel:
+        parser = itunessmart.Parser()
+        errors = 0
+        for playlist in library['Playlists']:
+            if 'Name' in playlist and 'Smart Criteria' in playlist and 'Smart Info' in playlist and playlist['Smart Criteria']:
+                parser.update_data_bytes(playlist['Smart Info'], playlist['Smart Criteria'])
+                try:
+                    itunessmart.createXSPFile(directory=sequential, name=playlist['Name'], smartPlaylist=parser.result, createSubplaylists=True, persistentIDMapping=persistentIDMapping)
+                except itunessmart.PlaylistException:
+                    errors += 1
+
+        report = itunessmart.exportXSPFiles(library['Playlists'], parallel, createSubplaylists=True, persistentIDMapping=persistentIDMapping, processes=2)
+        results = report.results
+        assert [result.name for result in results] == [p['Name'] for p in library['Playlists'] if 'Smart Info' in p and p.get('Smart Criteria')]
+        assert sum(1 for result in results if result.error) == errors
+        assert all(result.error in ("empty", "skipped") and result.message for result in results if result.error)
+
+        # Same files with the same content
+        assert sorted(os.listdir(parallel)) == sorted(os.listdir(sequential))
+        for filename in os.listdir(sequential):
+            with open(os.path.join(sequential, filename), "rb") as f, open(os.path.join(parallel, filename), "rb") as g:
+                assert f.read() == g.read(), filename
+        assert set(filename for result in results for filename in result.filenames) == set(os.listdir(parallel)) == set(report.files) == set(report.written)
+
+
+def test_xsp_incremental(verbose=False):
+    library = readLibrary("library_onlysmartplaylists.xml")
+    persistentIDMapping = itunessmart.generatePersistentIDMapping(library)
+    with tempfile.TemporaryDirectory() as full, tempfile.TemporaryDirectory() as directory:
+        itunessmart.exportXSPFiles(library['Playlists'], full, persistentIDMapping=persistentIDMapping, processes=1)
+
+        report = itunessmart.exportXSPFiles(library['Playlists'], directory, persistentIDMapping=persistentIDMapping, processes=1, incremental=True, removeStale=True)
+        assert report.unchanged == 0 and len(report.written) == len(report.files)
+        assert os.path.isfile(os.path.join(directory, itunessmart.export.manifestFilename))
+        mtime = os.stat(os.path.join(directory, itunessmart.export.manifestFilename)).st_mtime_ns
+
+        # Nothing changed: no playlist is converted and no file is written, the errors are reported again
+        again = itunessmart.exportXSPFiles(library['Playlists'], directory, persistentIDMapping=persistentIDMapping, processes=1, incremental=True, removeStale=True)
+        assert again.unchanged == len(again.results) and again.written == [] and again.removed == []
+        assert [(r.name, r.error, r.message, r.filenames) for r in again.results] == [(r.name, r.error, r.message, r.filenames) for r in report.results]
+        assert os.stat(os.path.join(directory, itunessmart.export.manifestFilename)).st_mtime_ns == mtime
+
+        # A file that was edited by hand is written again
+        with open(os.path.join(directory, "Deutschrap.xsp"), "ab") as f:
+            f.write(b"<!-- edited -->")
+        edited = itunessmart.exportXSPFiles(library['Playlists'], directory, persistentIDMapping=persistentIDMapping, processes=1, incremental=True, removeStale=True)
+        assert edited.written == ["Deutschrap.xsp"] and edited.unchanged == len(edited.results) - 1
+        with open(os.path.join(full, "Deutschrap.xsp"), "rb") as f, open(os.path.join(directory, "Deutschrap.xsp"), "rb") as g:
+            assert f.read() == g.read()
+
+        # Rename a playlist that is referenced by another playlist
+        playlists = [dict(p) for p in library['Playlists']]
+        renamed = next(p for p in playlists if p.get('Name') == "Deutschrap")
+        renamed['Name'] = "Deutschrap 2"
+        mapping = dict(persistentIDMapping)
+        mapping[renamed['Playlist Persistent ID']] = renamed['Name']
+        changed = itunessmart.exportXSPFiles(playlists, directory, persistentIDMapping=mapping, processes=1, incremental=True, removeStale=True)
+        converted = [r.name for r in changed.results if not r.unchanged]
+        assert "Deutschrap 2" in converted and "HipHop" in converted
+        assert 0 < len(converted) < len(changed.results)
+        assert "Deutschrap 2.xsp" in changed.written and "HipHop.xsp" in changed.written
+        assert changed.removed == ["Deutschrap.xsp"]
+        assert not os.path.isfile(os.path.join(directory, "Deutschrap.xsp"))
+
+        # A stale file that was edited by hand is not removed
+        with open(os.path.join(directory, "Deutschrap 2.xsp"), "ab") as f:
+            f.write(b"<!-- edited -->")
+        kept = itunessmart.exportXSPFiles(library['Playlists'], directory, persistentIDMapping=persistentIDMapping, processes=1, incremental=True, removeStale=True)
+        assert kept.removed == [] and os.path.isfile(os.path.join(directory, "Deutschrap 2.xsp"))
+        os.remove(os.path.join(directory, "Deutschrap 2.xsp"))
+
+        # Back to the first export
+        with open(os.path.join(directory, "HipHop.xsp"), "wb") as f:
+            f.write(b"")
+        back = itunessmart.exportXSPFiles(library['Playlists'], directory, persistentIDMapping=persistentIDMapping, processes=1, incremental=True, removeStale=True)
+        assert "HipHop.xsp" in back.written
+        assert sorted(os.listdir(directory)) == sorted(os.listdir(full) + [itunessmart.export.manifestFilename])
+        for filename in os.listdir(full):
+            with open(os.path.join(full, filename), "rb") as f, open(os.path.join(directory, filename), "rb") as g:
+                assert f.read() == g.read(), filename
+
+
+def test_xsp_subplaylist_registry(verbose=False):
+    # Two playlists with the same nested rules share one sub playlist
+    nested = {"or": [
+        {"field": "Artist", "type": "string", "operator": "is", "value": "Artist"},
+        {"field": "Genre", "type": "string", "operator": "is", "value": "Genre"}]}
+    smartPlaylists = []
+    for album in ("First", "Second"):
+        fulltree = {"and": [{"field": "Album", "type": "string", "operator": "is", "value": album}, nested]}
+        parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": fulltree}, ignore="")
+        smartPlaylists.append((album, itunessmart.SmartPlaylist(parser)))
+
+    registry = itunessmart.SubPlaylistRegistry()
+    for name, smartPlaylist in smartPlaylists:
+        assert itunessmart.createXSP(name, smartPlaylist, subPlaylists=registry) == itunessmart.createXSP(name, smartPlaylist)
+    assert len(registry) == 1 and registry.references == 2
+    [(first, _), _] = itunessmart.createXSP("First", smartPlaylists[0][1], subPlaylists=registry)
+    [(second, _), _] = itunessmart.createXSP("Second", smartPlaylists[1][1], subPlaylists=registry)
+    assert first == second and first.startswith("zzzsub_")
+
+    # The export creates each distinct sub playlist once
+    library = readLibrary("library_onlysmartplaylists.xml")
+    persistentIDMapping = itunessmart.generatePersistentIDMapping(library)
+    with tempfile.TemporaryDirectory() as directory:
+        report = itunessmart.exportXSPFiles(library['Playlists'], directory, persistentIDMapping=persistentIDMapping, processes=1)
+        assert report.subPlaylistReferences >= report.subPlaylists == report.subPlaylistsRendered > 0
+        assert len(report.written) == len(set(report.written)) == len(report.files)
+        assert all(os.path.isfile(os.path.join(directory, filename)) for result in report.results for filename in result.subPlaylists)
+
+
+def test_xsp_writer(verbose=False):
+    library = readLibrary("library_onlysmartplaylists.xml")
+    persistentIDMapping = itunessmart.generatePersistentIDMapping(library)
+    parser = itunessmart.Parser()
+    for playlist in library['Playlists']:
+        if 'Name' in playlist and ('HipHop' in playlist['Name'] or 'rap' in playlist['Name']):
+            parser.update_data_bytes(playlist['Smart Info'], playlist['Smart Criteria'])
+            sink = io.BytesIO()
+            subdocuments = itunessmart.writeXSP(sink, name=playlist['Name'], smartPlaylist=parser.result, persistentIDMapping=persistentIDMapping)
+            expected = itunessmart.createXSP(name=playlist['Name'], smartPlaylist=parser.result, persistentIDMapping=persistentIDMapping)
+            assert subdocuments == expected[:-1]
+            assert sink.getvalue() == expected[-1][1].encode("utf-8")
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The last write of a file wins, also with many threads and small batches
+        with itunessmart.FileWriterPool(threads=4, batch=3) as writer:
+            for i in range(100):
+                writer.write(os.path.join(directory, "same.xsp"), b"%d" % i)
+                writer.write(os.path.join(directory, "%d.xsp" % i), b"%d" % i)
+        with open(os.path.join(directory, "same.xsp"), "rb") as f:
+            assert f.read() == b"99"
+        assert len(os.listdir(directory)) == 101
+
+        # A failed write keeps the old file and removes the temporary file
+        try:
+            with itunessmart.atomicOpen(os.path.join(directory, "same.xsp")) as f:
+                f.write(b"partial")
+                raise ValueError()
+        except ValueError:
+            pass
+        with open(os.path.join(directory, "same.xsp"), "rb") as f:
+            assert f.read() == b"99"
+        assert len(os.listdir(directory)) == 101
+
+    # Playlists with the same filename: the file of the last playlist is written, like createXSPFile() one after another
+    playlists = [p for p in library['Playlists'] if 'Smart Info' in p and p.get('Smart Criteria')]
+    playlists = playlists[:20] + [dict(p, Name=playlists[0]['Name'], **{'Playlist Persistent ID': "COPY%d" % i}) for i, p in enumerate(playlists[20:40])] + playlists[40:60]
+    with tempfile.TemporaryDirectory() as sequential, tempfile.TemporaryDirectory() as parallel:
+        for playlist in playlists:
+            parser.update_data_bytes(playlist['Smart Info'], playlist['Smart Criteria'])
+            try:
+                itunessmart.createXSPFile(directory=sequential, name=playlist['Name'], smartPlaylist=parser.result, persistentIDMapping=persistentIDMapping)
+            except itunessmart.PlaylistException:
+                pass
+        for _ in range(2):
+            itunessmart.exportXSPFiles(playlists, parallel, persistentIDMapping=persistentIDMapping, processes=2, incremental=True, writers=3)
+            assert sorted(os.listdir(parallel)) == sorted(os.listdir(sequential) + [itunessmart.export.manifestFilename])
+            for filename in os.listdir(sequential):
+                with open(os.path.join(sequential, filename), "rb") as f, open(os.path.join(parallel, filename), "rb") as g:
+                    assert f.read() == g.read(), filename
+
+
+def test_xsp_ranges(verbose=False):
+    def convert(fulltree, createSubplaylists):
+        parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": fulltree}, ignore="")
+        return itunessmart.createXSP(name="example", smartPlaylist=itunessmart.SmartPlaylist(parser), createSubplaylists=createSubplaylists)
+
+    def values(xsp, field, operator):
+        rule = xsp.split('<rule field="%s" operator="%s">' % (field, operator))[1].split("</rule>")[0]
+        return [value.split("</value>")[0] for value in rule.split("<value>")[1:]]
+
+    artist = {"field": "Artist", "type": "string", "operator": "is", "value": "Foo"}
+
+    # Plays > 5 and Plays < 10 are merged to a range, the range is exported as two rules of the playlist
+    fulltree = {"and": [
+        {"field": "Plays", "type": "int", "operator": "greater than", "value": 5},
+        {"field": "Plays", "type": "int", "operator": "less than", "value": 10},
+        artist]}
+    for createSubplaylists in (True, False):
+        [(name, xsp)] = convert(fulltree, createSubplaylists)
+        assert "zzzsub_" not in xsp
+        assert values(xsp, "playcount", "greaterthan") == ["5"]
+        assert values(xsp, "playcount", "lessthan") == ["10"]
+        assert values(xsp, "artist", "is") == ["Foo"]
+
+    # Rating is 4 or Rating is 5 are merged to a range, the range is exported as one rule with both values
+    fulltree = {"or": [
+        {"field": "Rating", "type": "int", "operator": "is", "value": 4},
+        {"field": "Rating", "type": "int", "operator": "is", "value": 5},
+        artist]}
+    for createSubplaylists in (True, False):
+        [(name, xsp)] = convert(fulltree, createSubplaylists)
+        assert "zzzsub_" not in xsp
+        assert "<match>one</match>" in xsp
+        assert values(xsp, "userrating", "is") == ["4", "5"]
+        assert values(xsp, "artist", "is") == ["Foo"]
+
+
 def run_all(verbose=False):
     for fname, f in list(globals().items()):
         if fname.startswith('test_'):
@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+
+# Measure how the export of many smart playlists to XSP files scales with the number of worker processes
+# Usage: benchmark_export.py [iTunes Music Library.xml] [number of playlists]
+# The smart playlists of the library are repeated with new names until there are enough playlists
+# Then an incremental export is repeated without changes
+
+import os
+import sys
+import time
+import tempfile
+
+# Try to import from parent directory
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, include)
+import itunessmart
+
+
+if __name__ == "__main__":
+    libraryFile = sys.argv[1] if len(sys.argv) > 1 else os.path.join(include, "tests", "library_onlysmartplaylists.xml")
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    print("Reading %s . . . " % libraryFile)
+    with open(libraryFile, "rb") as fs:
+        library = itunessmart.readiTunesLibrary(fs)
+    persistentIDMapping = itunessmart.generatePersistentIDMapping(library)
+    smart = [p for p in library['Playlists'] if 'Name' in p and 'Smart Info' in p and p.get('Smart Criteria')]
+    playlists = []
+    for i in range(n):
+        playlist = smart[i % len(smart)]
+        playlists.append(dict(playlist, Name="%s %d" % (playlist['Name'], i), **{'Playlist Persistent ID': "%016X" % i}))
+    print("%d smart playlists" % len(playlists))
+
+    cpus = os.cpu_count() or 1
+    base = None
+    for processes in range(1, cpus + 1):
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            itunessmart.exportXSPFiles(playlists, directory, persistentIDMapping=persistentIDMapping, processes=processes)
+            seconds = time.perf_counter() - start
+            base = base or seconds
+            print("%2d processes: %.2f s, speedup %.2fx, %d files" % (processes, seconds, base / seconds, len(os.listdir(directory))))
+
+    with tempfile.TemporaryDirectory() as directory:
+        itunessmart.exportXSPFiles(playlists, directory, persistentIDMapping=persistentIDMapping, incremental=True)
+        start = time.perf_counter()
+        report = itunessmart.exportXSPFiles(playlists, directory, persistentIDMapping=persistentIDMapping, incremental=True)
+        print("Incremental export without changes: %.3f s, %s" % (time.perf_counter() - start, report))
@@ -0,0 +1,72 @@
+#! /usr/bin/env python3
+
+# Measure how the evaluation of all smart playlists scales with the number of worker processes
+# Usage: benchmark_parallel.py [iTunes Music Library.xml] [number of tracks]
+# Without a library file, the smart playlists of tests/library_onlysmartplaylists.xml are evaluated on random tracks
+
+import os
+import sys
+import time
+import random
+
+# Try to import from parent directory
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, include)
+import itunessmart
+
+
+def randomTracks(n, seed=1):
+    rnd = random.Random(seed)
+    now = int(time.time())
+    genres = ["Hip-Hop/Rap", "Reggae", "Metal", "Pop", "Jazz", "Soundtrack"]
+    tracks = {}
+    for i in range(1, n + 1):
+        tracks[str(i)] = {
+            "Track ID": i,
+            "Name": "Track %d" % i,
+            "Artist": "Artist %d" % rnd.randint(1, n // 10 + 1),
+            "Album": "Album %d" % rnd.randint(1, n // 5 + 1),
+            "Genre": rnd.choice(genres),
+            "Kind": rnd.choice(["MPEG audio file", "AAC audio file"]),
+            "Year": rnd.randint(1960, 2020),
+            "Play Count": rnd.randint(0, 50),
+            "Rating": rnd.choice([0, 20, 40, 60, 80, 100]),
+            "Date Added": now - rnd.randint(0, 3000) * 86400,
+            "Play Date UTC": now - rnd.randint(0, 400) * 86400,
+            "Location": "file://localhost/Music/%d.%s" % (i, rnd.choice(["mp3", "m4a"])),
+        }
+    return {"Tracks": tracks, "Playlists": []}
+
+
+if __name__ == "__main__":
+    if itunessmart.parallel.numpy is None:
+        print("NumPy is not available")
+        sys.exit(1)
+
+    libraryFile = sys.argv[1] if len(sys.argv) > 1 else os.path.join(include, "tests", "library_onlysmartplaylists.xml")
+    print("Reading %s . . . " % libraryFile)
+    with open(libraryFile, "rb") as fs:
+        library = itunessmart.readiTunesLibrary(fs)
+    evaluator = itunessmart.LibraryEvaluator(library)
+    tracks = evaluator.tracks
+    if not tracks:
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        tracks = itunessmart.createTrackRecords(randomTracks(n))
+    smartPlaylists = evaluator.smartPlaylists
+    now = time.time()
+    print("%d smart playlists, %d tracks" % (len(smartPlaylists), len(tracks)))
+
+    start = time.perf_counter()
+    expected = itunessmart.evaluateSmartPlaylists(smartPlaylists, tracks, now=now)
+    single = time.perf_counter() - start
+    print("Single process TrackTable: %.2f s" % single)
+
+    cpus = os.cpu_count() or 1
+    base = None
+    for processes in range(1, cpus + 1):
+        start = time.perf_counter()
+        result = itunessmart.evaluateParallel(smartPlaylists, tracks, now=now, processes=processes)
+        seconds = time.perf_counter() - start
+        base = base or seconds
+        assert result == expected
+        print("%2d processes: %.2f s, speedup %.2fx" % (processes, seconds, base / seconds))
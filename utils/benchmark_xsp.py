@@ -0,0 +1,33 @@
+#! /usr/bin/env python3
+
+# Measure the conversion to XSP of playlists with many alternative rules, e.g. hundreds of `Artist is ...` rules
+# The time per rule should stay the same when the number of rules grows
+
+import os
+import sys
+import time
+import types
+
+# Try to import from parent directory
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, include)
+import itunessmart
+
+
+def alternatives(n):
+    """Create a parser result with n OR'd rules on two fields"""
+    rules = []
+    for i in range(n):
+        field = "Artist" if i % 2 else "Genre"
+        rules.append({"field": field, "type": "string", "operator": "is", "value": "%s %d" % (field, i)})
+    parser = types.SimpleNamespace(output="", query="", queryTree={"fulltree": {"or": rules}}, ignore="")
+    return itunessmart.SmartPlaylist(parser)
+
+
+if __name__ == "__main__":
+    for n in (1000, 5000, 10000):
+        smartPlaylist = alternatives(n)
+        start = time.perf_counter()
+        itunessmart.createXSP("Alternatives", smartPlaylist)
+        seconds = time.perf_counter() - start
+        print("%5d rules: %.3f s, %.2f us per rule" % (n, seconds, seconds / n * 1e6))